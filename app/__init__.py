@@ -1,39 +1,151 @@
-# This script runs automatically when our `app` module is first loaded,
-# and handles all the setup for our Flask app.
-from flask import Flask, redirect, url_for
+# This script handles all the setup for our Flask app. Importing the `app`
+# package does nothing by itself: `create_app()` builds the app, e.g.
+#
+#     $ flask --app app run
+#     $ gunicorn --preload 'app:create_app()'
+#
+# Building the app doesn't connect to the database or start any background
+# threads or processes: each process creates its own connection pool (see
+# app/db/db.py) and password hashing pool (see app/utils/passwords.py) on
+# first use, and the background threads of the other modules start with the
+# first request that needs them. So it is safe to build once and fork server
+# workers from, as gunicorn does with `--preload`. How long each phase took is
+# recorded by app/utils/startup.py.
+from flask import Flask
 import os
 
-app = Flask(__name__)
-
-# Configure upload folder for event images
-from app.config import constants
-app.config[constants.IMAGE_UPLOAD_FOLDER] = os.path.join(app.root_path, 'static', 'uploads')
-os.makedirs(app.config[constants.IMAGE_UPLOAD_FOLDER], exist_ok=True)
-
-# Add multiple template search paths to Jinja2 template loader.
-# This allows Flask to locate templates stored in different subdirectories under 'templates'.
-app.jinja_loader.searchpath.append(os.path.join(app.root_path, 'templates', 'base'))
-app.jinja_loader.searchpath.append(os.path.join(app.root_path, 'templates', 'auth'))
-app.jinja_loader.searchpath.append(os.path.join(app.root_path, 'templates', 'home'))
-app.jinja_loader.searchpath.append(os.path.join(app.root_path, 'templates', 'user'))
-app.jinja_loader.searchpath.append(os.path.join(app.root_path, 'templates', 'event'))
-
-# Set the "secret key" that our app will use to sign session cookies.
-app.secret_key = 'Example Secret Key (CHANGE THIS TO YOUR OWN SECRET KEY!)'
-
-# Set up database connection.
-from app.db.connect import dbuser, dbpass, dbhost, dbname
-from app.db.db import init_db
-init_db(app, dbuser, dbpass, dbhost, dbname)
-
-# Include all modules that define our Flask route-handling functions.
-from app.routes import user
-from app.routes import admin
-from app.routes import editor
-from app.routes import traveller
-from app.routes import event
-
-# Add a root route
-@app.route('/')
-def index():
-    return redirect(url_for('login'))
\ No newline at end of file
+def create_app(config: dict = None) -> Flask:
+    """Builds the Flask app.
+
+    Args:
+        config: Optional settings applied after the defaults and environment
+            variables (see app/config/settings.py).
+
+    Returns:
+        The `Flask` application.
+    """
+    from app.utils import startup
+    startup.reset()
+
+    with startup.phase('config'):
+        app = Flask(__name__)
+
+        # Configure upload folder for event images
+        from app.config import constants
+        app.config[constants.IMAGE_UPLOAD_FOLDER] = os.path.join(app.root_path, 'static', 'uploads')
+        os.makedirs(app.config[constants.IMAGE_UPLOAD_FOLDER], exist_ok=True)
+
+        # Set the "secret key" that our app will use to sign session cookies.
+        app.secret_key = 'Example Secret Key (CHANGE THIS TO YOUR OWN SECRET KEY!)'
+
+        # Load runtime settings (defaults can be overridden by environment variables).
+        from app.config import settings
+        settings.load_settings(app)
+        app.config.update(config or {})
+
+    # Find templates through an index of their names, share compiled templates
+    # between processes, and add the `{% cache %}` fragment cache tag.
+    with startup.phase('templates'):
+        from app.utils import templates
+        templates.init_templates(app,
+                                 app.config[constants.TEMPLATE_BYTECODE_CACHE_PATH] or os.path.join(app.instance_path, 'jinja_bytecode'),
+                                 app.config[constants.TEMPLATE_FRAGMENT_CACHE_SIZE],
+                                 app.config[constants.TEMPLATE_FRAGMENT_TTL])
+
+    # Keep sessions on the server (the cookie only holds the session ID).
+    with startup.phase('sessions'):
+        from app.utils import sessions
+        sessions.init_sessions(app,
+                               app.config[constants.SESSION_STORE_PATH] or os.path.join(app.instance_path, 'sessions.sqlite3'),
+                               idle_timeout=app.config[constants.SESSION_IDLE_TIMEOUT],
+                               last_seen_flush_interval=app.config[constants.SESSION_LAST_SEEN_FLUSH_INTERVAL],
+                               poll_interval=app.config[constants.SESSION_POLL_INTERVAL])
+
+    # Set up database connectivity (the pool is created on first use).
+    with startup.phase('database'):
+        from app.db.connect import dbuser, dbpass, dbhost, dbname
+        from app.db.db import init_db
+        init_db(app, dbuser, dbpass, dbhost, dbname,
+                pool_size=app.config[constants.DB_POOL_SIZE],
+                acquire_timeout=app.config[constants.DB_POOL_ACQUIRE_TIMEOUT],
+                max_lifetime=app.config[constants.DB_POOL_MAX_LIFETIME],
+                release_early=app.config[constants.DB_RELEASE_EARLY],
+                instrument=app.config[constants.DB_INSTRUMENTATION],
+                round_trip_budget=app.config[constants.DB_ROUND_TRIP_BUDGET])
+
+    with startup.phase('caches'):
+        # Set up the cache of user rows.
+        from app.db import user_cache
+        user_cache.init_user_cache(app.config[constants.USER_CACHE_SIZE],
+                                   app.config[constants.USER_CACHE_TTL],
+                                   redis_url=app.config[constants.USER_CACHE_REDIS_URL],
+                                   shared_ttl=app.config[constants.USER_CACHE_SHARED_TTL],
+                                   free_ttl=app.config[constants.USERNAME_FREE_TTL])
+
+        # Set up the cache of journey owners and visibility checked by the event routes.
+        from app.utils import authorization
+        authorization.init_authorization(app.config[constants.JOURNEY_ACCESS_CACHE_SIZE],
+                                         app.config[constants.JOURNEY_ACCESS_TTL])
+
+        # Set up the cache of the announcements shown on the home pages.
+        from app.db import announcements
+        announcements.init_announcements(app.config[constants.ANNOUNCEMENT_CHECK_INTERVAL])
+
+    # Set up password hashing (the worker processes start on the first hash).
+    with startup.phase('passwords'):
+        from app.utils import passwords
+        passwords.init_passwords(app, app.config[constants.PASSWORD_HASH_WORKERS],
+                                 app.config[constants.PASSWORD_HASH_MAX_QUEUED],
+                                 rounds=app.config[constants.BCRYPT_LOG_ROUNDS])
+
+    # Set up login and signup rate limits.
+    with startup.phase('rate_limits'):
+        from app.utils import rate_limit
+        rate_limit.init_rate_limits(
+            app.config[constants.RATE_LIMIT_WINDOW],
+            {('login', rate_limit.KEY_IP): app.config[constants.RATE_LIMIT_LOGIN_PER_IP],
+             ('login', rate_limit.KEY_USERNAME): app.config[constants.RATE_LIMIT_LOGIN_PER_USERNAME],
+             ('signup', rate_limit.KEY_IP): app.config[constants.RATE_LIMIT_SIGNUP_PER_IP],
+             ('username_check', rate_limit.KEY_IP): app.config[constants.RATE_LIMIT_USERNAME_CHECK_PER_IP]},
+            shards=app.config[constants.RATE_LIMIT_SHARDS],
+            redis_url=app.config[constants.RATE_LIMIT_REDIS_URL])
+
+    # Set up the admin user search index.
+    with startup.phase('search'):
+        from app.search import users as user_search
+        user_search.init_search(app,
+                                app.config[constants.SEARCH_SNAPSHOT_PATH] or os.path.join(app.instance_path, 'user_search.json'),
+                                app.config[constants.SEARCH_REFRESH_INTERVAL])
+
+    # Resize uploaded images in the background, and remove the references to
+    # any that can't be processed.
+    with startup.phase('images'):
+        from app.db import image_refs
+        from app.utils import images
+        images.init_images(app, app.config[constants.IMAGE_UPLOAD_FOLDER],
+                           app.config[constants.IMAGE_STAGING_FOLDER] or os.path.join(app.instance_path, 'image_staging'),
+                           workers=app.config[constants.IMAGE_WORKERS],
+                           quality=app.config[constants.IMAGE_WEBP_QUALITY],
+                           on_failure=image_refs.forget)
+
+    # Serve static files with fingerprinted URLs and long-lived caching.
+    with startup.phase('static'):
+        from app.utils import static_assets
+        static_assets.init_static(app, app.config[constants.STATIC_SENDFILE],
+                                  accel_prefix=app.config[constants.STATIC_ACCEL_PREFIX],
+                                  max_age=app.config[constants.STATIC_MAX_AGE])
+
+    # Register the blueprints of all modules that define our Flask
+    # route-handling functions.
+    with startup.phase('routes'):
+        from app.routes import user, admin, editor, traveller, event, journey, announcement
+        for module in (user, admin, editor, traveller, event, journey, announcement):
+            app.register_blueprint(module.bp)
+
+    # Register the `flask` maintenance commands.
+    with startup.phase('cli'):
+        from app import cli
+        cli.init_cli(app)
+
+    app.logger.info('Started in %.1fms', startup.report()['total_ms'])
+    return app
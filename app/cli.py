@@ -0,0 +1,320 @@
+"""
+cli.py
+
+Maintenance commands for the app, run with Flask's `flask` command from the
+project directory, e.g.:
+```
+$ flask --app app passwords benchmark --target-ms 250
+$ flask --app app db migrate
+```
+"""
+import math
+import statistics
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+import bcrypt
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from app.config import constants
+from app.db import image_refs, journey_feed, migrate as migrations
+from app.search import users as user_search
+from app.utils import event_io, images, passwords, startup, static_assets, templates, validators
+
+passwords_cli = AppGroup('passwords', help='Password hashing commands.')
+
+@passwords_cli.command('benchmark')
+@click.option('--target-ms', default=250.0, show_default=True,
+              help='Longest acceptable time (p99) to check a password at login.')
+@click.option('--samples', default=200, show_default=True,
+              help='Hashes timed at each cost factor (fewer than 100 reports the max instead of the p99).')
+@click.option('--min-cost', default=10, show_default=True, help='Lowest cost factor to try.')
+@click.option('--max-cost', default=16, show_default=True, help='Highest cost factor to try.')
+def benchmark(target_ms, samples, min_cost, max_cost):
+    """Times bcrypt on this host and recommends a cost factor.
+
+    Hashes are run the way logins run them: in a pool of
+    PASSWORD_HASH_WORKERS processes, with every worker kept busy, so the
+    times include the workers competing for the CPU and handing back
+    results. They don't include waiting for a free worker, which depends on
+    how many logins arrive at once. With PASSWORD_HASH_WORKERS=0 one hash is
+    timed at a time. Every extra point of cost doubles the time, so costs are
+    tried from lowest to highest until one misses the target. The
+    recommendation is the highest cost whose p99 (or max, with fewer than 100
+    samples) meets `--target-ms`. Set it with the BCRYPT_LOG_ROUNDS
+    environment variable.
+    """
+    workers = current_app.config[constants.PASSWORD_HASH_WORKERS]
+    tail = 'p99' if samples >= 100 else 'max'
+    # The number of timings that can miss the target before the tail does.
+    allowed_misses = samples - (math.ceil(0.99 * samples) if tail == 'p99' else samples)
+    click.echo(f'Current cost factor: {current_app.config[constants.BCRYPT_LOG_ROUNDS]}')
+    if workers > 0:
+        click.echo(f'Timing hashes with all {workers} hashing workers busy '
+                   f'(not including the wait for a free worker).')
+    else:
+        click.echo('Timing one hash at a time (PASSWORD_HASH_WORKERS=0 hashes on the request threads).')
+    click.echo(f'{"cost":>4}  {"p50 ms":>8}  {tail + " ms":>8}  {"logins/s":>8}')
+
+    executor = passwords.make_pool(workers) if workers > 0 else None
+    recommended = None
+    try:
+        for cost in range(min_cost, max_cost + 1):
+            salt = bcrypt.gensalt(rounds=cost)
+            timings = _time_hashes(executor, workers, salt, samples,
+                                   stop=lambda timings: sum(t > target_ms for t in timings) > allowed_misses)
+            p50 = statistics.median(timings)
+            # Sustained password checks per second with every worker busy.
+            throughput = max(workers, 1) * 1000 / p50
+            if len(timings) < samples:
+                # Stopped early: too many hashes missed the target already.
+                click.echo(f'{cost:>4}  {p50:>8.1f}  {">" + format(target_ms, "g"):>8}  {throughput:>8.1f}')
+                break
+            timings.sort()
+            slowest = timings[math.ceil(0.99 * len(timings)) - 1] if tail == 'p99' else timings[-1]
+            click.echo(f'{cost:>4}  {p50:>8.1f}  {slowest:>8.1f}  {throughput:>8.1f}')
+            if slowest > target_ms:
+                break
+            recommended = cost
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if recommended is None:
+        click.echo(f'No cost factor from {min_cost} meets a {tail} of {target_ms:g}ms on this host.')
+    else:
+        click.echo(f'Recommended cost factor: {recommended} (BCRYPT_LOG_ROUNDS={recommended})')
+
+def _time_hashes(executor, workers, salt, samples, stop):
+    """Times `samples` hashes with `salt`, keeping `workers` of them running
+    on `executor` at once (or running them one at a time on this thread if
+    there's no executor).
+
+    Args:
+        stop: Called with the timings so far after each hash; hashing stops
+            early once it returns True.
+
+    Returns:
+        The time each hash took, in milliseconds, from being handed to a
+        worker to its result coming back.
+    """
+    timings = []
+    if executor is None:
+        while len(timings) < samples and not stop(timings):
+            start = time.perf_counter()
+            bcrypt.hashpw(b'benchmark password', salt)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    running = {}
+    submitted = 0
+    while (running or submitted < samples) and not stop(timings):
+        while len(running) < workers and submitted < samples:
+            running[executor.submit(bcrypt.hashpw, b'benchmark password', salt)] = time.perf_counter()
+            submitted += 1
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        now = time.perf_counter()
+        for future in done:
+            future.result()
+            timings.append((now - running.pop(future)) * 1000)
+    for future in running:
+        future.cancel()
+    wait(running)
+    return timings
+
+validators_cli = AppGroup('validators', help='Form validation commands.')
+
+# A valid submission of each form, and one with a problem in every field it
+# can (the slowest case for the field checks that stop at the first problem).
+_BENCHMARK_FORMS = {
+    'signup': (validators.SIGNUP_FORM,
+               dict(username='traveller42', email='traveller42@example.com', password='Tr4vel!ing',
+                    confirm_password='Tr4vel!ing', first_name='Ada', last_name='Lovelace', location='Christchurch'),
+               dict(username='traveller_42!', email='traveller42.example.com', password='travelling',
+                    confirm_password='travelling!', first_name=' ', last_name='x' * 51, location=' ')),
+    'profile': (validators.PROFILE_FORM,
+                dict(email='traveller42@example.com', first_name='Ada', last_name='Lovelace',
+                     location='Christchurch', personal_description='Likes trains.'),
+                dict(email='traveller42@', first_name=' ', last_name=' ', location='x' * 51,
+                     personal_description=' ')),
+    'change password': (validators.CHANGE_PASSWORD_FORM,
+                        dict(new_password='N3w-passw0rd', confirm_password='N3w-passw0rd'),
+                        dict(new_password='NEWPASSWORD1', confirm_password='NEWPASSWORD')),
+    'user edit': (validators.USER_EDIT_FORM,
+                  dict(role='editor', status='active'),
+                  dict(role='superuser', status='gone')),
+    'event': (validators.EVENT_FORM,
+              dict(title='Arrival', description='', start_time='2025-03-01T09:30', end_time='',
+                   location='Wellington'),
+              dict(title=' ', start_time='March 1st', end_time='soon', location='x' * 101)),
+    'announcement': (validators.ANNOUNCEMENT_FORM,
+                     dict(title='Maintenance', content='Down on Sunday.', level='high', status='active'),
+                     dict(title='', content=' ', level='urgent', status='')),
+}
+
+@validators_cli.command('benchmark')
+@click.option('--iterations', default=20000, show_default=True, help='Validations timed per form.')
+def benchmark_validators(iterations):
+    """Times the validation of each form (see app/utils/validators.py),
+    for a valid submission and for one with a problem in every field."""
+    click.echo(f'{"form":<16}  {"fields":>6}  {"valid µs":>9}  {"invalid µs":>10}')
+    for name, (form, valid, invalid) in _BENCHMARK_FORMS.items():
+        timings = []
+        for values in (valid, invalid):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                form.validate(values)
+            timings.append((time.perf_counter() - start) * 1e6 / iterations)
+        click.echo(f'{name:<16}  {len(form.fields):>6}  {timings[0]:>9.2f}  {timings[1]:>10.2f}')
+
+search_cli = AppGroup('search', help='User search index commands.')
+
+@search_cli.command('rebuild')
+def rebuild_search():
+    """Rebuilds the user search index from the users table.
+
+    The index is saved to its snapshot file, which every running app process
+    reloads within a second or so of it changing.
+    """
+    start = time.perf_counter()
+    count = user_search.rebuild()
+    click.echo(f'Indexed {count} users in {(time.perf_counter() - start) * 1000:.0f}ms.')
+
+images_cli = AppGroup('images', help='Uploaded image commands.')
+
+@images_cli.command('backfill')
+def backfill_images():
+    """Makes the resized variants of images uploaded before they existed,
+    and of any uploads left in the staging folder."""
+    start = time.perf_counter()
+    count = images.backfill()
+    click.echo(f'Processed {count} images in {(time.perf_counter() - start):.1f}s.')
+
+@images_cli.command('gc')
+@click.option('--grace', default=3600.0, show_default=True,
+              help='Seconds an image must have been unreferenced before it is deleted.')
+def collect_image_garbage(grace):
+    """Deletes the uploaded images that no user or event refers to."""
+    deleted, orphans = image_refs.collect_garbage(grace)
+    click.echo(f'Deleted {deleted} unreferenced images and {orphans} orphaned files.')
+
+static_cli = AppGroup('static', help='Static file commands.')
+
+@static_cli.command('compress')
+def compress_static():
+    """Writes gzip (and, if the brotli package is installed, brotli) copies
+    of the static text files, for the app to serve precompressed. Run it on
+    each deploy, before starting the app."""
+    count = static_assets.compress()
+    click.echo(f'Wrote {count} compressed files.')
+
+events_cli = AppGroup('events', help='Journey event commands.')
+
+@events_cli.command('import')
+@click.argument('journey_id', type=int)
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', 'file_format', type=click.Choice(list(event_io.FORMATS)),
+              help='File format (default: from the file name).')
+def import_events(journey_id, file, file_format):
+    """Imports events from a CSV or JSON Lines FILE into a journey. Nothing
+    is imported if any row is invalid."""
+    file_format = event_io.detect_format(file.name, file_format)
+    if file_format is None:
+        raise click.ClickException('Unknown file format: use --format.')
+    result = event_io.import_events(journey_id, file, file_format, max_rows=2 ** 31)
+    for line, error in result.errors:
+        click.echo(f'Line {line}: {error}' if line else error, err=True)
+    if result.errors:
+        raise click.ClickException('No events were imported.')
+    click.echo(f'Imported {result.imported} events.')
+
+@events_cli.command('export')
+@click.argument('journey_id', type=int)
+@click.option('--format', 'file_format', type=click.Choice(list(event_io.FORMATS)), default='csv',
+              show_default=True)
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-',
+              help='File to write (default: standard output).')
+def export_events(journey_id, file_format, output):
+    """Exports a journey's events as CSV or JSON Lines."""
+    for line in event_io.export_events(journey_id, file_format):
+        output.write(line)
+
+feed_cli = AppGroup('feed', help='Public journey feed commands.')
+
+@feed_cli.command('rebuild')
+def rebuild_feed():
+    """Recomputes the public journey feed from the journeys and events
+    tables, e.g. after changing journeys by hand in the database."""
+    start = time.perf_counter()
+    refreshed, removed = journey_feed.rebuild()
+    click.echo(f'Refreshed the feed ({refreshed} rows affected, {removed} removed) '
+               f'in {(time.perf_counter() - start) * 1000:.0f}ms.')
+
+db_cli = AppGroup('db', help='Database schema commands.')
+
+@db_cli.command('migrate')
+def migrate():
+    """Applies the pending migrations in app/db/migrations/."""
+    try:
+        applied = migrations.migrate(log=click.echo)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Applied {len(applied)} migration(s).' if applied else 'The schema is up to date.')
+
+@db_cli.command('status')
+def migration_status():
+    """Lists the migrations and whether each has been applied."""
+    for migration, applied in migrations.status():
+        click.echo(f"{migration.version:04d}_{migration.name}  {'applied' if applied else 'pending'}")
+
+@db_cli.command('check-plans')
+def check_plans():
+    """EXPLAINs every registered query, and the user filter's statements for
+    a sample of filters, and fails if any would scan a whole table (queries
+    registered with `full_scan_ok=True` excepted). Run it after changing
+    queries or indexes, against a database with realistic table sizes.
+    """
+    problems = migrations.check_query_plans()
+    for name, table in problems:
+        click.echo(f'Full scan of {table} in query {name}', err=True)
+    if problems:
+        raise click.ClickException(f'{len(problems)} full table scan(s) found.')
+    click.echo('No full table scans found.')
+
+templates_cli = AppGroup('templates', help='Template commands.')
+
+@templates_cli.command('compile')
+def compile_templates():
+    """Compiles every template into the shared bytecode cache, so no worker
+    has to compile one on its first request. Run it on each deploy, before
+    starting the app."""
+    compiled, seconds = templates.compile_all(current_app)
+    click.echo(f'Compiled {compiled} templates in {seconds * 1000:.0f}ms.')
+
+startup_cli = AppGroup('startup', help='Startup commands.')
+
+@startup_cli.command('report')
+def startup_report():
+    """Lists how long each phase of building the app took (in this process:
+    run it to time a startup)."""
+    report = startup.report()
+    for phase in report['phases']:
+        click.echo(f"{phase['phase']:<16}{phase['ms']:>8.1f}ms")
+    click.echo(f"{'total':<16}{report['total_ms']:>8.1f}ms")
+
+def init_cli(app):
+    """Registers the maintenance commands with the app.
+
+    Args:
+        app: The `Flask` application.
+    """
+    app.cli.add_command(passwords_cli)
+    app.cli.add_command(validators_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(images_cli)
+    app.cli.add_command(static_cli)
+    app.cli.add_command(events_cli)
+    app.cli.add_command(feed_cli)
+    app.cli.add_command(db_cli)
+    app.cli.add_command(templates_cli)
+    app.cli.add_command(startup_cli)
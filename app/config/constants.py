@@ -36,19 +36,61 @@ USER_STATUS_BANNED = 'banned'
 IMAGE_UPLOAD_FOLDER = 'IMAGE_UPLOAD_FOLDER'
 IMAGE_UPLOAD_FOLDER_URL = 'static/uploads'
 
+# App config keys (defaults and environment overrides live in config/settings.py)
+DB_INSTRUMENTATION = 'DB_INSTRUMENTATION'  # Record per-request SQL timing and round trips
+DB_ROUND_TRIP_BUDGET = 'DB_ROUND_TRIP_BUDGET'  # Statements per request before it gets flagged
+DB_POOL_SIZE = 'DB_POOL_SIZE'  # Connections in the MySQL pool (max 32)
+DB_POOL_ACQUIRE_TIMEOUT = 'DB_POOL_ACQUIRE_TIMEOUT'  # Seconds to wait for a free connection
+DB_POOL_MAX_LIFETIME = 'DB_POOL_MAX_LIFETIME'  # Seconds before a connection is replaced
+DB_RELEASE_EARLY = 'DB_RELEASE_EARLY'  # Release connections once their last cursor closes
+USER_CACHE_SIZE = 'USER_CACHE_SIZE'  # User rows cached per process
+USER_CACHE_TTL = 'USER_CACHE_TTL'  # Seconds a user row stays in the per-process cache
+USER_CACHE_REDIS_URL = 'USER_CACHE_REDIS_URL'  # Optional Redis URL shared by all workers
+USER_CACHE_SHARED_TTL = 'USER_CACHE_SHARED_TTL'  # Seconds a user row stays in Redis
+USERNAME_FREE_TTL = 'USERNAME_FREE_TTL'  # Seconds a username found to be free is cached as such
+PASSWORD_HASH_WORKERS = 'PASSWORD_HASH_WORKERS'  # Worker processes used for bcrypt
+PASSWORD_HASH_MAX_QUEUED = 'PASSWORD_HASH_MAX_QUEUED'  # bcrypt jobs allowed to wait for a worker
+BCRYPT_LOG_ROUNDS = 'BCRYPT_LOG_ROUNDS'  # bcrypt cost factor for new hashes (Flask-Bcrypt's key)
+RATE_LIMIT_WINDOW = 'RATE_LIMIT_WINDOW'  # Seconds in the login/signup rate limit window
+RATE_LIMIT_LOGIN_PER_IP = 'RATE_LIMIT_LOGIN_PER_IP'  # Login attempts per IP address per window
+RATE_LIMIT_LOGIN_PER_USERNAME = 'RATE_LIMIT_LOGIN_PER_USERNAME'  # Login attempts per username per window
+RATE_LIMIT_SIGNUP_PER_IP = 'RATE_LIMIT_SIGNUP_PER_IP'  # Signup attempts per IP address per window
+RATE_LIMIT_USERNAME_CHECK_PER_IP = 'RATE_LIMIT_USERNAME_CHECK_PER_IP'  # Username availability checks per IP address per window
+RATE_LIMIT_SHARDS = 'RATE_LIMIT_SHARDS'  # Shards in the in-process rate limit store
+RATE_LIMIT_REDIS_URL = 'RATE_LIMIT_REDIS_URL'  # Optional Redis URL for rate limit counters
+SESSION_STORE_PATH = 'SESSION_STORE_PATH'  # SQLite file server-side sessions are written to
+SESSION_IDLE_TIMEOUT = 'SESSION_IDLE_TIMEOUT'  # Seconds a session can go unused before it ends
+SESSION_LAST_SEEN_FLUSH_INTERVAL = 'SESSION_LAST_SEEN_FLUSH_INTERVAL'  # Seconds between writes of when sessions were last used
+SESSION_POLL_INTERVAL = 'SESSION_POLL_INTERVAL'  # Seconds between checks for revoked sessions
+SEARCH_SNAPSHOT_PATH = 'SEARCH_SNAPSHOT_PATH'  # File the user search index is saved to
+SEARCH_REFRESH_INTERVAL = 'SEARCH_REFRESH_INTERVAL'  # Seconds between user search index rebuilds
+IMAGE_STAGING_FOLDER = 'IMAGE_STAGING_FOLDER'  # Folder uploads wait in until they are resized
+IMAGE_WORKERS = 'IMAGE_WORKERS'  # Threads resizing uploaded images
+IMAGE_WEBP_QUALITY = 'IMAGE_WEBP_QUALITY'  # WebP quality of the resized images (0-100)
+STATIC_SENDFILE = 'STATIC_SENDFILE'  # '', 'x-sendfile' or 'x-accel-redirect'
+STATIC_ACCEL_PREFIX = 'STATIC_ACCEL_PREFIX'  # Internal nginx location for the static folder
+STATIC_MAX_AGE = 'STATIC_MAX_AGE'  # Seconds browsers cache fingerprinted static files for
+EVENT_IMPORT_MAX_ROWS = 'EVENT_IMPORT_MAX_ROWS'  # Most events a single import may contain
+JOURNEY_ACCESS_CACHE_SIZE = 'JOURNEY_ACCESS_CACHE_SIZE'  # Journey owners and visibility cached per process
+JOURNEY_ACCESS_TTL = 'JOURNEY_ACCESS_TTL'  # Seconds a journey's owner and visibility stay cached
+ANNOUNCEMENT_CHECK_INTERVAL = 'ANNOUNCEMENT_CHECK_INTERVAL'  # Seconds between checks that cached announcements are current
+TEMPLATE_BYTECODE_CACHE_PATH = 'TEMPLATE_BYTECODE_CACHE_PATH'  # Folder compiled templates are shared between processes in
+TEMPLATE_FRAGMENT_CACHE_SIZE = 'TEMPLATE_FRAGMENT_CACHE_SIZE'  # Rendered template fragments cached per process
+TEMPLATE_FRAGMENT_TTL = 'TEMPLATE_FRAGMENT_TTL'  # Default seconds a rendered template fragment stays cached
+
 # URL endpoint names
-URL_LOGIN = 'login'  # URL for the login page
-URL_TRAVELLER_HOME = 'traveller_home'
-URL_EDITOR_HOME = 'editor_home'
-URL_ADMIN_HOME = 'admin_home'
-URL_PROFILE = 'profile'
-URL_SIGNUP = 'signup'
+URL_LOGIN = 'user.login'  # URL for the login page
+URL_TRAVELLER_HOME = 'traveller.traveller_home'
+URL_EDITOR_HOME = 'editor.editor_home'
+URL_ADMIN_HOME = 'admin.admin_home'
+URL_PROFILE = 'user.profile'
+URL_SIGNUP = 'user.signup'
 
 # Event-related URLs
-URL_VIEW_EVENTS = 'view_events'
-URL_ADD_EVENT = 'add_event'
-URL_EDIT_EVENT = 'edit_event'
-URL_DELETE_EVENT = 'delete_event'
+URL_VIEW_EVENTS = 'event.view_events'
+URL_ADD_EVENT = 'event.add_event'
+URL_EDIT_EVENT = 'event.edit_event'
+URL_DELETE_EVENT = 'event.delete_event'
 
 # Template file names
 TEMPLATE_ACCESS_DENIED = 'access_denied.html'  # Template displayed when a user is denied access to a resource
@@ -66,6 +108,10 @@ TEMPLATE_AVATAR_PREVIEW = 'avatar_preview.html'
 # Event-related templates
 TEMPLATE_EVENTS = 'event/events.html'
 TEMPLATE_EVENT_FORM = 'event/event_form.html'
+TEMPLATE_JOURNEY_FEED = 'journey/feed.html'  # Template for the public journey feed
+TEMPLATE_JOURNEY_FEED_CARDS = 'journey/feed_cards.html'  # Template for a page of feed cards
+TEMPLATE_ANNOUNCEMENTS = 'announcement/announcements.html'  # Template for managing announcements
+TEMPLATE_ANNOUNCEMENT_FORM = 'announcement/announcement_form.html'  # Template for adding or editing an announcement
 
 # HTTP status codes
 # User permission-related issues
@@ -73,6 +119,9 @@ HTTP_STATUS_CODE_403 = 403  # Forbidden: User does not have permission to access
 # Database errors or other internal server issues
 HTTP_STATUS_CODE_500 = 500  # Internal Server Error: A generic error indicating that something went wrong on the server side
 HTTP_STATUS_CODE_404 = 404
+HTTP_STATUS_CODE_429 = 429  # Too Many Requests: the client is being rate limited
+# Server is temporarily overloaded (e.g. no free database connection)
+HTTP_STATUS_CODE_503 = 503
 
 # Flash message types for different scenarios
 FLASH_MESSAGE_DANGER = 'danger' # Used for error messages or warnings
@@ -80,6 +129,15 @@ FLASH_MESSAGE_DANGER = 'danger' # Used for error messages or warnings
 SEARCH_TERM = 'searchterm'  # Query parameter for the search term
 SEARCH_CATEGORY = 'searchcat'  # Query parameter for the search category
 
+PAGE_SIZE = 'per_page'  # Query parameter for the number of rows per page
+PAGE_AFTER = 'after'  # Query parameter for the cursor of the row before the page
+PAGE_BEFORE = 'before'  # Query parameter for the cursor of the row after the page
+PAGE_NUMBER = 'page'  # Query parameter for the page number of search results
+DEFAULT_PAGE_SIZE = 50  # Rows per page when no page size is given
+MAX_PAGE_SIZE = 200  # Largest page size a client may ask for
+EVENTS_PAGE_SIZE = 20  # Events per page of a journey's timeline
+FEED_PAGE_SIZE = 20  # Journeys per page of the public journey feed
+
 FORM_FIELD_CURRENT_PASSWORD = 'current_password'  # Form field for the user's current password
 FORM_FIELD_NEW_PASSWORD = 'new_password'  # Form field for the user's new password
 FORM_FIELD_CONFIRM_PASSWORD = 'confirm_password'  # Form field to confirm the new password
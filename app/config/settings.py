@@ -0,0 +1,129 @@
+"""Runtime settings for the Flask app.
+
+Every setting has a default below and can be overridden by setting an
+environment variable with the same name before starting the app, e.g.:
+```
+$ DB_INSTRUMENTATION=1 flask run
+```
+"""
+import os
+from app.config import constants
+
+DEFAULTS = {
+    # Record timing, row counts and round trips for every SQL statement run
+    # through `db.get_cursor()` (see app/db/instrumentation.py).
+    constants.DB_INSTRUMENTATION: False,
+    # Number of SQL statements a single request may run before it is flagged
+    # in the instrumentation log.
+    constants.DB_ROUND_TRIP_BUDGET: 8,
+    # Size of the MySQL connection pool. Size this to at least the number of
+    # request threads per worker; mysql-connector caps pools at 32.
+    constants.DB_POOL_SIZE: 10,
+    # Seconds a request waits for a free connection before failing with 503.
+    constants.DB_POOL_ACQUIRE_TIMEOUT: 5.0,
+    # Seconds after which a connection is reconnected (0 = never).
+    constants.DB_POOL_MAX_LIFETIME: 1800.0,
+    # Return a request's connection to the pool as soon as its last cursor is
+    # closed, instead of holding it until the request ends (see app/db/db.py).
+    constants.DB_RELEASE_EARLY: True,
+    # Read-through cache of `users` rows (see app/db/user_cache.py).
+    constants.USER_CACHE_SIZE: 10000,
+    constants.USER_CACHE_TTL: 60.0,
+    # Set to e.g. redis://localhost:6379/0 to share cached rows between
+    # workers. Lower USER_CACHE_TTL to a few seconds when you do.
+    constants.USER_CACHE_REDIS_URL: '',
+    constants.USER_CACHE_SHARED_TTL: 300.0,
+    # The signup form's live username check caches free usernames this long.
+    constants.USERNAME_FREE_TTL: 10.0,
+    # Password hashing runs in this many worker processes per app process
+    # (see app/utils/passwords.py). 0 hashes on the request thread instead.
+    constants.PASSWORD_HASH_WORKERS: 2,
+    # Hashes that may wait for a free worker; any more are refused with 503.
+    constants.PASSWORD_HASH_MAX_QUEUED: 8,
+    constants.BCRYPT_LOG_ROUNDS: 12,
+    # Sliding-window limits on login and signup attempts (see
+    # app/utils/rate_limit.py). 0 turns a limit off.
+    constants.RATE_LIMIT_WINDOW: 60.0,
+    constants.RATE_LIMIT_LOGIN_PER_IP: 30,
+    constants.RATE_LIMIT_LOGIN_PER_USERNAME: 10,
+    constants.RATE_LIMIT_SIGNUP_PER_IP: 10,
+    # The signup form checks the username as it is typed (at most a few
+    # times a second).
+    constants.RATE_LIMIT_USERNAME_CHECK_PER_IP: 60,
+    constants.RATE_LIMIT_SHARDS: 16,
+    # Set to e.g. redis://localhost:6379/0 to share the limits between
+    # workers; otherwise each worker process counts attempts separately.
+    constants.RATE_LIMIT_REDIS_URL: '',
+    # Server-side sessions (see app/utils/sessions.py). An empty path keeps
+    # them in sessions.sqlite3 in the app's instance folder.
+    constants.SESSION_STORE_PATH: '',
+    constants.SESSION_IDLE_TIMEOUT: 14 * 24 * 3600.0,
+    # Only when each session was last used is written behind; every other
+    # change is written straight away.
+    constants.SESSION_LAST_SEEN_FLUSH_INTERVAL: 1.0,
+    # Also the longest a revoked session can keep working in another worker
+    # process.
+    constants.SESSION_POLL_INTERVAL: 1.0,
+    # In-memory user search index (see app/search/users.py). An empty path
+    # keeps the snapshot in user_search.json in the app's instance folder.
+    constants.SEARCH_SNAPSHOT_PATH: '',
+    # Also the longest a change made by another worker process can take to
+    # show up in this one's search results.
+    constants.SEARCH_REFRESH_INTERVAL: 300.0,
+    # Uploaded images are resized in the background (see
+    # app/utils/images.py). An empty folder stages uploads in image_staging
+    # in the app's instance folder. 0 workers resizes on the request thread.
+    constants.IMAGE_STAGING_FOLDER: '',
+    constants.IMAGE_WORKERS: 2,
+    constants.IMAGE_WEBP_QUALITY: 80,
+    # Static files (see app/utils/static_assets.py). Set STATIC_SENDFILE to
+    # 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx, with an
+    # internal location at STATIC_ACCEL_PREFIX) to let the web server send
+    # the files.
+    constants.STATIC_SENDFILE: '',
+    constants.STATIC_ACCEL_PREFIX: '/protected-static/',
+    constants.STATIC_MAX_AGE: 365 * 24 * 3600,
+    # Bulk event imports (see app/utils/event_io.py).
+    constants.EVENT_IMPORT_MAX_ROWS: 5000,
+    # Cache of each journey's owner and visibility, checked by the event
+    # routes (see app/utils/authorization.py).
+    constants.JOURNEY_ACCESS_CACHE_SIZE: 10000,
+    constants.JOURNEY_ACCESS_TTL: 30.0,
+    # How often each process checks that its cached home page announcements
+    # are current (see app/db/announcements.py).
+    constants.ANNOUNCEMENT_CHECK_INTERVAL: 1.0,
+    # Folder compiled templates are written to and shared between worker
+    # processes ('' = the `jinja_bytecode` folder in the instance folder).
+    constants.TEMPLATE_BYTECODE_CACHE_PATH: '',
+    # Rendered `{% cache %}` fragments kept per process (0 = don't cache), and
+    # how long they are kept when the tag gives no time (see
+    # app/utils/templates.py).
+    constants.TEMPLATE_FRAGMENT_CACHE_SIZE: 5000,
+    constants.TEMPLATE_FRAGMENT_TTL: 300.0,
+}
+
+def load_settings(app):
+    """Copies every setting into `app.config`, applying any environment
+    variable overrides.
+
+    Args:
+        app: The `Flask` application to configure.
+    """
+    for key, default in DEFAULTS.items():
+        app.config[key] = _read_env(key, default)
+
+def _read_env(key, default):
+    """Reads an environment variable, converting it to the type of `default`.
+
+    Returns `default` if the variable is not set.
+    """
+    value = os.environ.get(key)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
@@ -0,0 +1,119 @@
+"""Announcements, as shown on the home pages, and their in-process cache.
+
+Every user lands on a home page after logging in, and every home page shows
+the active announcements, most important (then newest) first. They rarely
+change, so each process keeps the list in memory:
+```
+>>> announcements.active()
+({'announcement_id': 3, 'title': ..., 'level': 'high', ...}, ...)
+```
+
+Instead of re-reading the list on every page view, `active()` checks at most
+every `check_interval` seconds whether it is still current, by comparing
+`queries.ANNOUNCEMENTS_VERSION` (the `announcements` counter in
+`content_versions`, and the newest `announcement_id`) with the values it was
+loaded at. Only when they differ is the list read again. `create()`,
+`update()` and `delete()` bump the counter in the same round trip as their
+change, so every process picks the change up at its next check; announcements
+inserted straight into the database are noticed by their new id.
+"""
+import threading
+import time
+from app.db import db, queries
+
+# Settings (see `init_announcements`).
+_check_interval = 1.0
+
+# The cached announcements, the `(version, max_id)` they were loaded at, and
+# when the version was last checked.
+_active = ()
+_version = None
+_checked_at = float('-inf')
+_lock = threading.Lock()
+
+_counters = dict(hits=0, checks=0, reloads=0)
+_counters_lock = threading.Lock()
+
+def init_announcements(check_interval: float):
+    """Sets up the announcements cache.
+
+    Args:
+        check_interval: Seconds between checks that the cached announcements
+            are current (0 checks on every call).
+    """
+    global _check_interval, _active, _version, _checked_at
+    _check_interval = check_interval
+    _active, _version, _checked_at = (), None, float('-inf')
+
+def active():
+    """Returns the active announcements, most important first. Needs an app
+    context.
+
+    Returns:
+        A tuple of rows (see `queries.ACTIVE_ANNOUNCEMENTS` for their columns).
+        Don't change them: they are shared by every request.
+    """
+    global _active, _version, _checked_at
+    if time.monotonic() - _checked_at < _check_interval:
+        with _counters_lock:
+            _counters['hits'] += 1
+        return _active
+    # One thread checks while the others carry on with the cached list (unless
+    # there isn't one yet).
+    if not _lock.acquire(blocking=_version is None):
+        with _counters_lock:
+            _counters['hits'] += 1
+        return _active
+    try:
+        if time.monotonic() - _checked_at < _check_interval:
+            return _active
+        row = queries.fetch_one(queries.ANNOUNCEMENTS_VERSION)
+        version = (row['version'], row['max_id'])
+        reloaded = version != _version
+        if reloaded:
+            _active = tuple(queries.fetch_all(queries.ACTIVE_ANNOUNCEMENTS))
+            _version = version
+        _checked_at = time.monotonic()
+        with _counters_lock:
+            _counters['checks'] += 1
+            _counters['reloads'] += reloaded
+        return _active
+    finally:
+        _lock.release()
+
+def create(user_id: int, title: str, content: str, level: str, status: str):
+    """Adds an announcement."""
+    _change(queries.INSERT_ANNOUNCEMENT, (user_id, title, content, level, status))
+
+def update(announcement_id: int, title: str, content: str, level: str, status: str) -> bool:
+    """Changes an announcement.
+
+    Returns:
+        False if there is no such announcement.
+    """
+    return _change(queries.UPDATE_ANNOUNCEMENT, (title, content, level, status, announcement_id)) > 0
+
+def delete(announcement_id: int) -> bool:
+    """Deletes an announcement.
+
+    Returns:
+        False if there is no such announcement.
+    """
+    return _change(queries.DELETE_ANNOUNCEMENT, (announcement_id,)) > 0
+
+def _change(query, params):
+    """Runs a change to `announcements` and bumps their version in one round
+    trip, and makes this process check the version on its next `active()`.
+
+    Returns:
+        The number of announcements the change matched.
+    """
+    global _checked_at
+    matched, _ = db.run_batch((query.sql, params), (queries.BUMP_ANNOUNCEMENTS_VERSION.sql, None))
+    _checked_at = float('-inf')
+    return matched
+
+def stats():
+    """Returns the announcements cache counters of this process."""
+    with _counters_lock:
+        return dict(_counters, cached=len(_active), version=_version)
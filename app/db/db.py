@@ -1,10 +1,11 @@
 """Implements simple MySQL database connectivity for a Flask web app.
 
 This approach is based on the "Define and Access the Database" Flask
-tutorial [1], adapted to use MySQL with connection pooling. It gives you an
-easy way to request a database connection or cursor while processing a Flask
-request, and gives you access to that connection from anywhere in your app
-(including other functions or modules) until the request is complete.
+tutorial [1], adapted to use MySQL with connection pooling (see
+`app/db/pool.py`). It gives you an easy way to request a database connection
+or cursor while processing a Flask request, and gives you access to that
+connection from anywhere in your app (including other functions or modules)
+until the request is complete.
 
 Usage:
 ------
@@ -15,6 +16,11 @@ When initialising your Flask application, call `init_db` passing in your
 >>> db.init_db(app, 'username', 'password', 'host', 'database')
 ```
 
+`init_db` doesn't connect to the database: each process creates its pool the
+first time it needs a connection (see `get_pool()`). A process forked after
+that (e.g. a gunicorn worker under `--preload`) drops the pool it inherited
+and creates its own, so no two processes ever share a connection.
+
 Then, while handling a Flask request you can get a database connection
 specific to that request by calling:
 ```
@@ -36,24 +42,79 @@ automatically closed at the end of your query:
 >>>     # Your query here...
 ```
 
+If you need to run several statements back to back (e.g. an UPDATE followed
+by a SELECT of the updated row), `run_batch()` sends them to the server in a
+single round trip:
+```
+>>> _, rows = db.run_batch(('UPDATE users SET ... WHERE user_id = %s', (1,)),
+>>>                        ('SELECT ... FROM users WHERE user_id = %s', (1,)))
+```
+
+Most statements are not written inline: they are registered once in
+`app/db/queries.py` and run through prepared cursors obtained from
+`prepared_cursor()`, which are cached per connection so the server only parses
+each statement once per connection.
+
+If `init_db` is called with `instrument=True`, the cursors returned by
+`get_cursor()` also record how long each statement takes and how many round
+trips each request makes (see `app/db/instrumentation.py`).
+
 Note that you don't have to close the database connection returned by
 `get_db()` as it will be closed automatically at the end of the Flask request.
 However, you should ensure that you close all cursors: this includes any
 created by the `get_cursor()` function, and any you create manually using the
 database connection.
 
+If `init_db` is called with `release_early=True`, a connection that was only
+used through `get_cursor()` goes back to the pool as soon as the last of those
+cursors is closed, rather than being held until the end of the request (e.g.
+while a template is rendered). Calling `get_db()` yourself pins the connection
+to the request as before, so transactions spanning several cursors still see
+the same connection.
+
 References:
 -----------
     [1] https://flask.palletsprojects.com/en/stable/tutorial/database/
 """
+import os
+import threading
+from contextlib import contextmanager
 from flask import Flask, g
-from mysql.connector.pooling import MySQLConnectionPool
+from mysql.connector.constants import ClientFlag
+from mysql.connector.errors import PoolError
+from app.config import constants
+from app.db import instrumentation
+from app.db.pool import ManagedConnectionPool
 
-# Pool of reusable database connections (created when calling `init_db`).
-connection_pool: MySQLConnectionPool
+# Pool of reusable database connections (created by `get_pool()` on first
+# use in each process), and the arguments it is created with (set by
+# `init_db`).
+connection_pool: ManagedConnectionPool = None
+_pool_args = None
+_pool_lock = threading.Lock()
+
+# Pools inherited from a parent process. They are kept rather than closed: a
+# closed connection tells the server it is done, and the parent is still using
+# the same sockets.
+_inherited_pools = []
+
+# Whether cursors returned by `get_cursor()` record their statements.
+instrument_queries = False
+
+# Whether connections are released as soon as their last cursor is closed.
+release_connections_early = False
+
+# Prepared cursors, keyed by MySQL connection ID and then by query name (see
+# `prepared_cursor()`), guarded by `_prepared_lock`.
+_prepared_cursors = {}
+_prepared_lock = threading.Lock()
 
 def init_db(app: Flask, user: str, password: str, host: str, database: str,
-            pool_name: str = "flask_db_pool", autocommit: bool = True):
+            pool_name: str = "flask_db_pool", autocommit: bool = True,
+            pool_size: int = 10, acquire_timeout: float = 5.0,
+            max_lifetime: float = 1800.0,
+            release_early: bool = False, instrument: bool = False,
+            round_trip_budget: int = 8):
     """Sets up a MySQL connection pool for the specified Flask app.
 
     This must be called once while initialising your Flask web app, before any
@@ -67,29 +128,103 @@ def init_db(app: Flask, user: str, password: str, host: str, database: str,
         database: Name of the database to connect to on the MySQL server.
         pool_name: Name of the pool to create (default `flask_db_pool`).
         autocommit: Whether or not to enable auto-commit (default `True`) .
+        pool_size: Number of connections in the pool (default 10, max 32).
+        acquire_timeout: Seconds to wait for a free connection before the
+            request fails with a 503 (default 5).
+        max_lifetime: Seconds after which a connection is reconnected on
+            checkout, or 0 to never replace it (default 1800).
+        release_early: Whether to return a connection to the pool as soon as
+            the last cursor from `get_cursor()` is closed, unless `get_db()`
+            pinned it to the request (default `False`).
+        instrument: Whether to record timing and round trips for every
+            statement run through `get_cursor()` (default `False`).
+        round_trip_budget: Statements a request may run before it is flagged
+            by the instrumentation (default 8).
     """
-    # Create a pool of reusable database connections.
-    global connection_pool
-    connection_pool = MySQLConnectionPool(
+    # Set up a pool of reusable database connections, created on first use.
+    global connection_pool, _pool_args
+    connection_pool = None
+    _pool_args = dict(
+        pool_size=pool_size,
+        acquire_timeout=acquire_timeout,
+        max_lifetime=max_lifetime,
+        on_replace=_forget_prepared_cursors,
         user=user,
         password=password,
         host=host,
         database=database,
         pool_name=pool_name,
-        autocommit=autocommit)
+        autocommit=autocommit,
+        # Resetting the session when a connection goes back to the pool would
+        # deallocate the statements cached by `prepared_cursor()`. The app
+        # keeps no other session state (every statement auto-commits), so
+        # there's nothing else a reset would clear.
+        pool_reset_session=False,
+        # Report the rows an UPDATE matched rather than the rows it changed,
+        # so that a rowcount of 0 always means "no such row".
+        client_flags=[ClientFlag.FOUND_ROWS])
 
     # Register `close_db()` to run every time the application context is torn
     # down at the end of a Flask request, ensuring that any database connection
     # using during that request gets released back into the pool.
     app.teardown_appcontext(close_db)
 
+    # Requests that can't get a connection within `acquire_timeout` fail fast
+    # with "503 Service Unavailable" rather than a generic server error.
+    app.register_error_handler(PoolError, _pool_exhausted)
+
+    global release_connections_early
+    release_connections_early = release_early
+
+    global instrument_queries
+    instrument_queries = instrument
+    if instrument:
+        instrumentation.init_instrumentation(app, round_trip_budget)
+
+def get_pool() -> ManagedConnectionPool:
+    """Returns this process's connection pool, creating it the first time it
+    is needed.
+
+    Returns:
+        The `ManagedConnectionPool`.
+    """
+    global connection_pool
+    if connection_pool is None:
+        with _pool_lock:
+            if connection_pool is None:
+                connection_pool = ManagedConnectionPool(**_pool_args)
+    return connection_pool
+
+def pool_stats():
+    """Returns the connection pool counters (see `ManagedConnectionPool.stats()`),
+    or `{"created": false}` if this process hasn't needed a connection yet."""
+    if connection_pool is None:
+        return {'created': False}
+    return connection_pool.stats()
+
+def _forget_pool():
+    """Runs in a newly forked child process: drops the parent's pool and
+    prepared cursors, so the child creates its own on first use."""
+    global connection_pool, _pool_lock, _prepared_cursors, _prepared_lock
+    if connection_pool is not None:
+        _inherited_pools.append(connection_pool)
+    connection_pool = None
+    # Another thread of the parent may have held these locks when it forked.
+    _pool_lock = threading.Lock()
+    _prepared_cursors = {}
+    _prepared_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pool)
+
 def get_db():
     """Gets a MySQL database connection to use while serving the current Flask
     request.
 
     The first time you call this during a request, a new connection will be
-    allocated from the pool. After that, any additional calls to `get_db()`
-    during the same request are guaranteed to return the same connection.
+    allocated from the pool, waiting for one to be released if necessary.
+    After that, any additional calls to `get_db()` during the same request are
+    guaranteed to return the same connection.
     
     If you only need a MySQL cursor, and not a reference to the database, you
     can just call the `get_cursor()` function. There's no need to call
@@ -103,9 +238,18 @@ def get_db():
     Returns:
         A `PooledMySQLConnection` instance.
     """
+    # The caller may hold on to the connection (e.g. to run a transaction), so
+    # it must not be released early.
+    g.db_pinned = True
+    return _request_connection()
+
+def _request_connection():
+    """Returns the current request's connection, checking one out of the pool
+    if the request doesn't have one yet."""
     if 'db' not in g:
-        g.db = connection_pool.get_connection()
-    
+        g.db = get_pool().get_connection()
+        g.db_open_cursors = 0
+
     return g.db
 
 def get_cursor():
@@ -113,15 +257,23 @@ def get_cursor():
     Flask request.
     
     All cursors created by this function during a single Flask request will
-    belong to the same connection. You can get a reference to that connection
-    at any time during the request by calling `get_db()`.
+    belong to the same connection, unless `release_early` is enabled and every
+    earlier cursor has already been closed. You can get a reference to that
+    connection at any time during the request by calling `get_db()`.
     
     Ensure that you close all cursors before the end of the Flask request.
     
     Returns:
-        A new `MySQLCursor` instance.
+        A new `MySQLCursor` instance (wrapped in an `InstrumentedCursor` if
+        instrumentation is enabled).
     """
-    return get_db().cursor(dictionary=True)
+    cursor = _request_connection().cursor(dictionary=True)
+    if release_connections_early:
+        g.db_open_cursors += 1
+        cursor = ReleasingCursor(cursor, g.db)
+    if instrument_queries:
+        return instrumentation.InstrumentedCursor(cursor)
+    return cursor
 
 def close_db(exception = None):
     """Closes the MySQL database connection associated with the current Flask
@@ -138,6 +290,130 @@ def close_db(exception = None):
     # Get the database connection from the current application context (the one
     # that's being torn down), or `None` if there is no connection.
     db = g.pop('db', None)
+    g.pop('db_pinned', None)
+    g.pop('db_open_cursors', None)
     
     if db is not None:
-        db.close()
\ No newline at end of file
+        connection_pool.release(db)
+
+@contextmanager
+def prepared_cursor(key: str):
+    """Gets the prepared dictionary cursor cached under `key` for the current
+    request's connection, creating it the first time the key is used on that
+    connection.
+
+    A prepared cursor keeps its statement prepared on the server between
+    executions, and because the cursor is cached against the connection it is
+    reused by every later request that checks out the same connection. Use a
+    different key for each distinct SQL statement (`app/db/queries.py` uses
+    the query name), and fetch every row of a result before the block ends.
+
+    Usage:
+    ```
+    >>> with db.prepared_cursor('user_by_id') as cursor:
+    >>>     cursor.execute('SELECT ... FROM users WHERE user_id = %s', (1,))
+    >>>     rows = cursor.fetchall()
+    ```
+
+    Args:
+        key: Name identifying the statement the cursor will run.
+
+    Yields:
+        A `MySQLCursorPreparedDict` (wrapped in an `InstrumentedCursor` if
+        instrumentation is enabled). Don't close it: it belongs to the cache.
+    """
+    connection = _request_connection()
+    with _prepared_lock:
+        cursors = _prepared_cursors.setdefault(connection.connection_id, {})
+        cursor = cursors.get(key)
+        if cursor is None:
+            cursor = cursors[key] = connection.cursor(prepared=True, dictionary=True)
+
+    if release_connections_early:
+        g.db_open_cursors += 1
+    try:
+        if instrument_queries:
+            yield instrumentation.InstrumentedCursor(cursor, name=key)
+        else:
+            yield cursor
+    finally:
+        if release_connections_early and g.get('db') is connection:
+            g.db_open_cursors -= 1
+            if g.db_open_cursors == 0 and not g.get('db_pinned'):
+                close_db()
+
+def _forget_prepared_cursors(connection_id):
+    """Drops the prepared cursors cached for a connection that is being
+    replaced (its prepared statements die with it)."""
+    with _prepared_lock:
+        _prepared_cursors.pop(connection_id, None)
+
+def run_batch(*statements):
+    """Runs several SQL statements in a single round trip to the server.
+
+    The statements are sent together as one multi-statement query and run in
+    order, so a write followed by a read of the same row sees the write.
+
+    Args:
+        *statements: `(sql, params)` tuples, where `params` is a tuple of
+            values for the `%s` placeholders in `sql` (or `None`).
+
+    Returns:
+        A list with one entry per statement: the list of rows for statements
+        that return rows, or the number of affected rows for the others.
+    """
+    sql = '; '.join(statement.strip().rstrip(';') for statement, _ in statements)
+    params = tuple(value for _, values in statements for value in (values or ()))
+
+    results = []
+    with get_cursor() as cursor:
+        cursor.execute(sql, params, map_results=True)
+        while True:
+            results.append(cursor.fetchall() if cursor.with_rows else cursor.rowcount)
+            if not cursor.nextset():
+                break
+    return results
+
+class ReleasingCursor:
+    """Wraps a cursor returned by `get_cursor()` so that closing the last open
+    cursor of the request releases its connection back to the pool (see
+    `release_early`).
+
+    Any attribute not defined here is looked up on the wrapped cursor.
+    """
+
+    def __init__(self, cursor, connection):
+        self._cursor = cursor
+        self._connection = connection
+        self._closed = False
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._cursor.close()
+        finally:
+            # Only count this cursor against the connection it came from, in
+            # case that connection has already been released.
+            if g.get('db') is self._connection:
+                g.db_open_cursors -= 1
+                if g.db_open_cursors == 0 and not g.get('db_pinned'):
+                    close_db()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def _pool_exhausted(error: PoolError):
+    """Error handler for requests that timed out waiting for a connection."""
+    return ('The server is busy right now. Please try again in a moment.',
+            constants.HTTP_STATUS_CODE_503, {'Retry-After': '1'})
\ No newline at end of file
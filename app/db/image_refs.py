@@ -0,0 +1,102 @@
+"""Reference counts of the uploaded images, and garbage collection of the
+images nothing refers to any more.
+
+Images are content-addressed (see app/utils/images.py), so several users and
+events can share one image, and deleting an event mustn't delete a picture
+someone else is still using. Instead, the `image_blobs` table counts the
+references to each image, and the routes that store or replace an image name
+update the counts:
+```
+>>> name = images.save_upload(file)
+>>> image_refs.retain(name)            # before storing the new name
+>>> queries.execute(queries.UPDATE_USER_PROFILE_IMAGE, (name, user_id))
+>>> image_refs.release(old_name)       # after the old name is gone
+```
+
+Retaining before storing and releasing after means a count is never lower
+than the number of real references. `collect_garbage()` (run with
+`flask images gc`, see app/cli.py) recounts the references from the `users`
+and `events` tables, then deletes the images that have had none for longer
+than a grace period; the grace period also protects uploads whose reference
+hasn't been stored yet. An upload of an image that is being deleted at that
+very moment can lose its files; uploading it again restores them.
+
+If the workers can't process an upload (see app/utils/images.py), `forget()`
+removes every reference to it, so the users and events that stored its name
+show no image rather than a placeholder that never goes away.
+"""
+import os
+import threading
+import time
+from app.db import db, journey_feed, queries, user_cache
+from app.utils import images
+
+_counters = dict(retained=0, released=0, forgotten=0)
+_counters_lock = threading.Lock()
+
+def retain(name):
+    """Counts a new reference to an image. Does nothing if `name` is empty."""
+    if not name:
+        return
+    queries.execute(queries.RETAIN_IMAGE, (name,))
+    with _counters_lock:
+        _counters['retained'] += 1
+
+def release(name):
+    """Removes a reference to an image. Does nothing if `name` is empty."""
+    if not name:
+        return
+    queries.execute(queries.RELEASE_IMAGE, (name,))
+    with _counters_lock:
+        _counters['released'] += 1
+
+def forget(name):
+    """Removes every reference to an image whose upload couldn't be
+    processed, and its reference count. Needs an app context."""
+    users, journeys, *_ = db.run_batch(
+        (queries.IMAGE_USERS.sql, (name,)),
+        (queries.IMAGE_JOURNEYS.sql, (name,)),
+        (queries.CLEAR_PROFILE_IMAGE.sql, (name,)),
+        (queries.CLEAR_EVENT_IMAGE.sql, (name,)),
+        (queries.DELETE_IMAGE.sql, (name,)))
+    for row in users:
+        user_cache.invalidate_user(row['user_id'])
+    for row in journeys:
+        journey_feed.refresh(row['journey_id'])
+    with _counters_lock:
+        _counters['forgotten'] += 1
+
+def collect_garbage(grace: float):
+    """Deletes the images that nothing has referred to for `grace` seconds,
+    and any content-addressed image files with no `image_blobs` row that are
+    older than that (uploads whose reference was never stored). Needs an app
+    context.
+
+    Returns:
+        A `(images, files)` tuple: the number of unreferenced images deleted,
+        and the number of orphaned files deleted.
+    """
+    queries.execute(queries.RECOUNT_IMAGE_REFS)
+    deleted = 0
+    for row in queries.fetch_all(queries.UNREFERENCED_IMAGES, (int(grace),)):
+        # Only delete the files if the row is still unreferenced.
+        if queries.execute(queries.DELETE_UNREFERENCED_IMAGE, (row['name'],)):
+            images.delete(row['name'])
+            deleted += 1
+
+    known = {os.path.splitext(row['name'])[0] for row in queries.fetch_all(queries.ALL_IMAGE_NAMES)}
+    orphans = 0
+    cutoff = time.time() - grace
+    for digest, path, mtime in images.stored_files():
+        if digest not in known and mtime < cutoff:
+            try:
+                os.remove(path)
+                orphans += 1
+            except FileNotFoundError:
+                pass
+    return deleted, orphans
+
+def stats():
+    """Returns the reference counters of this process."""
+    with _counters_lock:
+        return dict(_counters)
@@ -0,0 +1,257 @@
+"""Opt-in SQL instrumentation for the cursors handed out by `db.get_cursor()`.
+
+When enabled (see `init_instrumentation`), every cursor is wrapped in an
+`InstrumentedCursor` which records, for each statement run during a Flask
+request:
+    - the statement text and its "shape" (the statement with literals and
+      whitespace normalised, so `WHERE user_id = 1` and `WHERE user_id = 2`
+      count as the same statement);
+    - how many parameters were passed;
+    - how long it took, including fetching its rows;
+    - how many rows it returned (or affected, for writes);
+    - the endpoint that ran it.
+
+At the end of every request a single structured (JSON) log line summarises
+the statements it ran. Requests that run more statements than the
+`DB_ROUND_TRIP_BUDGET` setting, or that run the same statement shape more than
+once (a likely N+1 query), are flagged in that line.
+
+Statements run through `app/db/queries.py` are grouped under their registered
+query name; any other statement is grouped under its shape.
+
+Totals across all requests are kept in memory and can be read with
+`snapshot()`, which is exposed to admins at `/admin/db_stats`.
+"""
+import json
+import re
+import threading
+import time
+from flask import Flask, current_app, g, has_request_context, request
+
+# Longest statement text kept in the per-request log.
+MAX_STATEMENT_LENGTH = 500
+
+# Most expensive statement shapes listed by `snapshot()`.
+SNAPSHOT_TOP_STATEMENTS = 50
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+
+# Round-trip budget, set by `init_instrumentation`.
+_round_trip_budget = 0
+
+# Totals across every instrumented request, guarded by `_stats_lock`.
+_stats_lock = threading.Lock()
+_stats = {}
+
+def init_instrumentation(app: Flask, round_trip_budget: int):
+    """Registers the end-of-request hook that logs and aggregates the
+    statements recorded during each request.
+
+    Args:
+        app: The `Flask` application to instrument.
+        round_trip_budget: Statements a request may run before it's flagged.
+    """
+    global _round_trip_budget
+    _round_trip_budget = round_trip_budget
+    reset()
+    app.teardown_request(_finish_request)
+
+def statement_shape(statement):
+    """Normalises a SQL statement so that statements differing only in their
+    literal values or whitespace compare equal.
+
+    Args:
+        statement: SQL text (`str` or `bytes`).
+
+    Returns:
+        The normalised statement as a string.
+    """
+    if isinstance(statement, (bytes, bytearray)):
+        statement = statement.decode('utf-8', 'replace')
+    shape = _STRING_LITERAL.sub('?', statement)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    return _WHITESPACE.sub(' ', shape).strip().rstrip(';')
+
+class InstrumentedCursor:
+    """Wraps a MySQL cursor, recording every statement it runs.
+
+    Apart from recording, the wrapper behaves exactly like the cursor it
+    wraps: any attribute not defined here is looked up on that cursor.
+
+    Args:
+        cursor: The cursor to wrap.
+        name: Name of the registered query the cursor runs (see
+            `app/db/queries.py`), used instead of the statement shape to
+            group its statistics.
+    """
+
+    def __init__(self, cursor, name=None):
+        self._cursor = cursor
+        self._name = name
+        self._record = None
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, params, *args, **kwargs)
+        finally:
+            self._start_record(operation, params, time.perf_counter() - start)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, seq_params, *args, **kwargs)
+        finally:
+            first_params = seq_params[0] if seq_params else None
+            self._start_record(operation, first_params, time.perf_counter() - start)
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        self._add_rows(0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self._timed(self._cursor.fetchmany, size)
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._add_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        return self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _start_record(self, operation, params, elapsed):
+        """Appends a record for the statement just executed to the current
+        request's log."""
+        if not has_request_context():
+            self._record = None
+            return
+        returns_rows = getattr(self._cursor, 'with_rows', False)
+        self._record = {
+            'query': self._name,
+            'statement': _statement_text(operation)[:MAX_STATEMENT_LENGTH],
+            'shape': statement_shape(operation),
+            'params': len(params) if params else 0,
+            'ms': elapsed * 1000,
+            'rows': 0 if returns_rows else max(self._cursor.rowcount, 0),
+        }
+        g.setdefault('sql_log', []).append(self._record)
+
+    def _timed(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._record is not None:
+                self._record['ms'] += (time.perf_counter() - start) * 1000
+
+    def _add_rows(self, count):
+        if self._record is not None:
+            self._record['rows'] += count
+
+def _statement_text(operation):
+    if isinstance(operation, (bytes, bytearray)):
+        return operation.decode('utf-8', 'replace')
+    return str(operation)
+
+def _finish_request(exception=None):
+    """Logs a summary of the statements run during the request that is ending
+    and folds them into the running totals."""
+    sql_log = g.pop('sql_log', None)
+    if not sql_log:
+        return
+
+    endpoint = request.endpoint or request.path
+    shape_counts = {}
+    for record in sql_log:
+        shape_counts[record['shape']] = shape_counts.get(record['shape'], 0) + 1
+    repeated = {shape: count for shape, count in shape_counts.items() if count > 1}
+    over_budget = len(sql_log) > _round_trip_budget
+    total_ms = sum(record['ms'] for record in sql_log)
+
+    summary = {
+        'event': 'sql_request',
+        'endpoint': endpoint,
+        'method': request.method,
+        'statements': len(sql_log),
+        'sql_ms': round(total_ms, 3),
+        'over_budget': over_budget,
+        'repeated_shapes': repeated,
+        'queries': [dict(record, ms=round(record['ms'], 3)) for record in sql_log],
+    }
+    if over_budget or repeated:
+        current_app.logger.warning(json.dumps(summary, default=str))
+    else:
+        current_app.logger.info(json.dumps(summary, default=str))
+
+    _aggregate(endpoint, sql_log, total_ms, over_budget, bool(repeated))
+
+def _aggregate(endpoint, sql_log, total_ms, over_budget, repeated):
+    with _stats_lock:
+        endpoint_stats = _stats['endpoints'].setdefault(endpoint, {
+            'requests': 0, 'statements': 0, 'sql_ms': 0.0,
+            'max_statements': 0, 'over_budget': 0, 'repeated_shapes': 0,
+        })
+        endpoint_stats['requests'] += 1
+        endpoint_stats['statements'] += len(sql_log)
+        endpoint_stats['sql_ms'] += total_ms
+        endpoint_stats['max_statements'] = max(endpoint_stats['max_statements'], len(sql_log))
+        endpoint_stats['over_budget'] += int(over_budget)
+        endpoint_stats['repeated_shapes'] += int(repeated)
+
+        for record in sql_log:
+            statement_stats = _stats['statements'].setdefault(record['query'] or record['shape'], {
+                'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'endpoints': set(),
+            })
+            statement_stats['count'] += 1
+            statement_stats['total_ms'] += record['ms']
+            statement_stats['max_ms'] = max(statement_stats['max_ms'], record['ms'])
+            statement_stats['rows'] += record['rows']
+            statement_stats['endpoints'].add(endpoint)
+
+        _stats['requests'] += 1
+        _stats['flagged_requests'] += int(over_budget or repeated)
+
+def snapshot():
+    """Returns a JSON-serialisable copy of the totals recorded so far.
+
+    Statement shapes are listed most expensive (by total time) first.
+    """
+    with _stats_lock:
+        statements = sorted(_stats['statements'].items(),
+                            key=lambda item: item[1]['total_ms'], reverse=True)
+        return {
+            'enabled': True,
+            'round_trip_budget': _round_trip_budget,
+            'requests': _stats['requests'],
+            'flagged_requests': _stats['flagged_requests'],
+            'endpoints': {endpoint: dict(stats) for endpoint, stats in _stats['endpoints'].items()},
+            'statements': [
+                dict(stats, key=key, endpoints=sorted(stats['endpoints']),
+                     avg_ms=stats['total_ms'] / stats['count'])
+                for key, stats in statements[:SNAPSHOT_TOP_STATEMENTS]
+            ],
+        }
+
+def reset():
+    """Clears all recorded totals."""
+    with _stats_lock:
+        _stats.clear()
+        _stats.update(requests=0, flagged_requests=0, endpoints={}, statements={})
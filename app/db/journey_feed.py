@@ -0,0 +1,81 @@
+"""The public journey feed: every public, unhidden journey, most recently
+updated first.
+
+The feed is the busiest page of the site, so it isn't worked out from
+`journeys` and `events` on every view. The `journey_feed` table holds one
+row per listed journey with everything a feed card shows (title, summary,
+owner, event count and cover image), and a page of the feed is a single read
+of its `(update_date, journey_id)` index (see `queries.FEED_PAGE`).
+
+The table is kept up to date one journey at a time: anything that changes a
+journey or its events calls `refresh()` afterwards, which recomputes that
+journey's row, or removes it if the journey is no longer listed:
+```
+>>> queries.insert(queries.INSERT_EVENT, (journey_id, ...))
+>>> journey_feed.refresh(journey_id)
+```
+Changes made outside the app (e.g. by hand in the database) are picked up by
+`rebuild()` (`flask feed rebuild`, see app/cli.py).
+"""
+import threading
+from datetime import datetime
+from app.db import db, queries
+from app.utils import pagination
+
+# Types of the `(update_date, journey_id)` sort key of feed cursors (see
+# `pagination.decode_cursor()`).
+CURSOR_TYPES = (datetime, int)
+
+_counters = dict(refreshes=0, rebuilds=0, pages=0)
+_counters_lock = threading.Lock()
+
+def refresh(journey_id: int):
+    """Brings one journey's feed row up to date. Needs an app context."""
+    db.run_batch((queries.REFRESH_FEED_ENTRY.sql, (journey_id,)),
+                 (queries.DELETE_UNLISTED_FEED_ENTRY.sql, (journey_id, journey_id)))
+    with _counters_lock:
+        _counters['refreshes'] += 1
+
+def rebuild():
+    """Brings every feed row up to date. Needs an app context.
+
+    Returns:
+        A `(refreshed, removed)` tuple: the rows affected by recomputing the
+        listed journeys (MySQL counts a changed row twice), and the number of
+        rows removed.
+    """
+    refreshed, removed = db.run_batch((queries.REBUILD_FEED.sql, None),
+                                      (queries.DELETE_UNLISTED_FEED.sql, None))
+    with _counters_lock:
+        _counters['rebuilds'] += 1
+    return refreshed, removed
+
+def fetch_page(per_page: int, after=None):
+    """Fetches one page of the feed.
+
+    Args:
+        per_page: Journeys per page.
+        after: Optional `(update_date, journey_id)` cursor of the journey
+            before the page.
+
+    Returns:
+        A `(journeys, next_cursor)` tuple: the feed rows, and the cursor token
+        of the next page, or `None` if this is the last page.
+    """
+    if after is None:
+        journeys = queries.fetch_all(queries.FEED_PAGE['first'], (per_page + 1,))
+    else:
+        journeys = queries.fetch_all(queries.FEED_PAGE['after'], (after[0], after[0], after[1], per_page + 1))
+    with _counters_lock:
+        _counters['pages'] += 1
+    next_cursor = None
+    if len(journeys) > per_page:
+        journeys = journeys[:per_page]
+        last = journeys[-1]
+        next_cursor = pagination.encode_cursor((last['update_date'].isoformat(sep=' '), last['journey_id']))
+    return journeys, next_cursor
+
+def stats():
+    """Returns the feed counters of this process."""
+    with _counters_lock:
+        return dict(_counters)
@@ -0,0 +1,175 @@
+"""Versioned schema migrations, and a check of the registered queries' plans.
+
+Changes to the schema after `create_database.sql` live in numbered SQL files
+in `app/db/migrations/`, e.g. `0001_index_pack.sql`. `migrate()` applies the
+ones the database hasn't had yet, in order, and records each in the
+`schema_migrations` table, so the schema can change without dropping any
+tables:
+```
+$ flask --app app db migrate
+$ flask --app app db status
+```
+
+Never edit a migration once it has been applied anywhere: add a new one
+instead. (`migrate()` refuses to run if an applied migration's file has
+changed.)
+
+`check_query_plans()` EXPLAINs every registered query (see `queries.py`), and
+the statements the admin user filter compiles (see app/search/planner.py),
+and reports any that would scan a whole table:
+```
+$ flask --app app db check-plans
+```
+"""
+import hashlib
+import os
+import re
+from collections import namedtuple
+from app.db import db, queries
+from app.search import planner
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+# Named lock held while migrating, so that two processes can't apply the same
+# migration at once.
+_LOCK_NAME = 'journey_schema_migrations'
+
+Migration = namedtuple('Migration', ['version', 'name', 'sql', 'checksum'])
+
+_CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        checksum CHAR(64) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )'''
+
+def available():
+    """Returns every migration in `MIGRATIONS_DIR`, oldest first."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.fullmatch(r'(\d+)_(\w+)\.sql', filename)
+        if match is None:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename), encoding='utf-8') as file:
+            sql = file.read()
+        migrations.append(Migration(int(match.group(1)), match.group(2), sql,
+                                    hashlib.sha256(sql.encode('utf-8')).hexdigest()))
+    return migrations
+
+def split_statements(sql: str):
+    """Splits a migration into statements, dropping `--` comment lines.
+    Statements end with a `;` at the end of a line."""
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    statements = re.split(r';\s*$', '\n'.join(lines), flags=re.MULTILINE)
+    return [statement.strip() for statement in statements if statement.strip()]
+
+def status():
+    """Returns `(migration, applied)` for every migration. Needs an app
+    context."""
+    with db.get_cursor() as cursor:
+        cursor.execute(_CREATE_TABLE)
+        cursor.execute('SELECT version FROM schema_migrations')
+        applied = {row['version'] for row in cursor.fetchall()}
+    return [(migration, migration.version in applied) for migration in available()]
+
+def migrate(log=print):
+    """Applies every pending migration, in order. Needs an app context.
+
+    MySQL commits DDL statements straight away, so a migration can't be rolled
+    back if one of its statements fails; it isn't recorded as applied, and
+    needs fixing by hand before running `migrate()` again.
+
+    Args:
+        log: Function called with a line of progress text.
+
+    Raises:
+        RuntimeError: An applied migration's file has changed since, or
+            another process is migrating.
+
+    Returns:
+        The migrations that were applied.
+    """
+    connection = db.get_db()
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute('SELECT GET_LOCK(%s, 10) AS acquired', (_LOCK_NAME,))
+        if not cursor.fetchone()['acquired']:
+            raise RuntimeError('Another process is applying migrations.')
+        try:
+            cursor.execute(_CREATE_TABLE)
+            cursor.execute('SELECT version, checksum FROM schema_migrations')
+            applied = {row['version']: row['checksum'] for row in cursor.fetchall()}
+
+            done = []
+            for migration in available():
+                if migration.version in applied:
+                    if applied[migration.version] != migration.checksum:
+                        raise RuntimeError(f'Migration {migration.version:04d}_{migration.name} '
+                                           'has changed since it was applied.')
+                    continue
+                log(f'Applying {migration.version:04d}_{migration.name}...')
+                for statement in split_statements(migration.sql):
+                    cursor.execute(statement)
+                cursor.execute('INSERT INTO schema_migrations (version, name, checksum) '
+                               'VALUES (%s, %s, %s)',
+                               (migration.version, migration.name, migration.checksum))
+                connection.commit()
+                done.append(migration)
+            return done
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (_LOCK_NAME,))
+            cursor.fetchall()
+    finally:
+        cursor.close()
+
+def check_query_plans():
+    """EXPLAINs every registered query that reads or changes rows, and the
+    statements `app/search/planner.py` compiles for a sample of user filters
+    (see `_SAMPLE_FILTERS`), and finds the ones that would scan a whole table.
+    Needs an app context.
+
+    Placeholders are filled in with sample values: `LIMIT %s` with 10, and
+    every other `%s` with '1' (which MySQL compares against numeric and string
+    columns alike without giving up on their indexes). Every table access of
+    type `ALL` counts, whether or not MySQL had an index it could have used,
+    so run the check against a database whose tables hold realistic numbers
+    of rows: on a near-empty table MySQL may prefer a scan to an index.
+    Queries registered with `full_scan_ok=True` are skipped.
+
+    Returns:
+        A list of `(query name, table)` pairs, one for each full scan found.
+    """
+    statements = [(query.name, query.sql) for query in queries.registry.values()
+                  if not query.full_scan_ok]
+    for name, (search, all_users, after) in _SAMPLE_FILTERS.items():
+        compiled = planner.compile_filter(search, all_users, per_page=10, after=after)
+        statements += [(f'filter {name} ({part})', sql)
+                       for part, (sql, _) in zip(('page', 'role counts', 'status counts'), compiled)]
+
+    problems = []
+    with db.get_cursor() as cursor:
+        for name, sql in statements:
+            if not re.match(r'(SELECT|UPDATE|DELETE)\b', sql, re.IGNORECASE):
+                continue
+            sql = re.sub(r'LIMIT %s', 'LIMIT 10', sql)
+            sql = sql.replace('%s', "'1'")
+            cursor.execute(f'EXPLAIN {sql}')
+            for row in cursor.fetchall():
+                if row.get('type') == 'ALL':
+                    problems.append((name, row.get('table')))
+    return problems
+
+# User filters whose compiled statements `check_query_plans()` checks, keyed by
+# name, as `(filter, all_users, after)`: each field prefix on its own (on every
+# user, and on editors and admins after a cursor), a prefix with both facets,
+# and both facets on their own.
+_SAMPLE_FILTERS = {
+    **{f'{field} prefix': (planner.UserFilter(fields={field: 'a'}), True, None)
+       for field in planner.FIELDS},
+    **{f'{field} prefix, system users, next page': (planner.UserFilter(fields={field: 'a'}), False, ('a', 1))
+       for field in planner.FIELDS},
+    'last_name prefix, role and status': (
+        planner.UserFilter(fields={'last_name': 'a'}, role='editor', status='active'), True, None),
+    'role and status, system users': (planner.UserFilter(role='editor', status='banned'), False, None),
+}
@@ -0,0 +1,21 @@
+-- Indexes for the query shapes the routes run (see app/db/queries.py).
+
+-- Admin user lists and filters (app/search/planner.py): prefix filters on
+-- names, role/status facets, and editors/admins in username order.
+ALTER TABLE users
+    ADD INDEX idx_users_last_name (last_name, first_name),
+    ADD INDEX idx_users_first_name (first_name),
+    ADD INDEX idx_users_role_status (role, status, username),
+    ADD INDEX idx_users_role_username (role, username);
+
+-- A journey's events in start_time order.
+ALTER TABLE events
+    ADD INDEX idx_events_journey_start (journey_id, start_time);
+
+-- Public, visible journeys, most recently updated first.
+ALTER TABLE journeys
+    ADD INDEX idx_journeys_status_hidden (status, is_hidden, update_date);
+
+-- Active announcements, newest first.
+ALTER TABLE announcements
+    ADD INDEX idx_announcements_status_created (status, created_time);
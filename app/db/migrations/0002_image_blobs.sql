@@ -0,0 +1,17 @@
+-- Reference counts of the uploaded images (see app/db/image_refs.py), keyed
+-- by the name stored in users.profile_image and events.event_image.
+CREATE TABLE image_blobs (
+    name VARCHAR(255) PRIMARY KEY,
+    ref_count INT NOT NULL DEFAULT 0,  -- Users and events referring to the image
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_image_blobs_unreferenced (ref_count, updated_at)  -- Garbage collection
+);
+
+-- Count the references to the images uploaded so far.
+INSERT INTO image_blobs (name, ref_count)
+SELECT name, COUNT(*) FROM (
+    SELECT profile_image AS name FROM users WHERE profile_image IS NOT NULL
+    UNION ALL
+    SELECT event_image FROM events WHERE event_image IS NOT NULL
+) AS refs
+GROUP BY name;
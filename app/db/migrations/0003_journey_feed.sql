@@ -0,0 +1,26 @@
+-- The public journey feed (see app/db/journey_feed.py): one row per public,
+-- unhidden journey, with what a feed card shows, so a page of the feed is a
+-- single read of idx_journey_feed_recent.
+CREATE TABLE journey_feed (
+    journey_id INT PRIMARY KEY,
+    user_id INT NOT NULL,
+    title VARCHAR(100) NOT NULL,
+    summary VARCHAR(280) NOT NULL,  -- The start of the journey's description
+    truncated TINYINT NOT NULL DEFAULT 0,  -- Whether the description is longer than the summary
+    update_date TIMESTAMP NOT NULL,  -- Copied from journeys.update_date
+    event_count INT NOT NULL DEFAULT 0,
+    cover_image VARCHAR(255),  -- The image of the journey's first event that has one
+    INDEX idx_journey_feed_recent (update_date, journey_id),  -- Feed pages, newest first
+    FOREIGN KEY (journey_id) REFERENCES journeys(journey_id) ON DELETE CASCADE
+);
+
+-- List the journeys that are already public.
+INSERT INTO journey_feed (journey_id, user_id, title, summary, truncated, update_date, event_count, cover_image)
+SELECT j.journey_id, j.user_id, j.title, LEFT(j.description, 280), CHAR_LENGTH(j.description) > 280,
+       j.update_date,
+       (SELECT COUNT(*) FROM events e WHERE e.journey_id = j.journey_id),
+       (SELECT e.event_image FROM events e
+        WHERE e.journey_id = j.journey_id AND e.event_image IS NOT NULL
+        ORDER BY e.start_time, e.event_id LIMIT 1)
+FROM journeys j
+WHERE j.status = 'public' AND j.is_hidden = 0;
@@ -0,0 +1,9 @@
+-- Version counters of content that app processes cache in memory (see
+-- app/db/announcements.py). Bumped whenever the content changes, so a cache
+-- can check it is current with a primary key lookup.
+CREATE TABLE content_versions (
+    name VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO content_versions (name, version) VALUES ('announcements', 0);
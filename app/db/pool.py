@@ -0,0 +1,168 @@
+"""Self-healing MySQL connection pool with blocking checkout and metrics.
+
+`MySQLConnectionPool` on its own raises `PoolError` the moment every
+connection is checked out. It already pings each connection on checkout (via
+`is_connected()`) and reconnects it if the ping fails, e.g. because the
+server closed it after `wait_timeout`. `ManagedConnectionPool` wraps it to
+add:
+    - a blocking checkout: callers wait up to `acquire_timeout` seconds for a
+      connection to be released before `PoolError` is raised;
+    - a maximum connection lifetime: connections older than `max_lifetime`
+      seconds are reconnected on checkout;
+    - notice of replaced connections: `on_replace` is called with the old
+      connection ID whenever a connection is reconnected, by the lifetime
+      limit or by `MySQLConnectionPool` after a failed ping;
+    - counters (see `stats()`) for connections in use, callers waiting, how
+      long callers waited and how many connections were replaced.
+
+Connections must be handed back with `release()` rather than `close()` so that
+the pool can keep track of how many are in use.
+"""
+import bisect
+import threading
+import time
+from mysql.connector import errors
+from mysql.connector.pooling import MySQLConnectionPool
+
+# Upper bounds (in milliseconds) of the checkout wait-time histogram buckets.
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+class ManagedConnectionPool:
+    """A `MySQLConnectionPool` with blocking checkout, connection health
+    checks and usage counters.
+
+    Args:
+        pool_size: Number of connections in the pool (at most 32, the limit
+            imposed by mysql-connector).
+        acquire_timeout: Seconds to wait for a free connection before raising
+            `PoolError`.
+        max_lifetime: Seconds after which a connection is reconnected on its
+            next checkout (0 to keep connections forever).
+        on_replace: Optional callback, called with the old connection ID
+            whenever a connection is replaced (e.g. to forget server-side
+            state such as prepared statements).
+        **connect_args: Passed straight to `MySQLConnectionPool`.
+    """
+
+    def __init__(self, pool_size: int, acquire_timeout: float, max_lifetime: float,
+                 on_replace=None, **connect_args):
+        self._pool = MySQLConnectionPool(pool_size=pool_size, **connect_args)
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self._on_replace = on_replace
+
+        # `_slots` guards every counter below, and is notified whenever a
+        # connection is released.
+        self._slots = threading.Condition()
+        self._in_use = 0
+        self._waiters = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._replaced = {'expired': 0, 'stale': 0}
+        self._wait_histogram = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+        # Creation times, keyed by MySQL connection ID, and the MySQL
+        # connection ID each of the pool's connection objects last had, keyed
+        # by `id()` of the object (to notice the ones reconnected by
+        # `MySQLConnectionPool`).
+        self._created = {}
+        self._connection_ids = {}
+
+    def get_connection(self):
+        """Checks a connection out of the pool, waiting for one to be released
+        if they're all in use.
+
+        Raises:
+            PoolError: No connection became free within `acquire_timeout`.
+
+        Returns:
+            A healthy `PooledMySQLConnection`.
+        """
+        start = time.monotonic()
+        with self._slots:
+            if self._in_use >= self.pool_size:
+                self._waiters += 1
+                try:
+                    acquired = self._slots.wait_for(lambda: self._in_use < self.pool_size,
+                                                    timeout=self.acquire_timeout)
+                finally:
+                    self._waiters -= 1
+                if not acquired:
+                    self._timeouts += 1
+                    raise errors.PoolError(
+                        f'No database connection became free within {self.acquire_timeout}s '
+                        f'({self.pool_size} in use)')
+            self._in_use += 1
+            self._checkouts += 1
+            waited_ms = (time.monotonic() - start) * 1000
+            self._wait_histogram[bisect.bisect_left(WAIT_BUCKETS_MS, waited_ms)] += 1
+
+        try:
+            connection = self._pool.get_connection()
+            self._check_health(connection)
+        except Exception:
+            self._free_slot()
+            raise
+        return connection
+
+    def release(self, connection):
+        """Returns a connection obtained from `get_connection()` to the pool.
+
+        Args:
+            connection: The `PooledMySQLConnection` to release.
+        """
+        try:
+            connection.close()
+        finally:
+            self._free_slot()
+
+    def stats(self):
+        """Returns a snapshot of the pool's counters as a dictionary."""
+        with self._slots:
+            histogram = {f'<={bound}ms': count
+                         for bound, count in zip(WAIT_BUCKETS_MS, self._wait_histogram)}
+            histogram[f'>{WAIT_BUCKETS_MS[-1]}ms'] = self._wait_histogram[-1]
+            return {
+                'pool_size': self.pool_size,
+                'in_use': self._in_use,
+                'waiters': self._waiters,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'replaced': dict(self._replaced),
+                'wait_ms_histogram': histogram,
+            }
+
+    def _free_slot(self):
+        with self._slots:
+            self._in_use -= 1
+            self._slots.notify()
+
+    def _check_health(self, connection):
+        """Reconnects `connection` if it is past its lifetime, and notices if
+        `MySQLConnectionPool` reconnected it after a failed ping."""
+        now = time.monotonic()
+        connection_id = connection.connection_id
+        # `_cnx` is the pool's `MySQLConnection` object, which outlives each
+        # `PooledMySQLConnection` wrapper handed out
+        key = id(connection._cnx)
+        previous_id = self._connection_ids.get(key)
+        self._connection_ids[key] = connection_id
+        if previous_id is not None and previous_id != connection_id:
+            self._forget(previous_id, 'stale')
+        created = self._created.setdefault(connection_id, now)
+
+        if self.max_lifetime and now - created > self.max_lifetime:
+            self._forget(connection_id, 'expired')
+            connection.reconnect(attempts=1)
+            self._created[connection.connection_id] = time.monotonic()
+            self._connection_ids[key] = connection.connection_id
+
+    def _forget(self, old_connection_id, reason):
+        """Drops the state of a server connection that has been (or is about to
+        be) replaced."""
+        self._created.pop(old_connection_id, None)
+        if self._on_replace is not None:
+            self._on_replace(old_connection_id)
+        with self._slots:
+            self._replaced[reason] += 1
@@ -0,0 +1,441 @@
+"""Central registry of the SQL statements run by the app.
+
+Every statement is defined once below as a `Query` with a stable name, and run
+with one of the helper functions at the bottom of this module:
+```
+>>> user = queries.fetch_one(queries.USER_BY_ID, (user_id,))
+>>> users = queries.fetch_all(queries.LIST_ALL_USERS)
+>>> queries.execute(queries.UPDATE_USER_PASSWORD, (password_hash, user_id))
+```
+
+The helpers run each statement through a prepared cursor from
+`db.prepared_cursor()`, keyed by the query name. The cursor (and the statement
+prepared on the server) is cached per connection, so a statement is parsed
+once per pooled connection rather than on every request. The name is also the
+key under which the instrumentation in `app/db/instrumentation.py` reports the
+statement, and it gives caches a stable handle on the queries they front.
+
+If you need a statement's SQL text directly (e.g. to combine several
+statements with `db.run_batch()`), use its `sql` attribute.
+"""
+import textwrap
+from collections import namedtuple
+from app.db import db
+
+# A named SQL statement. `sql` uses `%s` placeholders for its parameters.
+# `full_scan_ok` marks statements that are meant to read a whole table (see
+# `migrate.check_query_plans()`).
+Query = namedtuple('Query', ['name', 'sql', 'full_scan_ok'], defaults=(False,))
+
+# Every registered query, keyed by name.
+registry = {}
+
+def register(name: str, sql: str, full_scan_ok: bool = False) -> Query:
+    """Registers a SQL statement under a unique name.
+
+    Args:
+        name: Name of the query (must not already be registered).
+        sql: The SQL statement.
+        full_scan_ok: True if the statement is meant to scan a whole table,
+            so `flask db check-plans` shouldn't report it.
+
+    Returns:
+        The new `Query`.
+    """
+    if name in registry:
+        raise ValueError(f'Query "{name}" is already registered.')
+    query = registry[name] = Query(name, textwrap.dedent(sql).strip(), full_scan_ok)
+    return query
+
+# Columns of the `users` table that are safe to show on a page (everything
+# except the password hash).
+_USER_COLUMNS = ('user_id, username, email, first_name, last_name, location, profile_image, '
+                 'personal_description, role, status')
+
+# Columns shown in the admin user lists.
+_USER_LIST_COLUMNS = 'user_id, username, email, first_name, last_name, role, status'
+
+# --- Users ---
+
+USER_BY_ID = register('user_by_id', f'''
+    SELECT {_USER_COLUMNS} FROM users WHERE user_id = %s''')
+
+USER_BY_USERNAME = register('user_by_username', f'''
+    SELECT {_USER_COLUMNS} FROM users WHERE username = %s''')
+
+USER_LOGIN_BY_USERNAME = register('user_login_by_username', '''
+    SELECT user_id, username, password_hash, role, status FROM users WHERE username = %s''')
+
+USER_PASSWORD_HASH_BY_ID = register('user_password_hash_by_id', '''
+    SELECT password_hash FROM users WHERE user_id = %s''')
+
+USER_ID_BY_USERNAME = register('user_id_by_username', '''
+    SELECT user_id FROM users WHERE username = %s''')
+
+USER_ID_BY_EMAIL = register('user_id_by_email', '''
+    SELECT user_id FROM users WHERE email = %s''')
+
+# Whether a username and an email are in use, in one round trip (two unique
+# index lookups).
+USERNAME_EMAIL_TAKEN = register('username_email_taken', '''
+    SELECT EXISTS(SELECT 1 FROM users WHERE username = %s) AS username_taken,
+           EXISTS(SELECT 1 FROM users WHERE email = %s) AS email_taken''')
+
+INSERT_USER = register('insert_user', '''
+    INSERT INTO users (username, password_hash, email, first_name, last_name, location,
+                       profile_image, personal_description, role, shareable, status)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''')
+
+UPDATE_USER_PROFILE = register('update_user_profile', '''
+    UPDATE users SET first_name = %s, last_name = %s, email = %s, location = %s,
+                     personal_description = %s
+    WHERE user_id = %s''')
+
+UPDATE_USER_PASSWORD = register('update_user_password', '''
+    UPDATE users SET password_hash = %s WHERE user_id = %s''')
+
+# Only replaces the hash if it hasn't changed since it was read, so that a
+# background rehash can't undo a password change.
+UPDATE_USER_PASSWORD_IF_UNCHANGED = register('update_user_password_if_unchanged', '''
+    UPDATE users SET password_hash = %s WHERE user_id = %s AND password_hash = %s''')
+
+UPDATE_USER_PROFILE_IMAGE = register('update_user_profile_image', '''
+    UPDATE users SET profile_image = %s WHERE user_id = %s''')
+
+UPDATE_USER_ROLE_STATUS = register('update_user_role_status', '''
+    UPDATE users SET role = %s, status = %s WHERE user_id = %s''')
+
+# --- Admin user lists ---
+
+# Pages of the admin user lists, in `(username, user_id)` order, keyed by
+# `(all_users, direction)`. Pages are fetched by keyset pagination: 'first'
+# fetches the first page, 'after' the page following a `(username, user_id)`
+# cursor, and 'before' the page preceding one (in reverse order). Parameters
+# are the cursor's username twice, its user_id, then the page size.
+_PAGE_DIRECTIONS = {
+    'first': (None, 'ASC'),
+    'after': ('(username > %s OR (username = %s AND user_id > %s))', 'ASC'),
+    'before': ('(username < %s OR (username = %s AND user_id < %s))', 'DESC'),
+}
+
+def _users_page_sql(all_users, direction):
+    keyset, order = _PAGE_DIRECTIONS[direction]
+    conditions = [c for c in (keyset, None if all_users else "role IN ('editor', 'admin')") if c]
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f'''
+        SELECT {_USER_LIST_COLUMNS} FROM users{where}
+        ORDER BY username {order}, user_id {order}
+        LIMIT %s'''
+
+LIST_USERS_PAGE = {
+    (all_users, direction): register(f"list_{'all' if all_users else 'system'}_users_{direction}",
+                                     _users_page_sql(all_users, direction))
+    for direction in _PAGE_DIRECTIONS
+    for all_users in (True, False)
+}
+
+# Cheap approximate counts for the user lists, used instead of COUNT(*).
+# InnoDB's table statistics give the number of users (the number of editors
+# and admins is estimated by the optimizer, see `approx_user_total()` in
+# app/routes/admin.py).
+USERS_APPROX_TOTAL = register('users_approx_total', '''
+    SELECT TABLE_ROWS AS total FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'users'
+    ''', full_scan_ok=True)
+
+# Every user, with the columns kept in the user search index (see
+# app/search/users.py).
+USERS_FOR_SEARCH = register('users_for_search', f'''
+    SELECT {_USER_LIST_COLUMNS} FROM users''', full_scan_ok=True)
+
+# --- Journeys and events ---
+
+# What the access checks need to know about a journey (see
+# app/utils/authorization.py), plus what the event pages show.
+JOURNEY_ACCESS = register('journey_access', '''
+    SELECT j.journey_id, j.user_id, j.title, j.status, u.username
+    FROM journeys j
+    JOIN users u ON j.user_id = u.user_id
+    WHERE j.journey_id = %s''')
+
+# Pages of a journey's event timeline, in `(start_time, event_id)` order,
+# keyed by direction: 'first' fetches the first page, 'after' the page
+# following a `(start_time, event_id)` cursor. Only the summary columns are
+# selected: the description is cut to its first `EVENT_SUMMARY_LENGTH`
+# characters (see `EVENT_DESCRIPTION` for the rest). Parameters are the
+# journey_id, the cursor's start_time twice and its event_id, then the page
+# size.
+EVENT_SUMMARY_LENGTH = 280
+
+_EVENT_SUMMARY_COLUMNS = f'''event_id, journey_id, title, location, start_time, end_time, event_image,
+               LEFT(description, {EVENT_SUMMARY_LENGTH}) AS summary,
+               CHAR_LENGTH(description) > {EVENT_SUMMARY_LENGTH} AS truncated'''
+_EVENTS_AFTER = '(start_time > %s OR (start_time = %s AND event_id > %s))'
+
+def _events_page_sql(columns, keyset):
+    keyset = f' AND {keyset}' if keyset else ''
+    return f'''
+        SELECT {columns}
+        FROM events
+        WHERE journey_id = %s{keyset}
+        ORDER BY start_time, event_id
+        LIMIT %s'''
+
+EVENTS_PAGE = {
+    'first': register('events_page_first', _events_page_sql(_EVENT_SUMMARY_COLUMNS, None)),
+    'after': register('events_page_after', _events_page_sql(_EVENT_SUMMARY_COLUMNS, _EVENTS_AFTER)),
+}
+
+# The same pages with the columns that are exported (see
+# app/utils/event_io.py), descriptions in full.
+EVENTS_EXPORT_PAGE = {
+    'first': register('events_export_page_first', _events_page_sql(
+        'event_id, title, description, start_time, end_time, location', None)),
+    'after': register('events_export_page_after', _events_page_sql(
+        'event_id, title, description, start_time, end_time, location', _EVENTS_AFTER)),
+}
+
+EVENT_DESCRIPTION = register('event_description', '''
+    SELECT description FROM events WHERE event_id = %s AND journey_id = %s''')
+
+# The statements below take the event_id and journey_id together, so they
+# only touch an event of the journey the caller was authorized for.
+EVENT_BY_ID = register('event_by_id', '''
+    SELECT event_id, journey_id, title, description, start_time, end_time, location, event_image
+    FROM events WHERE event_id = %s AND journey_id = %s''')
+
+# Locks the event's row until the end of the transaction (see
+# `write_event()` in app/routes/event.py).
+LOCK_EVENT_IMAGE = register('lock_event_image', '''
+    SELECT event_image FROM events WHERE event_id = %s AND journey_id = %s FOR UPDATE''')
+
+INSERT_EVENT = register('insert_event', '''
+    INSERT INTO events (journey_id, title, description, start_time, end_time, location, event_image)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)''')
+
+UPDATE_EVENT = register('update_event', '''
+    UPDATE events
+    SET title = %s, description = %s, start_time = %s, end_time = %s, location = %s
+    WHERE event_id = %s AND journey_id = %s''')
+
+UPDATE_EVENT_WITH_IMAGE = register('update_event_with_image', '''
+    UPDATE events
+    SET title = %s, description = %s, start_time = %s, end_time = %s,
+        location = %s, event_image = %s
+    WHERE event_id = %s AND journey_id = %s''')
+
+DELETE_EVENT = register('delete_event', '''
+    DELETE FROM events WHERE event_id = %s AND journey_id = %s''')
+
+# --- Uploaded images (see app/db/image_refs.py) ---
+
+RETAIN_IMAGE = register('retain_image', '''
+    INSERT INTO image_blobs (name, ref_count) VALUES (%s, 1)
+    ON DUPLICATE KEY UPDATE ref_count = ref_count + 1''')
+
+RELEASE_IMAGE = register('release_image', '''
+    UPDATE image_blobs SET ref_count = ref_count - 1 WHERE name = %s AND ref_count > 0''')
+
+# Sets every reference count to the number of users and events that actually
+# refer to the image.
+RECOUNT_IMAGE_REFS = register('recount_image_refs', '''
+    UPDATE image_blobs b
+    LEFT JOIN (
+        SELECT name, COUNT(*) AS refs FROM (
+            SELECT profile_image AS name FROM users WHERE profile_image IS NOT NULL
+            UNION ALL
+            SELECT event_image FROM events WHERE event_image IS NOT NULL
+        ) AS r
+        GROUP BY name
+    ) AS c ON c.name = b.name
+    SET b.ref_count = COALESCE(c.refs, 0)''', full_scan_ok=True)
+
+UNREFERENCED_IMAGES = register('unreferenced_images', '''
+    SELECT name FROM image_blobs
+    WHERE ref_count = 0 AND updated_at < NOW() - INTERVAL %s SECOND''')
+
+DELETE_UNREFERENCED_IMAGE = register('delete_unreferenced_image', '''
+    DELETE FROM image_blobs WHERE name = %s AND ref_count = 0''')
+
+ALL_IMAGE_NAMES = register('all_image_names', '''
+    SELECT name FROM image_blobs''', full_scan_ok=True)
+
+# Removing every reference to an upload that couldn't be processed (see
+# `image_refs.forget()`). Image names aren't indexed in `users` and `events`,
+# but this only happens when an upload fails.
+IMAGE_USERS = register('image_users', '''
+    SELECT user_id FROM users WHERE profile_image = %s''', full_scan_ok=True)
+
+IMAGE_JOURNEYS = register('image_journeys', '''
+    SELECT DISTINCT journey_id FROM events WHERE event_image = %s''', full_scan_ok=True)
+
+CLEAR_PROFILE_IMAGE = register('clear_profile_image', '''
+    UPDATE users SET profile_image = NULL WHERE profile_image = %s''', full_scan_ok=True)
+
+CLEAR_EVENT_IMAGE = register('clear_event_image', '''
+    UPDATE events SET event_image = NULL WHERE event_image = %s''', full_scan_ok=True)
+
+DELETE_IMAGE = register('delete_image', '''
+    DELETE FROM image_blobs WHERE name = %s''')
+
+# --- Public journey feed (see app/db/journey_feed.py) ---
+
+# Length of the description summaries in `journey_feed` (its `summary`
+# column's size).
+FEED_SUMMARY_LENGTH = 280
+
+_LISTED_JOURNEY = "j.status = 'public' AND j.is_hidden = 0"
+
+def _feed_upsert_sql(where):
+    return f'''
+        INSERT INTO journey_feed
+            (journey_id, user_id, title, summary, truncated, update_date, event_count, cover_image)
+        SELECT * FROM (
+            SELECT j.journey_id, j.user_id, j.title,
+                   LEFT(j.description, {FEED_SUMMARY_LENGTH}) AS summary,
+                   CHAR_LENGTH(j.description) > {FEED_SUMMARY_LENGTH} AS truncated,
+                   j.update_date,
+                   (SELECT COUNT(*) FROM events e WHERE e.journey_id = j.journey_id) AS event_count,
+                   (SELECT e.event_image FROM events e
+                    WHERE e.journey_id = j.journey_id AND e.event_image IS NOT NULL
+                    ORDER BY e.start_time, e.event_id LIMIT 1) AS cover_image
+            FROM journeys j
+            WHERE {where}
+        ) AS f
+        ON DUPLICATE KEY UPDATE user_id = f.user_id, title = f.title, summary = f.summary,
+            truncated = f.truncated, update_date = f.update_date, event_count = f.event_count,
+            cover_image = f.cover_image'''
+
+# Recomputes one journey's feed row from `journeys` and `events` (if the
+# journey is listed), then removes it (if it isn't). Each takes the
+# journey_id. Run together by `journey_feed.refresh()`.
+REFRESH_FEED_ENTRY = register('refresh_feed_entry', _feed_upsert_sql(f'j.journey_id = %s AND {_LISTED_JOURNEY}'))
+
+DELETE_UNLISTED_FEED_ENTRY = register('delete_unlisted_feed_entry', f'''
+    DELETE FROM journey_feed
+    WHERE journey_id = %s
+      AND journey_id NOT IN (SELECT j.journey_id FROM journeys j WHERE j.journey_id = %s AND {_LISTED_JOURNEY})''')
+
+# The same for every journey, for `flask feed rebuild`.
+REBUILD_FEED = register('rebuild_feed', _feed_upsert_sql(_LISTED_JOURNEY), full_scan_ok=True)
+
+DELETE_UNLISTED_FEED = register('delete_unlisted_feed', f'''
+    DELETE FROM journey_feed
+    WHERE journey_id NOT IN (SELECT j.journey_id FROM journeys j WHERE {_LISTED_JOURNEY})''', full_scan_ok=True)
+
+# Pages of the feed, most recently updated journey first, keyed by direction
+# like `EVENTS_PAGE`: 'after' takes the cursor's update_date twice and its
+# journey_id, then the page size; 'first' just the page size.
+def _feed_page_sql(keyset):
+    keyset = f'WHERE {keyset}' if keyset else ''
+    return f'''
+        SELECT f.journey_id, f.title, f.summary, f.truncated, f.update_date, f.event_count,
+               f.cover_image, u.username
+        FROM journey_feed f
+        JOIN users u ON u.user_id = f.user_id
+        {keyset}
+        ORDER BY f.update_date DESC, f.journey_id DESC
+        LIMIT %s'''
+
+FEED_PAGE = {
+    'first': register('feed_page_first', _feed_page_sql(None)),
+    'after': register('feed_page_after', _feed_page_sql(
+        '(f.update_date < %s OR (f.update_date = %s AND f.journey_id < %s))')),
+}
+
+# --- Announcements (see app/db/announcements.py) ---
+
+# The cheap check of whether the cached announcements are current: the
+# version bumped by every change made through the app, and the newest
+# announcement_id (which catches rows inserted by hand). Both are single index
+# lookups.
+ANNOUNCEMENTS_VERSION = register('announcements_version', '''
+    SELECT (SELECT version FROM content_versions WHERE name = 'announcements') AS version,
+           (SELECT MAX(announcement_id) FROM announcements) AS max_id''')
+
+BUMP_ANNOUNCEMENTS_VERSION = register('bump_announcements_version', '''
+    INSERT INTO content_versions (name, version) VALUES ('announcements', 1)
+    ON DUPLICATE KEY UPDATE version = version + 1''')
+
+# Most important first: the `level` ENUM sorts 'high', 'medium', 'low'.
+ACTIVE_ANNOUNCEMENTS = register('active_announcements', '''
+    SELECT a.announcement_id, a.title, a.content, a.level, a.created_time, u.username
+    FROM announcements a
+    JOIN users u ON u.user_id = a.user_id
+    WHERE a.status = 'active'
+    ORDER BY a.level, a.created_time DESC, a.announcement_id DESC''')
+
+ALL_ANNOUNCEMENTS = register('all_announcements', '''
+    SELECT a.announcement_id, a.title, a.content, a.level, a.status, a.created_time, u.username
+    FROM announcements a
+    JOIN users u ON u.user_id = a.user_id
+    ORDER BY a.created_time DESC, a.announcement_id DESC''', full_scan_ok=True)
+
+ANNOUNCEMENT_BY_ID = register('announcement_by_id', '''
+    SELECT announcement_id, title, content, level, status FROM announcements WHERE announcement_id = %s''')
+
+INSERT_ANNOUNCEMENT = register('insert_announcement', '''
+    INSERT INTO announcements (user_id, title, content, level, status) VALUES (%s, %s, %s, %s, %s)''')
+
+UPDATE_ANNOUNCEMENT = register('update_announcement', '''
+    UPDATE announcements SET title = %s, content = %s, level = %s, status = %s
+    WHERE announcement_id = %s''')
+
+DELETE_ANNOUNCEMENT = register('delete_announcement', '''
+    DELETE FROM announcements WHERE announcement_id = %s''')
+
+def fetch_one(query: Query, params=()):
+    """Runs a query and returns its first row (or `None` if there are no rows).
+
+    Args:
+        query: The registered `Query` to run.
+        params: Values for the query's `%s` placeholders.
+
+    Returns:
+        The first row as a dictionary, or `None`.
+    """
+    rows = fetch_all(query, params)
+    return rows[0] if rows else None
+
+def fetch_all(query: Query, params=()):
+    """Runs a query and returns all of its rows.
+
+    Args:
+        query: The registered `Query` to run.
+        params: Values for the query's `%s` placeholders.
+
+    Returns:
+        A list of rows, each a dictionary.
+    """
+    with db.prepared_cursor(query.name) as cursor:
+        cursor.execute(query.sql, params)
+        return cursor.fetchall()
+
+def execute(query: Query, params=()):
+    """Runs a query that doesn't return rows (e.g. an UPDATE or DELETE).
+
+    Args:
+        query: The registered `Query` to run.
+        params: Values for the query's `%s` placeholders.
+
+    Returns:
+        The number of rows matched (for an UPDATE, including rows it left
+        unchanged; see `db.init_db()`).
+    """
+    with db.prepared_cursor(query.name) as cursor:
+        cursor.execute(query.sql, params)
+        return cursor.rowcount
+
+def insert(query: Query, params=()):
+    """Runs an INSERT query.
+
+    Args:
+        query: The registered `Query` to run.
+        params: Values for the query's `%s` placeholders.
+
+    Returns:
+        The ID generated for the new row's AUTO_INCREMENT column.
+    """
+    with db.prepared_cursor(query.name) as cursor:
+        cursor.execute(query.sql, params)
+        return cursor.lastrowid
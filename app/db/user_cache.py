@@ -0,0 +1,142 @@
+"""Read-through cache of `users` rows.
+
+Most pages look up the current user's row by `user_id` (or, for avatar
+previews, by `username`), but only a handful of routes ever change that row.
+This module caches the rows returned by `queries.USER_BY_ID` so those pages
+don't need a database round trip:
+```
+>>> user = user_cache.get_user(user_id)
+>>> user = user_cache.get_user_by_username(username)
+```
+
+Any route that changes a user's row must call `invalidate_user(user_id)`
+afterwards (or `remember_user(row)` if it has just re-read the row).
+
+Rows are cached in-process in an LRU cache with a time-to-live. If a shared
+Redis backend is configured, rows are also stored there, and invalidations are
+applied there too, so other worker processes pick up a change as soon as their
+own (short-lived) in-process copy expires.
+
+Usernames can't be changed, so the username -> user_id mapping is cached
+separately and never needs invalidating. It also answers "is this username
+taken?" for the signup form (`username_taken()`); usernames found to be free
+are remembered too, but only for `free_ttl` seconds, as someone may sign up
+with one at any moment.
+"""
+from app.db import queries
+from app.utils.cache import MISSING, RedisBackend, TTLCache
+
+# Cached rows keyed by user_id, user_ids keyed by username, and usernames
+# known to be free (created when calling `init_user_cache`).
+_rows: TTLCache
+_user_ids: TTLCache
+_free_usernames: TTLCache
+
+# Optional shared backend (see `init_user_cache`).
+_backend = None
+_backend_counters = dict(hits=0, misses=0)
+
+def init_user_cache(max_size: int, ttl: float, redis_url: str = '', shared_ttl: float = 300.0,
+                    free_ttl: float = 10.0):
+    """Sets up the user cache.
+
+    Args:
+        max_size: Maximum number of rows cached in this process.
+        ttl: Seconds a row stays in this process's cache. Keep this short if
+            several worker processes share a backend, as it bounds how long a
+            worker can serve a row another worker has changed.
+        redis_url: URL of a Redis server to share cached rows between
+            processes, or an empty string for no shared backend.
+        shared_ttl: Seconds a row stays in the shared backend.
+        free_ttl: Seconds a username found to be free is remembered as such.
+    """
+    global _rows, _user_ids, _free_usernames, _backend
+    _rows = TTLCache(max_size, ttl)
+    _user_ids = TTLCache(max_size, 0)
+    _free_usernames = TTLCache(max_size, free_ttl)
+    _backend = RedisBackend(redis_url, 'journey:user:', shared_ttl) if redis_url else None
+
+def get_user(user_id):
+    """Gets a user's row by user_id.
+
+    Returns:
+        A copy of the row (see `queries.USER_BY_ID` for its columns), or
+        `None` if there is no such user.
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    row = _rows.get(user_id)
+    if row is MISSING and _backend is not None:
+        row = _backend.get(str(user_id))
+        _backend_counters['hits' if row is not MISSING else 'misses'] += 1
+        if row is not MISSING:
+            _rows.set(user_id, row)
+    if row is MISSING:
+        row = queries.fetch_one(queries.USER_BY_ID, (user_id,))
+        if row is None:
+            return None
+        remember_user(row)
+    return dict(row)
+
+def get_user_by_username(username):
+    """Gets a user's row by username.
+
+    Returns:
+        A copy of the row, or `None` if there is no such user.
+    """
+    user_id = _user_ids.get(username)
+    if user_id is not MISSING:
+        return get_user(user_id)
+
+    row = queries.fetch_one(queries.USER_BY_USERNAME, (username,))
+    if row is None:
+        return None
+    remember_user(row)
+    return dict(row)
+
+def username_taken(username) -> bool:
+    """Returns True if a user already has `username`. Answers from the cache
+    where it can, so it is cheap enough to call as the user types."""
+    if _user_ids.get(username) is not MISSING:
+        return True
+    if _free_usernames.get(username) is not MISSING:
+        return False
+    row = queries.fetch_one(queries.USER_ID_BY_USERNAME, (username,))
+    if row is None:
+        _free_usernames.set(username, True)
+        return False
+    _user_ids.set(username, row['user_id'])
+    return True
+
+def remember_username(username, user_id):
+    """Caches the user_id of a username that has just been taken (e.g. by a
+    new account)."""
+    _free_usernames.delete(username)
+    _user_ids.set(username, user_id)
+
+def remember_user(row):
+    """Caches a freshly read `queries.USER_BY_ID` row, replacing any copy that
+    is already cached."""
+    row = dict(row)
+    _rows.set(row['user_id'], row)
+    _user_ids.set(row['username'], row['user_id'])
+    if _backend is not None:
+        _backend.set(str(row['user_id']), row)
+
+def invalidate_user(user_id):
+    """Drops a user's cached row. Call this after changing the user's row."""
+    user_id = int(user_id)
+    _rows.delete(user_id)
+    if _backend is not None:
+        _backend.delete(str(user_id))
+
+def stats():
+    """Returns the cache's hit/miss/eviction counters."""
+    counters = _rows.stats()
+    counters['usernames'] = _user_ids.stats()
+    counters['free_usernames'] = _free_usernames.stats()
+    if _backend is not None:
+        counters['shared_backend'] = dict(_backend_counters)
+    return counters
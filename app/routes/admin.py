@@ -6,95 +6,226 @@ It includes role-based access control to ensure only admin users can access this
 Unauthorized users are either redirected or shown a 403 error.
 """
 from app.config import constants
-from app import app
-from flask import request, redirect, render_template, session, url_for
-from app.db import db
+from flask import Blueprint, flash, request, redirect, render_template, session, url_for, jsonify
+from app.db import announcements, db, image_refs, instrumentation, journey_feed, queries, user_cache
+from app.utils import authorization, images, pagination, passwords, rate_limit, sessions, startup, templates, validators
+from app.utils.cache import MISSING, TTLCache
+from app.search import planner, users as user_search
 from app.routes.user import login
 # Importing decorators from the current package
 from app.utils.decorators import role_required, login_required
 
+bp = Blueprint('admin', __name__)
 
-@app.route('/admin/home')
+
+@bp.route('/admin/home')
 @role_required(constants.USER_ROLE_ADMIN)
 def admin_home():
      """Admin Homepage endpoint.
 
      Methods:
-     - get: Renders the homepage for the current admin user, or an "Access
+     - get: Renders the homepage (with the active announcements, see
+          `app/db/announcements.py`) for the current admin user, or an "Access
           Denied" 403: Forbidden page if the current user has a different role.
 
      If the user is not logged in, requests will redirect to the login page.
      """
-     return render_template(constants.TEMPLATE_ADMIN_HOME)
+     return render_template(constants.TEMPLATE_ADMIN_HOME, announcements=announcements.active())
+
+
+@bp.route('/admin/db_stats')
+@role_required(constants.USER_ROLE_ADMIN)
+def db_stats():
+     """Database statistics endpoint.
+
+     Methods:
+     - get: Returns the connection pool counters (see `app/db/pool.py`), the
+          user cache counters (see `app/db/user_cache.py`), the password
+          hashing pool counters (see `app/utils/passwords.py`), the login
+          and signup rate limit counters (see `app/utils/rate_limit.py`), the
+          session store counters (see `app/utils/sessions.py`), the user
+          search index counters (see `app/search/users.py`), the image
+          upload and reference counters (see `app/utils/images.py` and
+          `app/db/image_refs.py`), the journey access cache counters (see
+          `app/utils/authorization.py`), the public journey feed counters
+          (see `app/db/journey_feed.py`), the announcements cache counters
+          (see `app/db/announcements.py`), the template fragment cache
+          counters (see `app/utils/templates.py`), the startup phase timings
+          (see `app/utils/startup.py`) and the per-endpoint and
+          per-statement SQL totals recorded by `app/db/instrumentation.py` as
+          JSON. The SQL totals and fragment counters are just
+          `{"enabled": false}` when turned off, and the pool counters
+          `{"created": false}` until this process first connects.
+     """
+     sql_stats = instrumentation.snapshot() if db.instrument_queries else {'enabled': False}
+     return jsonify(pool=db.pool_stats(), user_cache=user_cache.stats(),
+                    passwords=passwords.stats(), rate_limits=rate_limit.stats(),
+                    sessions=sessions.stats(), user_search=user_search.stats(),
+                    images=dict(images.stats(), **image_refs.stats()),
+                    journey_access=authorization.stats(), journey_feed=journey_feed.stats(),
+                    announcements=announcements.stats(), template_fragments=templates.stats(),
+                    startup=startup.report(),
+                    queries=sql_stats)
 
 
-@app.route('/all_users')
+@bp.route('/all_users')
 def all_users():
      return users(all_users=True)
 
 
-@app.route('/system_users')
+@bp.route('/system_users')
 def system_users():
      return users()
 
 
+# Types of the `(username, user_id)` sort key of the user list cursors.
+_USER_CURSOR_TYPES = (str, int)
+
+# Approximate user counts shown with the user lists, keyed by `all_users`.
+_approx_totals = TTLCache(max_size=2, ttl=60)
+
+# The optimizer's row estimate (`rows` * `filtered` / 100) of the number of
+# editors and admins. This isn't in the query registry (app/db/queries.py):
+# EXPLAIN can't be prepared, so it is run with a plain cursor.
+_SYSTEM_USERS_ROW_ESTIMATE = "EXPLAIN SELECT user_id FROM users WHERE role IN ('editor', 'admin')"
+
 @login_required
 @role_required(constants.USER_ROLE_ADMIN)
 def users(all_users=False):
-     sqlStr = "SELECT user_id, username, email, first_name, last_name, role, status FROM users WHERE role IN ('editor', 'admin') ORDER BY username, last_name, first_name;"
+     """Shows one page of the user list.
+
+     The page is chosen by keyset pagination on `(username, user_id)` (see
+     `app/utils/pagination.py`): the `after` or `before` query parameter holds
+     a cursor for the last row of the previous page or the first row of the
+     next one, and `per_page` sets the page size.
+     """
+     per_page = pagination.page_size(request.args.get(constants.PAGE_SIZE))
+     after = pagination.decode_cursor(request.args.get(constants.PAGE_AFTER), _USER_CURSOR_TYPES)
+     before = None if after else pagination.decode_cursor(request.args.get(constants.PAGE_BEFORE), _USER_CURSOR_TYPES)
+
+     # Fetch one extra row to find out whether there's another page beyond
+     # this one.
+     if after or before:
+          direction = 'after' if after else 'before'
+          username, user_id = after or before
+          params = (username, username, user_id, per_page + 1)
+     else:
+          direction = 'first'
+          params = (per_page + 1,)
+     userslist = queries.fetch_all(queries.LIST_USERS_PAGE[(all_users, direction)], params)
+     more = len(userslist) > per_page
+     userslist = userslist[:per_page]
+     if before:
+          # Pages before a cursor are fetched in reverse order.
+          userslist.reverse()
+
+     next_url = prev_url = None
+     if userslist:
+          first = pagination.encode_cursor((userslist[0]['username'], userslist[0]['user_id']))
+          last = pagination.encode_cursor((userslist[-1]['username'], userslist[-1]['user_id']))
+          if more or before:
+               next_url = url_for(request.endpoint, **{constants.PAGE_AFTER: last, constants.PAGE_SIZE: per_page})
+          if after or (before and more):
+               prev_url = url_for(request.endpoint, **{constants.PAGE_BEFORE: first, constants.PAGE_SIZE: per_page})
 
-     if all_users:
-          sqlStr = "SELECT user_id, username, email, first_name, last_name, role, status FROM users ORDER BY username, last_name, first_name;"
+     return render_template(constants.TEMPLATE_USER, userslist=userslist, all_users=all_users,
+                            prev_url=prev_url, next_url=next_url,
+                            approx_total=approx_user_total(all_users))
 
-     with db.get_cursor() as cursor:
-          cursor.execute(sqlStr)
-          userslist = cursor.fetchall()
-          return render_template(constants.TEMPLATE_USER, userslist=userslist, all_users=all_users)
+def approx_user_total(all_users=False):
+     """Returns a cheap estimate of the number of users in a user list, from
+     the table statistics rather than a COUNT(*). Estimates are cached for a
+     minute."""
+     total = _approx_totals.get(all_users)
+     if total is MISSING:
+          if all_users:
+               row = queries.fetch_one(queries.USERS_APPROX_TOTAL)
+               total = int(row['total'] or 0) if row else 0
+          else:
+               with db.get_cursor() as cursor:
+                    cursor.execute(_SYSTEM_USERS_ROW_ESTIMATE)
+                    row = cursor.fetchone()
+               total = int((row['rows'] or 0) * (row['filtered'] or 100) / 100) if row else 0
+          _approx_totals.set(all_users, total)
+     return total
 
-@app.route('/users/search_all_users', methods=[constants.HTTP_METHOD_GET])
+@bp.route('/users/search_all_users', methods=[constants.HTTP_METHOD_GET])
 @role_required(constants.USER_ROLE_ADMIN)
 def search_all_users():
     return search_users(all_users=True)
 
-@app.route('/users/search_system_users', methods=[constants.HTTP_METHOD_GET])
+@bp.route('/users/search_system_users', methods=[constants.HTTP_METHOD_GET])
 @role_required(constants.USER_ROLE_ADMIN)
 def search_system_users():
     return search_users()
 
 def search_users(all_users=False):
-    searchterm = request.args.get(constants.SEARCH_TERM)
-    sqlsearch = f'%{searchterm}%'
+    """Shows one page of user search results, best match first.
+
+    Searches are served from the in-memory index in `app/search/users.py`
+    rather than the database. An unknown search category matches nothing.
+    """
+    searchterm = request.args.get(constants.SEARCH_TERM, '')
     searchcat = request.args.get(constants.SEARCH_CATEGORY)
+    per_page = pagination.page_size(request.args.get(constants.PAGE_SIZE))
+    page = request.args.get(constants.PAGE_NUMBER, 1, type=int)
+
+    userslist, total = user_search.search(searchterm, searchcat, all_users, page, per_page)
+
+    prev_url = next_url = None
+    args = {constants.SEARCH_TERM: searchterm, constants.SEARCH_CATEGORY: searchcat,
+            constants.PAGE_SIZE: per_page}
+    if page > 1:
+        prev_url = url_for(request.endpoint, **args, **{constants.PAGE_NUMBER: page - 1})
+    if page * per_page < total:
+        next_url = url_for(request.endpoint, **args, **{constants.PAGE_NUMBER: page + 1})
+    return render_template(constants.TEMPLATE_USER, userslist=userslist, all_users=all_users,
+                           total=total, prev_url=prev_url, next_url=next_url)
+
+
+@bp.route('/users/filter_all_users', methods=[constants.HTTP_METHOD_GET])
+@role_required(constants.USER_ROLE_ADMIN)
+def filter_all_users():
+    return filter_users(all_users=True)
+
+@bp.route('/users/filter_system_users', methods=[constants.HTTP_METHOD_GET])
+@role_required(constants.USER_ROLE_ADMIN)
+def filter_system_users():
+    return filter_users()
+
+def filter_users(all_users=False):
+    """Shows one page of users matching several filters at once: prefixes of
+    any of the `username`, `first_name`, `last_name` and `email` fields, plus
+    the `role` and `status` facets, with a count for each facet value.
+
+    The filters are compiled into a single query (see
+    `app/search/planner.py`), run in one round trip together with the facet
+    counts.
+    """
+    search = planner.parse_filter(request.args)
+    per_page = pagination.page_size(request.args.get(constants.PAGE_SIZE))
+    after = pagination.decode_cursor(request.args.get(constants.PAGE_AFTER), _USER_CURSOR_TYPES)
+
+    userslist, next_cursor, facets = planner.run_filter(search, all_users, per_page, after)
 
-    role_condition = "" if all_users else "AND role IN ('editor', 'admin')"
-
-    with db.get_cursor() as cursor:
-        if searchcat == constants.USERNAME:
-            cursor.execute(
-                f"SELECT username, first_name, last_name, email, role, status, user_id FROM users WHERE username LIKE %s {role_condition} ORDER BY username, last_name, first_name;",
-                (sqlsearch,))
-        elif searchcat == constants.LAST_NAME:
-            cursor.execute(
-                f"SELECT username, first_name, last_name, email, role, status, user_id FROM users WHERE last_name LIKE %s {role_condition} ORDER BY username, last_name, first_name;",
-                (sqlsearch,))
-        elif searchcat == constants.FIRST_NAME:
-            cursor.execute(
-                f"SELECT username, first_name, last_name, email, role, status, user_id FROM users WHERE first_name LIKE %s {role_condition} ORDER BY username, last_name, first_name;",
-                (sqlsearch,))
-        elif searchcat == constants.USER_FULL_NAME:
-            cursor.execute(
-                f"SELECT username, first_name, last_name, email, role, status, user_id FROM users WHERE CONCAT(first_name, ' ', last_name) LIKE %s {role_condition} ORDER BY username, last_name, first_name;",
-                (sqlsearch,))
-        elif searchcat == constants.EMAIL:
-            cursor.execute(
-                f"SELECT username, first_name, last_name, email, role, status, user_id FROM users WHERE email LIKE %s {role_condition} ORDER BY username, last_name, first_name;",
-                (sqlsearch,))
-
-        userslist = cursor.fetchall()
-        return render_template(constants.TEMPLATE_USER, userslist=userslist, all_users=all_users)
-
-
-@app.route('/users/edit', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
+    # Links keep the current filters, and change one thing.
+    args = dict(search.fields, role=search.role, status=search.status, **{constants.PAGE_SIZE: per_page})
+    next_url = prev_url = None
+    if next_cursor:
+        next_url = url_for(request.endpoint, **args,
+                           **{constants.PAGE_AFTER: pagination.encode_cursor(next_cursor)})
+    if after:
+        # Back to the first page.
+        prev_url = url_for(request.endpoint, **args)
+    facet_urls = {facet: {value: url_for(request.endpoint, **dict(args, **{facet: value}))
+                          for value in values}
+                  for facet, values in planner.FACETS.items()}
+
+    return render_template(constants.TEMPLATE_USER, userslist=userslist, all_users=all_users,
+                           prev_url=prev_url, next_url=next_url, user_filter=search,
+                           facets=facets, facet_urls=facet_urls)
+
+@bp.route('/users/edit', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
 @login_required
 @role_required(constants.USER_ROLE_ADMIN)
 def edit_user():
@@ -102,11 +233,7 @@ def edit_user():
           user_id = request.args.get(constants.USER_ID)
           print(request.args)
 
-          with db.get_cursor() as cursor:
-               cursor.execute(
-                    "SELECT username, email, first_name, last_name, role, status FROM users WHERE user_id = %s;",
-                    (user_id,))
-               user = cursor.fetchone()
+          user = user_cache.get_user(user_id)
 
           return render_template(constants.TEMPLATE_USER_EDIT, user=user, user_id=user_id)
      elif request.method == constants.HTTP_METHOD_POST:
@@ -114,19 +241,26 @@ def edit_user():
           role = request.form.get(constants.USER_ROLE)
           status = request.form.get(constants.USER_STATUS)
 
-          with db.get_cursor() as cursor:
-               cursor.execute("UPDATE users SET role=%s, status=%s WHERE user_id=%s;", (role, status, user_id,))
+          error = validators.USER_EDIT_FORM.first_error(request.form)
+          if error:
+               flash(error, 'error')
+               return render_template(constants.TEMPLATE_USER_EDIT, user=user_cache.get_user(user_id), user_id=user_id)
 
-          with db.get_cursor() as cursor:
-               cursor.execute(
-                    "SELECT username, email, first_name, last_name, role, status FROM users WHERE user_id = %s;",
-                    (user_id,))
-               user = cursor.fetchone()
+          # Apply the change and re-read the user in a single round trip.
+          _, users = db.run_batch(
+               (queries.UPDATE_USER_ROLE_STATUS.sql, (role, status, user_id,)),
+               (queries.USER_BY_ID.sql, (user_id,)))
+          user = users[0] if users else None
+          if user is not None:
+               user_cache.remember_user(user)
+               user_search.index_user(user)
+               # Apply the change to the user's sessions (banning ends them).
+               sessions.update_user(user_id, role, status)
 
           return render_template(constants.TEMPLATE_USER_EDIT, user=user, user_id=user_id)
 
 
-@app.route('/users/update', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
+@bp.route('/users/update', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
 @login_required
 @role_required(constants.USER_ROLE_ADMIN)
 def update_user_status():
@@ -134,8 +268,15 @@ def update_user_status():
      user_new_role = request.form.get(constants.USER_ROLE)
      user_new_status = request.form.get(constants.USER_STATUS)
 
-     with db.get_cursor() as cursor:
-          cursor.execute("UPDATE users SET role=%s, status=%s WHERE user_id=%s;",
-                         (user_new_role, user_new_status, user_id,))
+     error = validators.USER_EDIT_FORM.first_error(request.form)
+     if error:
+          flash(error, 'error')
+          return redirect(url_for('admin.edit_user', user_id=user_id))
+
+     queries.execute(queries.UPDATE_USER_ROLE_STATUS, (user_new_role, user_new_status, user_id,))
+     user_cache.invalidate_user(user_id)
+     user_search.update_user(user_id, role=user_new_role, status=user_new_status)
+     # Apply the change to the user's sessions (banning ends them).
+     sessions.update_user(user_id, user_new_role, user_new_status)
 
-     return redirect(url_for('edit_user', user_id=user_id))
\ No newline at end of file
+     return redirect(url_for('admin.edit_user', user_id=user_id))
\ No newline at end of file
@@ -0,0 +1,88 @@
+"""
+Module: Announcement Management Routes
+
+This module defines the admin endpoints for adding, editing and deleting the
+announcements shown on the home pages (see app/db/announcements.py).
+"""
+from flask import Blueprint, flash, redirect, render_template, request, session, url_for
+from app.config import constants
+from app.db import announcements, queries
+from app.utils import validators
+from app.utils.decorators import role_required
+
+bp = Blueprint('announcement', __name__)
+
+def announcement_form():
+    """Read the announcement form.
+
+    Returns:
+        A `(values, error)` tuple: the title, content, level and status, and
+        the reason they can't be saved (or an empty string).
+    """
+    title = (request.form.get('title') or '').strip()
+    content = (request.form.get('content') or '').strip()
+    level = request.form.get('level')
+    status = request.form.get('status')
+    return (title, content, level, status), validators.ANNOUNCEMENT_FORM.first_error(
+        dict(title=title, content=content, level=level, status=status))
+
+@bp.route('/admin/announcements')
+@role_required(constants.USER_ROLE_ADMIN)
+def manage_announcements():
+    """List every announcement, active or not, newest first."""
+    return render_template(constants.TEMPLATE_ANNOUNCEMENTS,
+                           announcements=queries.fetch_all(queries.ALL_ANNOUNCEMENTS))
+
+@bp.route('/admin/announcements/add', methods=['GET', 'POST'])
+@role_required(constants.USER_ROLE_ADMIN)
+def add_announcement():
+    """Add an announcement."""
+    if request.method == 'POST':
+        values, error = announcement_form()
+        if error:
+            flash(error, 'error')
+            return render_template(constants.TEMPLATE_ANNOUNCEMENT_FORM, announcement=None)
+        announcements.create(session[constants.USER_ID], *values)
+        flash('Announcement added successfully', 'success')
+        return redirect(url_for('announcement.manage_announcements'))
+
+    return render_template(constants.TEMPLATE_ANNOUNCEMENT_FORM, announcement=None)
+
+@bp.route('/admin/announcements/<int:announcement_id>/edit', methods=['GET', 'POST'])
+@role_required(constants.USER_ROLE_ADMIN)
+def edit_announcement(announcement_id):
+    """Edit an announcement.
+
+    Args:
+        announcement_id: The ID of the announcement to edit
+    """
+    if request.method == 'POST':
+        values, error = announcement_form()
+        if error:
+            flash(error, 'error')
+            return redirect(url_for('announcement.edit_announcement', announcement_id=announcement_id))
+        if not announcements.update(announcement_id, *values):
+            flash('Announcement not found', 'error')
+        else:
+            flash('Announcement updated successfully', 'success')
+        return redirect(url_for('announcement.manage_announcements'))
+
+    announcement = queries.fetch_one(queries.ANNOUNCEMENT_BY_ID, (announcement_id,))
+    if not announcement:
+        flash('Announcement not found', 'error')
+        return redirect(url_for('announcement.manage_announcements'))
+    return render_template(constants.TEMPLATE_ANNOUNCEMENT_FORM, announcement=announcement)
+
+@bp.route('/admin/announcements/<int:announcement_id>/delete', methods=['POST'])
+@role_required(constants.USER_ROLE_ADMIN)
+def delete_announcement(announcement_id):
+    """Delete an announcement.
+
+    Args:
+        announcement_id: The ID of the announcement to delete
+    """
+    if announcements.delete(announcement_id):
+        flash('Announcement deleted successfully', 'success')
+    else:
+        flash('Announcement not found', 'error')
+    return redirect(url_for('announcement.manage_announcements'))
@@ -6,20 +6,23 @@ It includes role-based access control to ensure only editor users can access thi
 Unauthorized users are either redirected or shown a 403 error.
 """
 from app.config import constants
-from app import app
-from flask import redirect, render_template, session, url_for
+from flask import Blueprint, redirect, render_template, session, url_for
+from app.db import announcements
 # Importing decorators from the current package
 from app.utils.decorators import role_required
 
-@app.route('/editor/home')
+bp = Blueprint('editor', __name__)
+
+@bp.route('/editor/home')
 @role_required(constants.USER_ROLE_EDITOR)
 def editor_home():
      """Editor Homepage endpoint.
 
      Methods:
-     - get: Renders the homepage for the current editor user, or an "Access
+     - get: Renders the homepage (with the active announcements, see
+          `app/db/announcements.py`) for the current editor user, or an "Access
           Denied" 403: Forbidden page if the current user has a different role.
 
      If the user is not logged in, requests will redirect to the login page.
      """
-     return render_template(constants.TEMPLATE_EDITOR_HOME)
\ No newline at end of file
+     return render_template(constants.TEMPLATE_EDITOR_HOME, announcements=announcements.active())
\ No newline at end of file
@@ -4,53 +4,157 @@ Module: Event Management Routes
 This module defines the endpoints for managing events in journeys.
 It includes functionality for adding, editing, deleting and viewing events.
 """
-from app import app
-from flask import redirect, render_template, request, session, url_for, flash
+from flask import Blueprint, Response, current_app, jsonify, redirect, render_template, request, stream_with_context, url_for, flash
 from app.config import constants
 from app.utils.decorators import login_required
-from app.db import db
-from werkzeug.utils import secure_filename
-import os
+from app.db import db, image_refs, journey_feed, queries
+from app.utils import authorization, event_io, images, pagination, validators
 from datetime import datetime
 
-@app.route('/journey/<int:journey_id>/events')
+bp = Blueprint('event', __name__)
+
+# Types of the `(start_time, event_id)` sort key of timeline cursors (see
+# `pagination.decode_cursor()`).
+_CURSOR_TYPES = (datetime, int)
+
+def fetch_events_page(journey_id, after=None):
+    """Fetch one page of a journey's timeline.
+
+    Args:
+        journey_id: The ID of the journey
+        after: Optional `(start_time, event_id)` cursor of the event before
+            the page
+
+    Returns:
+        A `(events, next_cursor)` tuple: the events (summary columns only, see
+        `queries.EVENTS_PAGE`), and the cursor token of the next page, or
+        `None` if this is the last page.
+    """
+    per_page = pagination.page_size(request.args.get(constants.PAGE_SIZE), constants.EVENTS_PAGE_SIZE)
+    if after is None:
+        events = queries.fetch_all(queries.EVENTS_PAGE['first'], (journey_id, per_page + 1))
+    else:
+        events = queries.fetch_all(queries.EVENTS_PAGE['after'],
+                                   (journey_id, after[0], after[0], after[1], per_page + 1))
+    next_cursor = None
+    if len(events) > per_page:
+        events = events[:per_page]
+        last = events[-1]
+        next_cursor = pagination.encode_cursor((last['start_time'].isoformat(sep=' '), last['event_id']))
+    return events, next_cursor
+
+@bp.route('/journey/<int:journey_id>/events')
 @login_required
 def view_events(journey_id):
-    """View all events for a specific journey.
+    """View the first page of a journey's event timeline. Later pages are
+    loaded as the user scrolls (see `events_page`).
     
     Args:
         journey_id: The ID of the journey to view events for
     """
-    with db.get_cursor() as cursor:
-        # Get journey details
-        cursor.execute("""
-            SELECT j.*, u.username 
-            FROM journeys j 
-            JOIN users u ON j.user_id = u.user_id 
-            WHERE j.journey_id = %s
-        """, (journey_id,))
-        journey = cursor.fetchone()
+    journey, error = authorization.authorize(authorization.VIEW, journey_id)
+    if not journey:
+        flash(error, 'error')
+        return redirect(url_for('traveller.traveller_home'))
         
-        if not journey:
-            flash('Journey not found', 'error')
-            return redirect(url_for('traveller_home'))
-            
-        # Check if user has permission to view this journey
-        if journey['status'] == 'private' and journey['user_id'] != session['user_id']:
-            flash('You do not have permission to view this journey', 'error')
-            return redirect(url_for('traveller_home'))
-            
-        # Get all events for this journey
-        cursor.execute("""
-            SELECT * FROM events 
-            WHERE journey_id = %s 
-            ORDER BY start_time ASC
-        """, (journey_id,))
-        events = cursor.fetchall()
+    events, next_cursor = fetch_events_page(journey_id)
+    next_url = url_for('event.events_page', journey_id=journey_id, after=next_cursor) if next_cursor else None
         
-    return render_template('event/events.html', journey=journey, events=events)
+    return render_template('event/events.html', journey=journey, events=events, next_url=next_url)
+
+@bp.route('/journey/<int:journey_id>/events/page')
+@login_required
+def events_page(journey_id):
+    """One page of a journey's event timeline, for infinite scrolling.
+
+    Methods:
+    - get: Returns the page as JSON: `html` holds the rendered event cards,
+        and `next_url` the URL of the following page (or `null` on the last
+        page). Takes the `after` cursor from the previous page.
+    """
+    journey, error = authorization.authorize(authorization.VIEW, journey_id)
+    if not journey:
+        return jsonify(error=error), constants.HTTP_STATUS_CODE_404
+
+    after = pagination.decode_cursor(request.args.get(constants.PAGE_AFTER), _CURSOR_TYPES)
+    events, next_cursor = fetch_events_page(journey_id, after)
+    next_url = url_for('event.events_page', journey_id=journey_id, after=next_cursor) if next_cursor else None
+    html = render_template('event/event_cards.html', journey=journey, events=events, lazy_from=0)
+    return jsonify(html=html, next_url=next_url)
+
+@bp.route('/journey/<int:journey_id>/event/<int:event_id>/description')
+@login_required
+def event_description(journey_id, event_id):
+    """The full description of an event, for expanding a timeline card.
+
+    Methods:
+    - get: Returns `{"description": ...}` as JSON.
+    """
+    journey, error = authorization.authorize(authorization.VIEW, journey_id)
+    event = queries.fetch_one(queries.EVENT_DESCRIPTION, (event_id, journey_id)) if journey else None
+    if not event:
+        return jsonify(error=error or 'Event not found'), constants.HTTP_STATUS_CODE_404
+    return jsonify(description=event['description'])
+
+@bp.route('/journey/<int:journey_id>/events/export')
+@login_required
+def export_events(journey_id):
+    """Download a journey's events.
+
+    Methods:
+    - get: Streams the events as CSV, or as JSON Lines with `format=jsonl`
+        (see app/utils/event_io.py).
+    """
+    journey, error = authorization.authorize(authorization.VIEW, journey_id)
+    if not journey:
+        flash(error, 'error')
+        return redirect(url_for('traveller.traveller_home'))
+
+    file_format = event_io.detect_format(None, request.args.get('format', 'csv'))
+    if file_format is None:
+        flash('Unknown export format', 'error')
+        return redirect(url_for('event.view_events', journey_id=journey_id))
+
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(event_io.export_events(journey_id, file_format)),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=journey-{journey_id}-events.{file_format}'})
+
+@bp.route('/journey/<int:journey_id>/events/import', methods=['POST'])
+@login_required
+def import_events(journey_id):
+    """Add events to a journey in bulk from an uploaded CSV or JSON Lines
+    file (see app/utils/event_io.py). Nothing is imported if any row is
+    invalid; the problems are flashed with their line numbers instead.
 
-@app.route('/journey/<int:journey_id>/event/add', methods=['GET', 'POST'])
+    Args:
+        journey_id: The ID of the journey to add the events to
+    """
+    journey, _ = authorization.authorize(authorization.EDIT, journey_id)
+    if not journey:
+        flash('Journey not found or you do not have permission to add events', 'error')
+        return redirect(url_for('traveller.traveller_home'))
+
+    file = request.files.get('events_file')
+    file_format = event_io.detect_format(file.filename if file else None, request.form.get('format'))
+    if not file or not file.filename or file_format is None:
+        flash('Please choose a .csv or .jsonl file to import', 'error')
+        return redirect(url_for('event.view_events', journey_id=journey_id))
+
+    result = event_io.import_events(journey_id, file.stream, file_format,
+                                    current_app.config[constants.EVENT_IMPORT_MAX_ROWS])
+    if result.errors:
+        for line, error in result.errors[:10]:
+            flash(f'Line {line}: {error}' if line else error, 'error')
+        if len(result.errors) > 10:
+            flash(f'...and {len(result.errors) - 10} more problems. No events were imported.', 'error')
+        else:
+            flash('No events were imported.', 'error')
+    else:
+        flash(f'Imported {result.imported} events', 'success')
+    return redirect(url_for('event.view_events', journey_id=journey_id))
+
+@bp.route('/journey/<int:journey_id>/event/add', methods=['GET', 'POST'])
 @login_required
 def add_event(journey_id):
     """Add a new event to a journey.
@@ -58,16 +162,13 @@ def add_event(journey_id):
     Args:
         journey_id: The ID of the journey to add the event to
     """
-    with db.get_cursor() as cursor:
-        # Verify journey exists and user owns it
-        cursor.execute("SELECT * FROM journeys WHERE journey_id = %s AND user_id = %s", 
-                      (journey_id, session['user_id']))
-        journey = cursor.fetchone()
+    # Verify journey exists and user owns it
+    journey, _ = authorization.authorize(authorization.EDIT, journey_id)
+    
+    if not journey:
+        flash('Journey not found or you do not have permission to add events', 'error')
+        return redirect(url_for('traveller.traveller_home'))
         
-        if not journey:
-            flash('Journey not found or you do not have permission to add events', 'error')
-            return redirect(url_for('traveller_home'))
-            
     if request.method == 'POST':
         title = request.form.get('title')
         description = request.form.get('description')
@@ -75,32 +176,36 @@ def add_event(journey_id):
         end_time = request.form.get('end_time')
         location = request.form.get('location')
         
-        # Validate required fields
-        if not all([title, start_time, location]):
-            flash('Title, start time and location are required', 'error')
+        # Validate the fields (see app/utils/validators.py)
+        error = validators.EVENT_FORM.first_error(request.form)
+        if error:
+            flash(error, 'error')
             return render_template('event/event_form.html', journey=journey)
             
-        # Handle image upload if provided
+        # Handle image upload if provided (resized in the background, see
+        # app/utils/images.py)
         event_image = None
         if 'event_image' in request.files:
             file = request.files['event_image']
             if file and file.filename:
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config[constants.IMAGE_UPLOAD_FOLDER], filename))
-                event_image = filename
-                
-        with db.get_cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO events (journey_id, title, description, start_time, end_time, location, event_image)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (journey_id, title, description, start_time, end_time, location, event_image))
+                try:
+                    event_image = images.save_upload(file)
+                except images.InvalidImage as e:
+                    flash(str(e), 'error')
+                    return render_template('event/event_form.html', journey=journey)
+
+        # Count the reference before storing it (see app/db/image_refs.py)
+        image_refs.retain(event_image)
+        queries.insert(queries.INSERT_EVENT,
+                       (journey_id, title, description, start_time, end_time, location, event_image))
+        journey_feed.refresh(journey_id)
             
         flash('Event added successfully', 'success')
-        return redirect(url_for('view_events', journey_id=journey_id))
+        return redirect(url_for('event.view_events', journey_id=journey_id))
         
     return render_template('event/event_form.html', journey=journey)
 
-@app.route('/journey/<int:journey_id>/event/<int:event_id>/edit', methods=['GET', 'POST'])
+@bp.route('/journey/<int:journey_id>/event/<int:event_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_event(journey_id, event_id):
     """Edit an existing event.
@@ -109,20 +214,17 @@ def edit_event(journey_id, event_id):
         journey_id: The ID of the journey containing the event
         event_id: The ID of the event to edit
     """
-    with db.get_cursor() as cursor:
-        # Verify journey exists and user owns it
-        cursor.execute("""
-            SELECT j.*, e.* 
-            FROM journeys j 
-            JOIN events e ON j.journey_id = e.journey_id 
-            WHERE j.journey_id = %s AND e.event_id = %s AND j.user_id = %s
-        """, (journey_id, event_id, session['user_id']))
-        event = cursor.fetchone()
+    # Verify journey exists and user owns it; the event itself only needs
+    # fetching to fill in the form, since the UPDATE is conditional on it
+    # belonging to the journey
+    journey, _ = authorization.authorize(authorization.EDIT, journey_id)
+    event = queries.fetch_one(queries.EVENT_BY_ID, (event_id, journey_id)) \
+        if journey and request.method == 'GET' else None
+    
+    if not journey or (request.method == 'GET' and not event):
+        flash('Event not found or you do not have permission to edit it', 'error')
+        return redirect(url_for('traveller.traveller_home'))
         
-        if not event:
-            flash('Event not found or you do not have permission to edit it', 'error')
-            return redirect(url_for('traveller_home'))
-            
     if request.method == 'POST':
         title = request.form.get('title')
         description = request.form.get('description')
@@ -130,40 +232,95 @@ def edit_event(journey_id, event_id):
         end_time = request.form.get('end_time')
         location = request.form.get('location')
         
-        # Validate required fields
-        if not all([title, start_time, location]):
-            flash('Title, start time and location are required', 'error')
-            return render_template('event/event_form.html', event=event)
+        # Validate the fields (see app/utils/validators.py)
+        error = validators.EVENT_FORM.first_error(request.form)
+        if error:
+            flash(error, 'error')
+            return _render_edit_form(journey, event_id)
             
-        # Handle image upload if provided
-        event_image = event['event_image']
+        # Handle image upload if provided (resized in the background, see
+        # app/utils/images.py)
+        event_image = None
         if 'event_image' in request.files:
             file = request.files['event_image']
             if file and file.filename:
-                # Delete old image if it exists
-                if event_image:
-                    old_image_path = os.path.join(app.config[constants.IMAGE_UPLOAD_FOLDER], event_image)
-                    if os.path.exists(old_image_path):
-                        os.remove(old_image_path)
-                        
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config[constants.IMAGE_UPLOAD_FOLDER], filename))
-                event_image = filename
-                
-        with db.get_cursor() as cursor:
-            cursor.execute("""
-                UPDATE events 
-                SET title = %s, description = %s, start_time = %s, end_time = %s, 
-                    location = %s, event_image = %s
-                WHERE event_id = %s AND journey_id = %s
-            """, (title, description, start_time, end_time, location, event_image, event_id, journey_id))
+                try:
+                    event_image = images.save_upload(file)
+                except images.InvalidImage as e:
+                    flash(str(e), 'error')
+                    return _render_edit_form(journey, event_id)
+
+        values = (title, description, start_time, end_time, location)
+        if event_image is None:
+            updated = queries.execute(queries.UPDATE_EVENT, (*values, event_id, journey_id))
+        else:
+            # Count the new image's reference before storing it, and release
+            # the old one's after (see app/db/image_refs.py)
+            image_refs.retain(event_image)
+            updated, old_image = write_event(queries.UPDATE_EVENT_WITH_IMAGE,
+                                             (*values, event_image, event_id, journey_id),
+                                             event_id, journey_id)
+            image_refs.release(old_image if updated else event_image)
+        if not updated:
+            flash('Event not found', 'error')
+            return redirect(url_for('event.view_events', journey_id=journey_id))
+        journey_feed.refresh(journey_id)
             
         flash('Event updated successfully', 'success')
-        return redirect(url_for('view_events', journey_id=journey_id))
+        return redirect(url_for('event.view_events', journey_id=journey_id))
         
-    return render_template('event/event_form.html', event=event)
+    return render_template('event/event_form.html', journey=journey, event=event)
+
+def write_event(query, params, event_id, journey_id):
+    """Update or delete an event, and read the image it had, in a single round
+    trip. The row is locked between the read and the write, so the image read
+    is the one the write replaced.
 
-@app.route('/journey/<int:journey_id>/event/<int:event_id>/delete', methods=['POST'])
+    Args:
+        query: The UPDATE or DELETE (conditional on the event's ID and journey)
+        params: Parameters of `query`
+        event_id: The ID of the event
+        journey_id: The ID of the journey containing the event
+
+    Returns:
+        A `(rows, old_image)` tuple: the number of events written (0 if the
+        event isn't in the journey), and the event's image before the write.
+    """
+    _, old, rows, _ = db.run_batch(('START TRANSACTION', None),
+                                   (queries.LOCK_EVENT_IMAGE.sql, (event_id, journey_id)),
+                                   (query.sql, params),
+                                   ('COMMIT', None))
+    return rows, old[0]['event_image'] if old else None
+
+def _render_edit_form(journey, event_id):
+    """Re-render the edit form after a rejected submission, showing the values
+    the user entered over the stored event.
+
+    Args:
+        journey: The journey containing the event
+        event_id: The ID of the event being edited
+    """
+    event = queries.fetch_one(queries.EVENT_BY_ID, (event_id, journey['journey_id']))
+    if not event:
+        flash('Event not found', 'error')
+        return redirect(url_for('event.view_events', journey_id=journey['journey_id']))
+    for field in ('title', 'description', 'location'):
+        if field in request.form:
+            event[field] = request.form[field]
+    # The form shows the times with `strftime`, so only replace them with
+    # submitted values that parse (the end time is optional and can be cleared)
+    for field in ('start_time', 'end_time'):
+        value = request.form.get(field)
+        if value:
+            try:
+                event[field] = datetime.fromisoformat(value)
+            except ValueError:
+                pass
+        elif field == 'end_time':
+            event[field] = None
+    return render_template('event/event_form.html', journey=journey, event=event)
+
+@bp.route('/journey/<int:journey_id>/event/<int:event_id>/delete', methods=['POST'])
 @login_required
 def delete_event(journey_id, event_id):
     """Delete an event.
@@ -172,29 +329,20 @@ def delete_event(journey_id, event_id):
         journey_id: The ID of the journey containing the event
         event_id: The ID of the event to delete
     """
-    with db.get_cursor() as cursor:
-        # Verify journey exists and user owns it
-        cursor.execute("""
-            SELECT j.*, e.* 
-            FROM journeys j 
-            JOIN events e ON j.journey_id = e.journey_id 
-            WHERE j.journey_id = %s AND e.event_id = %s AND j.user_id = %s
-        """, (journey_id, event_id, session['user_id']))
-        event = cursor.fetchone()
-        
-        if not event:
-            flash('Event not found or you do not have permission to delete it', 'error')
-            return redirect(url_for('traveller_home'))
-            
-        # Delete event image if it exists
-        if event['event_image']:
-            image_path = os.path.join(app.config[constants.IMAGE_UPLOAD_FOLDER], event['event_image'])
-            if os.path.exists(image_path):
-                os.remove(image_path)
-                
-        # Delete the event
-        cursor.execute("DELETE FROM events WHERE event_id = %s AND journey_id = %s", 
-                      (event_id, journey_id))
+    # Verify journey exists and user owns it; the DELETE is conditional on the
+    # event belonging to the journey
+    journey, _ = authorization.authorize(authorization.EDIT, journey_id)
+    deleted, old_image = write_event(queries.DELETE_EVENT, (event_id, journey_id),
+                                     event_id, journey_id) if journey else (0, None)
+    
+    if not deleted:
+        flash('Event not found or you do not have permission to delete it', 'error')
+        return redirect(url_for('traveller.traveller_home'))
         
+    # Release the deleted event's image (the file is deleted by `flask images
+    # gc` once nothing refers to it)
+    image_refs.release(old_image)
+    journey_feed.refresh(journey_id)
+    
     flash('Event deleted successfully', 'success')
-    return redirect(url_for('view_events', journey_id=journey_id)) 
\ No newline at end of file
+    return redirect(url_for('event.view_events', journey_id=journey_id)) 
\ No newline at end of file
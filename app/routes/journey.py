@@ -0,0 +1,44 @@
+"""
+Module: Public Journey Routes
+
+This module defines the endpoints for browsing the public journeys of all
+travellers, most recently updated first (see app/db/journey_feed.py).
+"""
+from flask import Blueprint, jsonify, render_template, request, url_for
+from app.config import constants
+from app.db import journey_feed
+from app.utils import pagination
+from app.utils.decorators import login_required
+
+bp = Blueprint('journey', __name__)
+
+@bp.route('/journeys')
+@login_required
+def public_journeys():
+    """The first page of the public journey feed. Later pages are loaded as
+    the user scrolls (see `public_journeys_page`).
+
+    Methods:
+    - get: Renders the feed.
+    """
+    per_page = pagination.page_size(request.args.get(constants.PAGE_SIZE), constants.FEED_PAGE_SIZE)
+    journeys, next_cursor = journey_feed.fetch_page(per_page)
+    next_url = url_for('journey.public_journeys_page', after=next_cursor, per_page=per_page) if next_cursor else None
+    return render_template(constants.TEMPLATE_JOURNEY_FEED, journeys=journeys, next_url=next_url)
+
+@bp.route('/journeys/page')
+@login_required
+def public_journeys_page():
+    """One page of the public journey feed, for infinite scrolling.
+
+    Methods:
+    - get: Returns the page as JSON: `html` holds the rendered journey cards,
+        and `next_url` the URL of the following page (or `null` on the last
+        page). Takes the `after` cursor from the previous page.
+    """
+    per_page = pagination.page_size(request.args.get(constants.PAGE_SIZE), constants.FEED_PAGE_SIZE)
+    after = pagination.decode_cursor(request.args.get(constants.PAGE_AFTER), journey_feed.CURSOR_TYPES)
+    journeys, next_cursor = journey_feed.fetch_page(per_page, after)
+    next_url = url_for('journey.public_journeys_page', after=next_cursor, per_page=per_page) if next_cursor else None
+    html = render_template(constants.TEMPLATE_JOURNEY_FEED_CARDS, journeys=journeys, lazy_from=0)
+    return jsonify(html=html, next_url=next_url)
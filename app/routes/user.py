@@ -1,21 +1,19 @@
-from app import app
-from flask import redirect, render_template, request, session, url_for, flash
+from flask import Blueprint, current_app, jsonify, redirect, render_template, request, session, url_for, flash
 from app.config import constants
 from app.config.constants import DEFAULT_USER_ROLE, DEFAULT_STATUS
-from app.utils.decorators import if_logged_in_redirect, login_required
-from app.db import db
-from flask_bcrypt import Bcrypt
+from app.utils.decorators import if_logged_in_redirect, login_required, rate_limited
+from app.db import db, image_refs, queries, user_cache
 from app.utils.helpers import allowed_file
-from werkzeug.utils import secure_filename
-import re, os
-from app.utils.validators import validate_firstname, validate_lastname, validate_email, validate_password, \
-    validate_repassword, validate_location, validate_username, validate_personal_description
+from app.utils import images, passwords, rate_limit
+from app.search import users as user_search
+import re
+from app.utils import validators
+from mysql.connector import errorcode
+from mysql.connector.errors import IntegrityError
 
-# Create an instance of the Bcrypt class, which we'll be using to hash user
-# passwords during login and registration.
-flask_bcrypt = Bcrypt(app)
+bp = Blueprint('user', __name__)
 
-@app.route('/')
+@bp.route('/')
 def root():
     """Root endpoint (/)
     
@@ -24,7 +22,7 @@ def root():
         their own role-specific homepage.
     """
     if not session.get(constants.SESSION_LOGGED_IN):
-        return redirect(url_for('login'))
+        return redirect(url_for('user.login'))
     return redirect(user_home_url())
 
 def user_home_url():
@@ -45,8 +43,9 @@ def user_home_url():
     
     return url_for(home_endpoint)
 
-@app.route('/login', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
+@bp.route('/login', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
 @if_logged_in_redirect
+@rate_limited('login', constants.TEMPLATE_LOGIN)
 def login():
     """Handles user login.
     
@@ -74,40 +73,44 @@ def login():
 
         try:
             # Attempt to validate the login details against the database.
-            with db.get_cursor() as cursor:
-                cursor.execute('''
-                            SELECT user_id, username, password_hash, role, status
-                            FROM users
-                            WHERE username = %s;
-                            ''', (username,))
-                account = cursor.fetchone()
-                if account is not None:
-                    # Banned users cannot log in.
-                    if account[constants.USER_STATUS]==constants.USER_STATUS_BANNED:
-                        # No matching username found in the database.
-                        flash("User is banned, cannot log in", constants.FLASH_MESSAGE_DANGER)
-                        return render_template(constants.TEMPLATE_LOGIN, username=username)
-                    # Retrieve stored password hash from the database.
-                    password_hash = account[constants.PASSWORD_HASH]
-                    # Verify the provided password against the stored hash.
-                    if flask_bcrypt.check_password_hash(password_hash, password):
-                        # Authentication successful: store user session data.
-                        session[constants.SESSION_LOGGED_IN] = True
-                        session[constants.USER_ID] = account[constants.USER_ID]
-                        session[constants.USERNAME] = account[constants.USERNAME]
-                        session[constants.USER_ROLE] = account[constants.USER_ROLE]
-
-                        return redirect(user_home_url())
-                    else:
-                        # Password is incorrect. Re-display the login form, keeping
-                        # the username provided by the user so they don't need to re-enter it. 
-                        flash("Incorrect username or password", constants.FLASH_MESSAGE_DANGER)
-                        return render_template(constants.TEMPLATE_LOGIN,
-                                            username=username)
-                else:
+            account = queries.fetch_one(queries.USER_LOGIN_BY_USERNAME, (username,))
+            if account is not None:
+                # Banned users cannot log in.
+                if account[constants.USER_STATUS]==constants.USER_STATUS_BANNED:
                     # No matching username found in the database.
+                    flash("User is banned, cannot log in", constants.FLASH_MESSAGE_DANGER)
+                    return render_template(constants.TEMPLATE_LOGIN, username=username)
+                # Retrieve stored password hash from the database.
+                password_hash = account[constants.PASSWORD_HASH]
+                # Verify the provided password against the stored hash.
+                if passwords.check_password(password_hash, password):
+                    # Bring hashes made with an old cost factor up to date.
+                    if passwords.needs_rehash(password_hash):
+                        passwords.rehash_in_background(account[constants.USER_ID], password_hash, password)
+
+                    # Authentication successful: store user session data.
+                    session[constants.SESSION_LOGGED_IN] = True
+                    session[constants.USER_ID] = account[constants.USER_ID]
+                    session[constants.USERNAME] = account[constants.USERNAME]
+                    session[constants.USER_ROLE] = account[constants.USER_ROLE]
+                    session[constants.USER_STATUS] = account[constants.USER_STATUS]
+                    # Issue a new session ID now that the user is logged in.
+                    session.regenerate()
+
+                    return redirect(user_home_url())
+                else:
+                    # Password is incorrect. Re-display the login form, keeping
+                    # the username provided by the user so they don't need to re-enter it. 
                     flash("Incorrect username or password", constants.FLASH_MESSAGE_DANGER)
-                    return render_template(constants.TEMPLATE_LOGIN,username=username)
+                    return render_template(constants.TEMPLATE_LOGIN,
+                                        username=username)
+            else:
+                # No matching username found in the database.
+                flash("Incorrect username or password", constants.FLASH_MESSAGE_DANGER)
+                return render_template(constants.TEMPLATE_LOGIN,username=username)
+        except passwords.HasherBusy:
+            # Let the app's error handler send a 503.
+            raise
         except Exception as e:
             flash("An error occurred while processing your request. Please try again", constants.FLASH_MESSAGE_DANGER)
             print(e)
@@ -124,8 +127,9 @@ DEFAULT_ROLE = 'traveller'
 DEFAULT_SHAREABLE = '1'
 DEFAULT_STATUS = 'active'
 
-@app.route('/signup', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
+@bp.route('/signup', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
 @if_logged_in_redirect
+@rate_limited('signup', constants.TEMPLATE_SIGN_UP)
 def signup():
     """Signup (registration) page endpoint.
 
@@ -155,65 +159,57 @@ def signup():
         last_name = request.form[constants.LAST_NAME]
         location = request.form[constants.LOCATION]
 
-        # We start by assuming that everything is okay. If we encounter any
-        # errors during validation, we'll store an error message in one or more
-        # of these variables so we can pass them through to the template.
-        username_error = None
-        email_error = None
-        password_error = None
-        confirm_password_error = None
-        last_name_error = None
-        first_name_error = None
-        location_error = None
-
-        # Validate the username, email, password and confirm password
-        # to ensure they meet the constraints of our web app.
-        username_error = validate_username(username)
-        email_error = validate_email(email, constants.URL_SIGNUP, '')
-        password_error = validate_password(password)
-        confirm_password_error =  validate_repassword(password, confirm_password)
-        
-        # First name, last name and location are optional. If user provided, 
-        # validate each of them to ensure they meet the constraints.
-        if first_name:
-            first_name_error = validate_firstname(first_name)
-        if last_name:
-            last_name_error = validate_lastname(last_name)
-        if location:
-            location_error = validate_location(location)
-
-        # One or more errors were encountered, so send the user back to the
-        # signup page with their username, email, first name, last name and location pre-populated.
-        # For security reasons, we never send back the password they chose.
-        # Error messages will also be returned to display on the form.
-        if username_error or password_error or confirm_password_error or email_error or first_name_error or last_name_error or location_error:
+        # Validate every field to ensure they meet the constraints of our web
+        # app (see app/utils/validators.py); `errors` holds the error message
+        # of each field that doesn't. First name, last name and location are
+        # optional. Whether the username and email are already taken is left
+        # to the UNIQUE constraints on `users` (see below).
+        errors = validators.SIGNUP_FORM.validate(request.form)
+
+        user_id = None
+        if not errors:
+            # The new account details are valid. Hash the user's new password
+            # and create their account in the database.
+            password_hash = passwords.hash_password(password)
+
+            try:
+                user_id = queries.insert(queries.INSERT_USER,
+                    (username, password_hash, email, first_name.strip() if first_name else "", last_name.strip() if last_name else "", location.strip() if location else "", DEFAULT_PROFILE_IMAGE, DEFAULT_PERSONAL_DESCRIPTION, DEFAULT_ROLE, DEFAULT_SHAREABLE, DEFAULT_STATUS,))
+            except IntegrityError as e:
+                if e.errno != errorcode.ER_DUP_ENTRY:
+                    raise
+                # The username or email is taken: a single query finds out
+                # which (possibly both).
+                taken = queries.fetch_one(queries.USERNAME_EMAIL_TAKEN, (username, email))
+                if taken['username_taken']:
+                    errors[constants.USERNAME] = validators.USERNAME_TAKEN
+                if taken['email_taken']:
+                    errors[constants.EMAIL] = validators.EMAIL_TAKEN
+                if not errors:
+                    # The duplicate has gone again since the insert: report
+                    # it against the username.
+                    errors[constants.USERNAME] = validators.USERNAME_TAKEN
+
+        if user_id is None:
+            # One or more errors were encountered, so send the user back to the
+            # signup page with their username, email, first name, last name and location pre-populated.
+            # For security reasons, we never send back the password they chose.
+            # Error messages will also be returned to display on the form, as
+            # username_error, email_error, password_error and so on.
             return render_template('signup.html',
                                    username = username,
                                    email = email,
                                    first_name = first_name,
                                    last_name = last_name,
                                    location = location,
-
-                                   username_error = username_error,
-                                   email_error = email_error,
-                                   password_error = password_error,
-                                   confirm_password_error = confirm_password_error,
-                                   first_name_error = first_name_error,
-                                   last_name_error = last_name_error,
-                                   location_error = location_error,
-                                   )
+                                   **{f'{field}_error': error for field, error in errors.items()})
 
         else:
-            # The new account details are valid. Hash the user's new password
-            # and create their account in the database.
-            password_hash = flask_bcrypt.generate_password_hash(password)
-
-            with db.get_cursor() as cursor:
-                cursor.execute('''
-                            INSERT INTO users (username, password_hash, email, first_name, last_name, location, profile_image, personal_description, role, shareable, status)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                            ''',
-                            (username, password_hash, email, first_name.strip() if first_name else "", last_name.strip() if last_name else "", location.strip() if location else "", DEFAULT_PROFILE_IMAGE, DEFAULT_PERSONAL_DESCRIPTION, DEFAULT_ROLE, DEFAULT_SHAREABLE, DEFAULT_STATUS,))
+            user_cache.remember_username(username, user_id)
+            user_search.index_user(dict(user_id=user_id, username=username, email=email,
+                                        first_name=first_name.strip() if first_name else "",
+                                        last_name=last_name.strip() if last_name else "",
+                                        role=DEFAULT_ROLE, status=DEFAULT_STATUS))
             
             # Registration is complete, send the user back to the signup page.
             # We set the `signup_successful` flag to display a post-signup message.
@@ -224,8 +220,33 @@ def signup():
     # error messages.
     return render_template(constants.TEMPLATE_SIGN_UP)
 
+@bp.route('/signup/username_available', methods=[constants.HTTP_METHOD_GET])
+def username_available():
+    """Username availability endpoint, for checking the signup form's
+    username as the user types.
 
-@app.route('/profile', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
+    Methods:
+    - get: Returns `{"available": true}` if the `username` query parameter
+        can be signed up with, or `{"available": false, "error": ...}` with
+        the reason it can't. Answered from the user cache where possible (see
+        `user_cache.username_taken`); the signup itself still checks.
+        Limited per IP address, so it can't be used to list usernames
+        quickly: refused checks get a 429 response.
+    """
+    retry_after = rate_limit.check('username_check', {rate_limit.KEY_IP: request.remote_addr})
+    if retry_after is not None:
+        return (jsonify(error="Too many checks. Please wait a minute and try again."),
+                constants.HTTP_STATUS_CODE_429, {'Retry-After': str(retry_after)})
+    username = request.args.get(constants.USERNAME, '')
+    error = validators.USERNAME.error(username)
+    if not error and user_cache.username_taken(username):
+        error = validators.USERNAME_TAKEN
+    if error:
+        return jsonify(available=False, error=error)
+    return jsonify(available=True)
+
+
+@bp.route('/profile', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
 @login_required
 def profile():
     """User Profile page endpoint.
@@ -237,25 +258,27 @@ def profile():
     """
     if request.method == constants.HTTP_METHOD_GET:
         # Retrieve user profile from the database.
-        with db.get_cursor() as cursor:
-            cursor.execute(
-                "SELECT user_id, username, email, first_name, last_name, location, profile_image, role FROM users WHERE user_id = %s;",
-                (session[constants.USER_ID],))
-            profile = cursor.fetchone()
-            return render_template(constants.TEMPLATE_PROFILE, profile=profile)
+        profile = user_cache.get_user(session[constants.USER_ID])
+        return render_template(constants.TEMPLATE_PROFILE, profile=profile)
     elif request.method == constants.HTTP_METHOD_POST:
-        user_id = request.form.get(constants.USER_ID)
+        # Only ever update the logged-in user's own profile (the form's hidden
+        # user ID is not trusted)
+        user_id = session[constants.USER_ID]
         username = request.form.get(constants.USERNAME)
         email = request.form.get(constants.EMAIL)
         first_name = request.form.get(constants.FIRST_NAME)
         last_name = request.form.get(constants.LAST_NAME)
         location = request.form.get(constants.LOCATION)
         personal_description = request.form.get(constants.USER_PERSONAL_DESCRIPTION)
-        email_error = validate_email(email, constants.URL_PROFILE, user_id)
-        firstname_error = validate_firstname(first_name)
-        lastname_error = validate_lastname(last_name)
-        location_error = validate_location(location)
-        personal_description_error = validate_personal_description(personal_description)
+        errors = validators.PROFILE_FORM.validate(request.form)
+        # Allow user to keep their own email, but prevent duplicates
+        if constants.EMAIL not in errors and validators.email_taken(email, user_id):
+            errors[constants.EMAIL] = validators.EMAIL_TAKEN
+        email_error = errors.get(constants.EMAIL)
+        firstname_error = errors.get(constants.FIRST_NAME)
+        lastname_error = errors.get(constants.LAST_NAME)
+        location_error = errors.get(constants.LOCATION)
+        personal_description_error = errors.get(constants.USER_PERSONAL_DESCRIPTION)
 
         if (email_error or firstname_error or lastname_error or location_error or personal_description_error):
             profile = {
@@ -277,21 +300,21 @@ def profile():
                                    location_error=location_error,
                                    personal_description_error=personal_description_error)
         else:
-            with db.get_cursor() as cursor:
-                cursor.execute("UPDATE users SET first_name=%s, last_name=%s, email=%s, location=%s, personal_description=%s WHERE user_id=%s;",
-                               (first_name.strip() if first_name else "", last_name.strip() if last_name else "", email, location.strip() if location else "", personal_description.strip() if personal_description else "", user_id))
-
-            # retrieve new profile details again
-            with db.get_cursor() as cursor:
-                cursor.execute(
-                    "SELECT user_id, username, email, first_name, last_name, location, profile_image, role, personal_description FROM users WHERE user_id = %s;",
-                    (session[constants.USER_ID],))
-                profile = cursor.fetchone()
+            # Update the profile and retrieve the new profile details in a
+            # single round trip.
+            _, profiles = db.run_batch(
+                (queries.UPDATE_USER_PROFILE.sql,
+                 (first_name.strip() if first_name else "", last_name.strip() if last_name else "", email, location.strip() if location else "", personal_description.strip() if personal_description else "", user_id)),
+                (queries.USER_BY_ID.sql, (user_id,)))
+            profile = profiles[0] if profiles else None
+            if profile is not None:
+                user_cache.remember_user(profile)
+                user_search.index_user(profile)
 
             return render_template(constants.TEMPLATE_PROFILE, profile=profile, profile_update_successful=True)
 
 
-@app.route('/profile/change_password', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
+@bp.route('/profile/change_password', methods=[constants.HTTP_METHOD_GET, constants.HTTP_METHOD_POST])
 @login_required
 def change_password():
     user_id = session[constants.USER_ID]
@@ -307,29 +330,30 @@ def change_password():
         confirm_password = request.form.get(constants.FORM_FIELD_CONFIRM_PASSWORD)
 
         # Check if the entered current password matches the password in the database
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT password_hash FROM users WHERE user_id = %s;', (user_id,))
-            user = cursor.fetchone()
+        user = queries.fetch_one(queries.USER_PASSWORD_HASH_BY_ID, (user_id,))
 
-            if not user:
-                current_password_error = "User not found."
+        if not user:
+            current_password_error = "User not found."
+        else:
+            old_hashed_password = user[constants.PASSWORD_HASH]
+
+            # Check if the current password is correct. This is the only
+            # bcrypt check: once it passes, the submitted current password is
+            # known to be the stored one, so the new password can simply be
+            # compared with it.
+            if not passwords.check_password(old_hashed_password, current_password or ''):
+                current_password_error = "Current password is incorrect."
             else:
-                old_hashed_password = user[constants.PASSWORD_HASH]
-
-                # Check if the current password is correct
-                if not flask_bcrypt.check_password_hash(old_hashed_password, current_password):
-                    current_password_error = "Current password is incorrect."
-                else:
-                    # Validate new password and confirm password
-                    new_password_error = validate_password(new_password)
-                    confirm_password_error = validate_password(confirm_password)
-                    confirm_password_error = validate_repassword(new_password, confirm_password)
+                # Validate new password and confirm password
+                errors = validators.CHANGE_PASSWORD_FORM.validate(request.form)
+                new_password_error = errors.get(constants.FORM_FIELD_NEW_PASSWORD)
+                confirm_password_error = errors.get(constants.FORM_FIELD_CONFIRM_PASSWORD)
 
-                    # Check if new password is the same as the current password
-                    if flask_bcrypt.check_password_hash(old_hashed_password, new_password):
-                        new_password_error = 'The new password cannot be the same as the current password. Please enter a new password.'
-                    if flask_bcrypt.check_password_hash(old_hashed_password, confirm_password):
-                        confirm_password_error = 'The new password cannot be the same as the current password. Please enter a new password.'
+                # Check if new password is the same as the current password
+                if new_password == current_password:
+                    new_password_error = 'The new password cannot be the same as the current password. Please enter a new password.'
+                if confirm_password == current_password:
+                    confirm_password_error = 'The new password cannot be the same as the current password. Please enter a new password.'
 
         # If there are any errors, return the form with errors
         if current_password_error or new_password_error or confirm_password_error:
@@ -345,16 +369,15 @@ def change_password():
 
         # If no errors, update the password
         if not (current_password_error or new_password_error or confirm_password_error):
-            password_hash = flask_bcrypt.generate_password_hash(new_password)
+            password_hash = passwords.hash_password(new_password)
 
-            with db.get_cursor() as cursor:
-                cursor.execute("UPDATE users SET password_hash=%s WHERE user_id=%s;", (password_hash, user_id))
+            queries.execute(queries.UPDATE_USER_PASSWORD, (password_hash, user_id))
 
             return render_template(constants.TEMPLATE_CHANGE_PASSWORD, user_id=user_id, update_successful=True)
 
     return render_template(constants.TEMPLATE_CHANGE_PASSWORD)
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     """Logout endpoint.
@@ -363,21 +386,15 @@ def logout():
     - get: Logs the current user out (if they were logged in to begin with),
         and redirects them to the login page.
     """
-    # Note that nothing actually happens on the server when a user logs out: we
-    # just remove the cookie from their web browser. They could technically log
-    # back in by manually restoring the cookie we've just deleted. In a high-
-    # security web app, you may need additional protections against this (e.g.
-    # keeping a record of active sessions on the server side).
-    session.pop(constants.SESSION_LOGGED_IN, None)
-    session.pop(constants.USER_ID, None)
-    session.pop(constants.USERNAME, None)
-    session.pop(constants.USER_ROLE, None)
+    # Sessions are kept on the server (see app/utils/sessions.py), so emptying
+    # the session ends it there too: restoring the old cookie won't log the
+    # user back in.
+    session.clear()
 
     return redirect(url_for(constants.URL_LOGIN))
 
 
-app.config[constants.IMAGE_UPLOAD_FOLDER] = os.path.join(app.root_path, constants.IMAGE_UPLOAD_FOLDER_URL)
-@app.route('/profile/upload_image', methods=[constants.HTTP_METHOD_GET,constants.HTTP_METHOD_POST])
+@bp.route('/profile/upload_image', methods=[constants.HTTP_METHOD_GET,constants.HTTP_METHOD_POST])
 @login_required
 def upload_image():
     user_id = session.get(constants.USER_ID)
@@ -385,27 +402,33 @@ def upload_image():
 
     # access the image file
     if request.method == constants.HTTP_METHOD_POST:
-        profile_image = request.files[constants.USER_PROFILE_IMAGE]
+        profile = user_cache.get_user(user_id)
+        if profile is None:
+            # The account was deleted since the user logged in.
+            session.clear()
+            flash("User not found. Please log in again.", constants.FLASH_MESSAGE_DANGER)
+            return redirect(url_for(constants.URL_LOGIN))
 
-        # validate if the image extension is valid
-        if not allowed_file(profile_image.filename):
-            image_error = 'Invalid file type. Please choose an image.'
+        profile_image = request.files[constants.USER_PROFILE_IMAGE]
 
-            with db.get_cursor() as cursor:
-                cursor.execute("SELECT * FROM users WHERE user_id = %s;", (user_id,))
-                profile = cursor.fetchone()
+        # validate the image, and stage it to be resized in the background
+        # (see app/utils/images.py)
+        try:
+            if not allowed_file(profile_image.filename):
+                raise images.InvalidImage('Invalid file type. Please choose an image.')
+            profile_image_name = images.save_upload(profile_image)
+        except images.InvalidImage as e:
+            image_error = str(e)
 
             return render_template(constants.TEMPLATE_PROFILE, user_id = user_id, profile = profile, image_error = image_error)
 
-        # retrieve the file name
-        profile_image_name = secure_filename(profile_image.filename)
-
-        # save image to the folder
-        profile_image_path = os.path.join(app.config[constants.IMAGE_UPLOAD_FOLDER], profile_image_name)
-        profile_image.save(profile_image_path)
-
-        with db.get_cursor() as cursor:
-            cursor.execute("UPDATE users SET profile_image=%s WHERE user_id = %s;",(profile_image_name, user_id))
+        # count the new reference before storing it, and release the old one
+        # after (see app/db/image_refs.py)
+        old_image = profile[constants.USER_PROFILE_IMAGE]
+        image_refs.retain(profile_image_name)
+        queries.execute(queries.UPDATE_USER_PROFILE_IMAGE, (profile_image_name, user_id))
+        user_cache.invalidate_user(user_id)
+        image_refs.release(old_image)
         return redirect(url_for(constants.URL_PROFILE))
 
     return render_template(constants.TEMPLATE_PROFILE, user_id = user_id)
@@ -419,36 +442,41 @@ def fetch_profile():
         not logged in.
     """
     if 'loggedin' in session:
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT username, email, first_name as firstname, last_name as lastname, location, role, profile_image FROM users WHERE user_id = %s;',
-                           (session[constants.USER_ID],))
-            profile = cursor.fetchone()
+        profile = user_cache.get_user(session[constants.USER_ID])
+        if profile is not None:
+            # Callers expect the names under these keys.
+            profile['firstname'] = profile[constants.FIRST_NAME]
+            profile['lastname'] = profile[constants.LAST_NAME]
         return profile
     else:
         return None
 
 
-@app.route('/profile/remove_image', methods=[constants.HTTP_METHOD_POST])
+@bp.route('/profile/remove_image', methods=[constants.HTTP_METHOD_POST])
 @login_required
 def remove_image():
     user_id = session.get(constants.USER_ID)
 
     # query the user's profile image file name
-    with db.get_cursor() as cursor:
-        cursor.execute("SELECT profile_image FROM users WHERE user_id = %s;", (user_id,))
-        profile_image = cursor.fetchone()
-        profile_image = profile_image[constants.USER_PROFILE_IMAGE]
+    profile = user_cache.get_user(user_id)
+    if profile is None:
+        # The account was deleted since the user logged in.
+        session.clear()
+        flash("User not found. Please log in again.", constants.FLASH_MESSAGE_DANGER)
+        return redirect(url_for(constants.URL_LOGIN))
+    profile_image = profile[constants.USER_PROFILE_IMAGE]
 
     if profile_image is not None:
-        os.remove(os.path.join(app.config[constants.IMAGE_UPLOAD_FOLDER], profile_image))
+        queries.execute(queries.UPDATE_USER_PROFILE_IMAGE, (None, user_id))
+        user_cache.invalidate_user(user_id)
 
-        with db.get_cursor() as cursor:
-            cursor.execute("UPDATE users SET profile_image = NULL WHERE user_id = %s;", (user_id,))
+        # the file is deleted by `flask images gc` once nothing refers to it
+        image_refs.release(profile_image)
 
     return redirect(url_for(constants.URL_PROFILE))
 
 
-@app.route('/profile/avatar/<username>')
+@bp.route('/profile/avatar/<username>')
 @login_required
 def preview_avatar(username):
     """Preview avatar for a specific user based on the username."""
@@ -458,17 +486,11 @@ def preview_avatar(username):
 
     # Retrieve user profile from the database based on the username
     try:
-        with db.get_cursor() as cursor:
-            cursor.execute('''
-                SELECT username, email, first_name as firstname, last_name as lastname, location, role, profile_image
-                FROM users
-                WHERE username = %s;
-            ''', (username,))
-            profile = cursor.fetchone()
-            if not profile or profile[constants.USER_PROFILE_IMAGE] is None:
-                return render_template(constants.TEMPLATE_AVATAR_PREVIEW, error='User not found or no profile image found.'), constants.HTTP_STATUS_CODE_404
+        profile = user_cache.get_user_by_username(username)
+        if not profile or profile[constants.USER_PROFILE_IMAGE] is None:
+            return render_template(constants.TEMPLATE_AVATAR_PREVIEW, error='User not found or no profile image found.'), constants.HTTP_STATUS_CODE_404
     except Exception as e:
-        app.logger.error(f"Error retrieving user details for {username}: {e}")
+        current_app.logger.error(f"Error retrieving user details for {username}: {e}")
         return render_template(constants.TEMPLATE_AVATAR_PREVIEW, error=str(e)), constants.HTTP_STATUS_CODE_500
 
     return render_template(constants.TEMPLATE_AVATAR_PREVIEW, profile=profile)
\ No newline at end of file
@@ -0,0 +1,10 @@
+"""
+Search package.
+
+Admin user search, without `LIKE '%term%'` table scans:
+    - `index.py`: a generic n-gram inverted index of user rows.
+    - `users.py`: the admin user search built on it, and how it's kept up to
+      date.
+    - `planner.py`: multi-field user filters with role and status facets,
+      compiled into a single index-friendly SQL query.
+"""
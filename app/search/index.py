@@ -0,0 +1,187 @@
+"""N-gram inverted index over the searchable fields of `users` rows.
+
+Every searchable field of every user is lowercased and split into its n-grams
+(all substrings of length 1 to `NGRAM`), and each n-gram maps to the set of
+user_ids whose field contains it. To find the users whose field contains a
+search term, the posting sets of the term's n-grams are intersected, smallest
+first, which narrows the candidates down without looking at any other users;
+the few candidates left are then checked against the full term (two n-grams
+can both appear in a value without the term appearing in it).
+
+Matches are ranked by how well the term matches each field: a whole-field
+match beats a prefix match, which beats a word-prefix match, which beats any
+other substring match, and fields such as the username count for more than
+the email address.
+"""
+import threading
+
+# Longest n-gram indexed. Terms longer than this are looked up by all of
+# their NGRAM-long substrings.
+NGRAM = 3
+
+# Searchable fields and their ranking weights. `full_name` is derived from
+# `first_name` and `last_name`.
+FIELD_WEIGHTS = {
+    'username': 4,
+    'full_name': 3,
+    'first_name': 2,
+    'last_name': 2,
+    'email': 1,
+}
+
+# Scores for each kind of match, multiplied by the field's weight.
+_EXACT, _PREFIX, _WORD_PREFIX, _SUBSTRING = 8, 4, 2, 1
+
+def ngrams(text: str):
+    """Returns the set of n-grams (lengths 1 to `NGRAM`) of `text`."""
+    return {text[i:i + n] for n in range(1, NGRAM + 1) for i in range(len(text) - n + 1)}
+
+def _search_key(term: str):
+    """Returns the n-grams used to look `term` up: the term itself if it is
+    short enough, otherwise its `NGRAM`-long substrings."""
+    if len(term) <= NGRAM:
+        return {term}
+    return {term[i:i + NGRAM] for i in range(len(term) - NGRAM + 1)}
+
+def _field_values(row):
+    """Returns the lowercased searchable values of a row, keyed by field."""
+    first = (row.get('first_name') or '').strip()
+    last = (row.get('last_name') or '').strip()
+    values = {
+        'username': row.get('username') or '',
+        'full_name': f'{first} {last}'.strip(),
+        'first_name': first,
+        'last_name': last,
+        'email': row.get('email') or '',
+    }
+    return {field: value.lower() for field, value in values.items()}
+
+def _match_score(value: str, term: str):
+    """Returns how well `term` matches `value` (0 for no match)."""
+    if value == term:
+        return _EXACT
+    if value.startswith(term):
+        return _PREFIX
+    if term not in value:
+        return 0
+    if any(word.startswith(term) for word in value.split()):
+        return _WORD_PREFIX
+    return _SUBSTRING
+
+class UserSearchIndex:
+    """A thread-safe n-gram index of user rows.
+
+    Rows are dictionaries with at least `user_id` and the searchable fields
+    (see `FIELD_WEIGHTS`). Any other columns (e.g. `role` and `status`) are
+    stored alongside and returned with the search results.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Stored rows and their lowercased field values, keyed by user_id.
+        self._rows = {}
+        self._values = {}
+        # user_ids keyed by (field, n-gram).
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def load(self, rows):
+        """Replaces the whole index with `rows`."""
+        rows = list(rows)
+        index = UserSearchIndex()
+        for row in rows:
+            index._add(dict(row))
+        with self._lock:
+            self._rows, self._values, self._postings = index._rows, index._values, index._postings
+
+    def add(self, row):
+        """Adds a row to the index, replacing any row with the same
+        user_id."""
+        with self._lock:
+            self._remove(row['user_id'])
+            self._add(dict(row))
+
+    def update(self, user_id, **changes):
+        """Changes some columns of an indexed row (does nothing if the user
+        isn't indexed)."""
+        with self._lock:
+            row = self._rows.get(user_id)
+            if row is None:
+                return
+            self._remove(user_id)
+            self._add(dict(row, **changes))
+
+    def remove(self, user_id):
+        """Removes a row from the index."""
+        with self._lock:
+            self._remove(user_id)
+
+    def rows(self):
+        """Returns a copy of every indexed row."""
+        with self._lock:
+            return [dict(row) for row in self._rows.values()]
+
+    def search(self, term: str, fields=None, where=None, offset: int = 0, limit=None):
+        """Finds the rows whose fields contain `term`.
+
+        Args:
+            term: Text to look for (case-insensitive).
+            fields: Names of the fields to search (default: all of them).
+            where: Optional function that takes a row and returns whether it
+                may be included in the results.
+            offset: Number of matches to skip.
+            limit: Most matches to return (default: all of them).
+
+        Returns:
+            A `(rows, total)` tuple: copies of the matching rows from `offset`
+            on, best match first (ties in username order), and the total
+            number of matches.
+        """
+        term = (term or '').strip().lower()
+        fields = list(fields or FIELD_WEIGHTS)
+        if not term:
+            return [], 0
+        keys = _search_key(term)
+
+        scores = {}
+        with self._lock:
+            for field in fields:
+                postings = [self._postings.get((field, key), ()) for key in keys]
+                postings.sort(key=len)
+                candidates = set(postings[0]).intersection(*postings[1:]) if postings else set()
+                for user_id in candidates:
+                    score = _match_score(self._values[user_id][field], term) * FIELD_WEIGHTS[field]
+                    if score > scores.get(user_id, 0):
+                        scores[user_id] = score
+            rows = [(score, self._rows[user_id]) for user_id, score in scores.items()]
+            if where is not None:
+                rows = [(score, row) for score, row in rows if where(row)]
+            rows.sort(key=lambda item: (-item[0], item[1]['username'], item[1]['user_id']))
+            end = None if limit is None else offset + limit
+            return [dict(row) for _, row in rows[offset:end]], len(rows)
+
+    def _add(self, row):
+        """Indexes a row (hold `_lock`, or own the index)."""
+        user_id = row['user_id']
+        values = _field_values(row)
+        self._rows[user_id] = row
+        self._values[user_id] = values
+        for field, value in values.items():
+            for gram in ngrams(value):
+                self._postings.setdefault((field, gram), set()).add(user_id)
+
+    def _remove(self, user_id):
+        """Removes a row from the index (hold `_lock`)."""
+        values = self._values.pop(user_id, None)
+        self._rows.pop(user_id, None)
+        if values is None:
+            return
+        for field, value in values.items():
+            for gram in ngrams(value):
+                posting = self._postings.get((field, gram))
+                if posting is not None:
+                    posting.discard(user_id)
+                    if not posting:
+                        del self._postings[(field, gram)]
@@ -0,0 +1,120 @@
+"""Multi-field user filtering, compiled into a single index-friendly query.
+
+Where `users.py` answers "which users contain this text in this field", this
+module answers structured questions such as "editors who are banned and whose
+last name starts with 'smi'": any combination of field prefixes plus role and
+status facets:
+```
+>>> search = UserFilter(fields={'last_name': 'smi'}, role='editor', status='banned')
+>>> rows, next_cursor, facets = run_filter(search, all_users=True, per_page=50)
+```
+
+The filter is compiled into one SELECT for the page (keyset-paginated on
+`(username, user_id)`, see app/utils/pagination.py) plus one GROUP BY query for
+the role counts and one for the status counts, and all three are sent together
+in a single round trip (see `db.run_batch()`). Field filters are prefix
+matches (`LIKE 'smi%'`), which MySQL can answer from an index on the column
+(see app/db/migrations/0001_index_pack.sql), unlike `LIKE '%smi%'`.
+
+As usual for facets, each facet's counts apply every other filter but not the
+facet's own, so they show how many users each choice would leave.
+"""
+from collections import namedtuple
+from app.config import constants
+from app.db import db
+
+# Fields that can be filtered by prefix.
+FIELDS = ('username', 'first_name', 'last_name', 'email')
+
+# Facets that can be filtered by exact value, and their values.
+FACETS = {
+    'role': (constants.USER_ROLE_TRAVELLER, constants.USER_ROLE_EDITOR, constants.USER_ROLE_ADMIN),
+    'status': (constants.USER_STATUS_ACTIVE, constants.USER_STATUS_BANNED),
+}
+
+_LIST_COLUMNS = 'user_id, username, email, first_name, last_name, role, status'
+
+# A user filter: `fields` maps field names to prefixes; `role` and `status`
+# are facet values (or `None` for any).
+UserFilter = namedtuple('UserFilter', ['fields', 'role', 'status'], defaults=({}, None, None))
+
+def parse_filter(args):
+    """Builds a `UserFilter` from request arguments (e.g. `request.args`),
+    ignoring empty values and unknown facet values."""
+    fields = {field: args[field].strip() for field in FIELDS if (args.get(field) or '').strip()}
+    facets = {facet: args.get(facet) if args.get(facet) in values else None
+              for facet, values in FACETS.items()}
+    return UserFilter(fields, **facets)
+
+def escape_like(text: str) -> str:
+    """Escapes LIKE wildcards in `text` so that it matches literally."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def compile_filter(search: UserFilter, all_users: bool, per_page: int, after=None):
+    """Compiles a filter into the statements run by `run_filter()`.
+
+    Args:
+        search: The filter.
+        all_users: False to only include editors and admins.
+        per_page: Page size.
+        after: Optional `(username, user_id)` cursor of the row before the
+            page.
+
+    Returns:
+        A list of `(sql, params)` tuples: the page query, then the role
+        counts, then the status counts.
+    """
+    # Conditions shared by every statement.
+    shared, shared_params = [], []
+    for field in FIELDS:
+        if field in search.fields:
+            shared.append(f'{field} LIKE %s')
+            shared_params.append(escape_like(search.fields[field]) + '%')
+    if not all_users:
+        shared.append("role IN ('editor', 'admin')")
+
+    facet_conditions = {facet: (f'{facet} = %s', value)
+                        for facet, value in (('role', search.role), ('status', search.status))
+                        if value is not None}
+
+    def where(exclude=None):
+        conditions, params = list(shared), list(shared_params)
+        for facet, (condition, value) in facet_conditions.items():
+            if facet != exclude:
+                conditions.append(condition)
+                params.append(value)
+        return (f" WHERE {' AND '.join(conditions)}" if conditions else ''), params
+
+    page_where, page_params = where()
+    if after is not None:
+        keyset = '(username > %s OR (username = %s AND user_id > %s))'
+        page_where = f'{page_where} AND {keyset}' if page_where else f' WHERE {keyset}'
+        page_params += [after[0], after[0], after[1]]
+    statements = [(f'SELECT {_LIST_COLUMNS} FROM users{page_where} '
+                   f'ORDER BY username, user_id LIMIT %s', tuple(page_params + [per_page + 1]))]
+    for facet in FACETS:
+        facet_where, facet_params = where(exclude=facet)
+        statements.append((f'SELECT {facet}, COUNT(*) AS count FROM users{facet_where} '
+                           f'GROUP BY {facet}', tuple(facet_params)))
+    return statements
+
+def run_filter(search: UserFilter, all_users: bool, per_page: int, after=None):
+    """Runs a filter in a single round trip.
+
+    Returns:
+        A `(rows, next_cursor, facets)` tuple: the page of users, the
+        `(username, user_id)` cursor of the page's last row if there is a next
+        page (or `None`), and the counts for each facet value, e.g.
+        `{'role': {'traveller': 10, 'editor': 2, 'admin': 0}, 'status': ...}`.
+    """
+    page, *facet_rows = db.run_batch(*compile_filter(search, all_users, per_page, after))
+    next_cursor = None
+    if len(page) > per_page:
+        page = page[:per_page]
+        next_cursor = (page[-1]['username'], page[-1]['user_id'])
+    facets = {}
+    for facet, rows in zip(FACETS, facet_rows):
+        counts = dict.fromkeys(FACETS[facet], 0)
+        counts.update({row[facet]: row['count'] for row in rows})
+        facets[facet] = counts
+    return page, next_cursor, facets
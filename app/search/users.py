@@ -0,0 +1,305 @@
+"""User search for the admin user lists, served from an in-memory n-gram
+index (see `index.py`) instead of `LIKE '%term%'` scans of the `users`
+table:
+```
+>>> rows, total = users.search('smi', 'last_name', all_users=True, page=1, per_page=50)
+```
+
+Keeping the index up to date:
+    - The routes that create or change users call `index_user(row)` or
+      `update_user(user_id, ...)` straight afterwards, so searches in the same
+      process see the change at once. These changes are also kept in a
+      journal and replayed over every rebuild or snapshot load whose rows
+      were read before they were made, so loading a snapshot doesn't undo
+      them.
+    - One process (whichever first takes the lock on `<snapshot>.owner`)
+      rebuilds the index from the `users` table every `refresh_interval`
+      seconds in a background thread, which picks up changes made by other
+      worker processes (and anything else that writes to the table). If it
+      exits, another process takes over at its next refresh.
+    - After each rebuild the rows are saved to a snapshot file. A process
+      starting up loads the snapshot (if it's recent) instead of reading the
+      whole table, and every process reloads the snapshot when it is newer
+      than its own index, so the owner's rebuilds and `flask search rebuild`
+      (see app/cli.py) update every running process within a second or so.
+      Rebuilds are serialized by a lock on `<snapshot>.lock`, so processes
+      starting together read the table once between them.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from app.config import constants
+from app.db import queries
+from app.search.index import FIELD_WEIGHTS, UserSearchIndex
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks every process rebuilds its own index.
+    fcntl = None
+
+# Search categories (the `searchcat` parameter) and the fields each searches.
+CATEGORIES = {field: (field,) for field in FIELD_WEIGHTS}
+
+# Columns stored in the index (those shown in the user lists).
+_INDEXED_COLUMNS = ('user_id', 'username', 'email', 'first_name', 'last_name', 'role', 'status')
+
+index = UserSearchIndex()
+
+# Settings (see `init_search`).
+_app = None
+_snapshot_path = None
+_refresh_interval = 300.0
+
+# When the index was last built or loaded, and the modification time of the
+# snapshot it was loaded from (guarded by `_state_lock`).
+_state_lock = threading.Lock()
+_built_at = None
+_snapshot_mtime = 0.0
+_last_snapshot_check = 0.0
+_refresher = None
+_counters = dict(searches=0, rebuilds=0, snapshot_loads=0)
+
+# Changes made by this process since the rows last loaded were read, as
+# `(time, user_id, row, changes)` entries (`row` for `index_user`, `changes`
+# for `update_user`), oldest first. Entries are replayed if they were made
+# less than `_JOURNAL_MARGIN` seconds before the rows were read, to allow for
+# the time between a change being committed and the journal entry being
+# made. Guarded by `_journal_lock`, which is also held while an entry is
+# applied, so replays and new changes are applied in order.
+_JOURNAL_MARGIN = 2.0
+_journal = []
+_journal_lock = threading.Lock()
+
+# The open `<snapshot>.owner` file while this process holds its lock (and so
+# runs the periodic rebuilds).
+_owner_file = None
+
+def init_search(app, snapshot_path: str, refresh_interval: float):
+    """Sets up user search. The index itself is built on first use.
+
+    Args:
+        app: The `Flask` application (used for the background rebuilds).
+        snapshot_path: Path of the snapshot file.
+        refresh_interval: Seconds between rebuilds from the database.
+    """
+    global _app, _snapshot_path, _refresh_interval
+    _app = app
+    _snapshot_path = snapshot_path
+    _refresh_interval = refresh_interval
+
+def search(term: str, category: str, all_users: bool, page: int = 1,
+           per_page: int = constants.DEFAULT_PAGE_SIZE):
+    """Searches users.
+
+    Args:
+        term: Text to look for in the category's fields.
+        category: Search category (see `CATEGORIES`). Unknown categories match
+            nothing.
+        all_users: True to search every user, False for editors and admins
+            only.
+        page: Page of results to return (starting at 1).
+        per_page: Results per page.
+
+    Returns:
+        A `(rows, total)` tuple: one page of matching rows, best match first,
+        and the total number of matches.
+    """
+    fields = CATEGORIES.get(category)
+    if fields is None:
+        return [], 0
+    _ensure_fresh()
+    where = None if all_users else _is_system_user
+    rows, total = index.search(term, fields, where, offset=(max(page, 1) - 1) * per_page, limit=per_page)
+    with _state_lock:
+        _counters['searches'] += 1
+    return rows, total
+
+def index_user(row):
+    """Adds or replaces a user's row in the index. `row` needs the columns of
+    `queries.USER_BY_ID` (extra columns are ignored)."""
+    row = {key: row.get(key) for key in _INDEXED_COLUMNS}
+    with _journal_lock:
+        _journal.append((time.time(), row['user_id'], row, None))
+        index.add(row)
+
+def update_user(user_id, **changes):
+    """Changes some columns (e.g. `role` and `status`) of an indexed user."""
+    with _journal_lock:
+        _journal.append((time.time(), int(user_id), None, changes))
+        index.update(int(user_id), **changes)
+
+def rebuild():
+    """Rebuilds the index from the `users` table and saves a snapshot. Needs an
+    app context.
+
+    Returns:
+        The number of users indexed.
+    """
+    with _file_lock('lock'):
+        return _rebuild()
+
+def stats():
+    """Returns the index size and counters."""
+    with _state_lock:
+        age = None if _built_at is None else round(time.time() - _built_at, 1)
+        return dict(_counters, users=len(index), age_seconds=age, journal=len(_journal),
+                    owner=_owner_file is not None)
+
+def _is_system_user(row):
+    return row['role'] in (constants.USER_ROLE_EDITOR, constants.USER_ROLE_ADMIN)
+
+def _rebuild():
+    """Rebuilds the index and saves a snapshot (hold the `lock` file lock)."""
+    global _built_at, _snapshot_mtime
+    read_at = time.time()
+    rows = queries.fetch_all(queries.USERS_FOR_SEARCH)
+    _load_rows(rows, read_at)
+    mtime = _save_snapshot(rows, read_at)
+    with _state_lock:
+        _built_at = time.time()
+        _snapshot_mtime = max(_snapshot_mtime, mtime)
+        _counters['rebuilds'] += 1
+    return len(rows)
+
+def _load_rows(rows, read_at):
+    """Replaces the index with `rows`, read from the table at `read_at`, and
+    replays the journal entries that may be missing from them."""
+    index.load(rows)
+    with _journal_lock:
+        _journal[:] = [entry for entry in _journal if entry[0] >= read_at - _JOURNAL_MARGIN]
+        for _, user_id, row, changes in _journal:
+            if row is not None:
+                index.add(row)
+            else:
+                index.update(user_id, **changes)
+
+def _ensure_fresh():
+    """Builds the index if this process hasn't yet, starts the background
+    rebuilds, and reloads the snapshot if another process has saved a newer
+    one (checked at most once a second)."""
+    global _refresher, _last_snapshot_check
+    if _built_at is None:
+        with _state_lock:
+            needs_build = _built_at is None
+        if needs_build and not _load_snapshot(max_age=_refresh_interval):
+            # Another process may be rebuilding: wait for it, then use its
+            # snapshot
+            with _file_lock('lock'):
+                if not _load_snapshot(max_age=_refresh_interval):
+                    _rebuild()
+    now = time.time()
+    if now - _last_snapshot_check >= 1:
+        _last_snapshot_check = now
+        _load_snapshot()
+    with _state_lock:
+        if _refresher is None or not _refresher.is_alive():
+            _refresher = threading.Thread(target=_refresh_forever, name='search-refresh', daemon=True)
+            _refresher.start()
+
+def _refresh_forever():
+    """Background thread: rebuilds the index every `refresh_interval` seconds
+    if this process owns the rebuilds (the others pick up the snapshot)."""
+    while True:
+        time.sleep(_refresh_interval)
+        if not _own_rebuilds():
+            continue
+        try:
+            with _app.app_context():
+                rebuild()
+        except Exception:
+            _app.logger.exception('Rebuilding the user search index failed')
+
+def _own_rebuilds():
+    """Returns True if this process holds (or has just taken) the lock on
+    `<snapshot>.owner`."""
+    global _owner_file
+    if fcntl is None or _owner_file is not None:
+        return True
+    try:
+        file = open(f'{_snapshot_path}.owner', 'a')
+    except OSError:
+        return False
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return False
+    _owner_file = file
+    return True
+
+@contextmanager
+def _file_lock(suffix):
+    """Holds an exclusive lock on `<snapshot>.<suffix>` (does nothing without
+    `fcntl`)."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(_snapshot_path) or '.', exist_ok=True)
+    with open(f'{_snapshot_path}.{suffix}', 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+def _forget_owner():
+    """Runs in a forked child: closes the inherited `<snapshot>.owner` file,
+    so only the parent owns the rebuilds and the lock is released when it
+    exits."""
+    global _owner_file
+    if _owner_file is not None:
+        _owner_file.close()
+        _owner_file = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_owner)
+
+def _load_snapshot(max_age=None):
+    """Loads the snapshot file into the index if it is newer than what the
+    index was last built or loaded from (and, if `max_age` is given, no older
+    than `max_age` seconds).
+
+    Returns:
+        True if the snapshot was loaded.
+    """
+    global _built_at, _snapshot_mtime
+    try:
+        mtime = os.stat(_snapshot_path).st_mtime
+    except OSError:
+        return False
+    with _state_lock:
+        if mtime <= _snapshot_mtime or (max_age is not None and time.time() - mtime > max_age):
+            return False
+        _snapshot_mtime = mtime
+    try:
+        with open(_snapshot_path, encoding='utf-8') as file:
+            snapshot = json.load(file)
+        rows, read_at = snapshot['rows'], snapshot['read_at']
+    except (OSError, ValueError, TypeError, KeyError):
+        return False
+    _load_rows(rows, read_at)
+    with _state_lock:
+        _built_at = mtime
+        _counters['snapshot_loads'] += 1
+    return True
+
+def _save_snapshot(rows, read_at):
+    """Atomically writes `rows`, read from the table at `read_at`, to the
+    snapshot file.
+
+    Returns:
+        The snapshot's modification time (0 if it couldn't be written).
+    """
+    os.makedirs(os.path.dirname(_snapshot_path) or '.', exist_ok=True)
+    temp_path = f'{_snapshot_path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(dict(read_at=read_at,
+                           rows=[{key: row.get(key) for key in _INDEXED_COLUMNS} for row in rows]), file)
+        os.replace(temp_path, _snapshot_path)
+        return os.stat(_snapshot_path).st_mtime
+    except OSError:
+        return 0.0
@@ -0,0 +1,51 @@
+/*
+ * Signup form (auth/signup.html).
+ *
+ * - Checks whether the username is available as the user types (after a
+ *   short pause), and marks the field invalid with the reason if it isn't.
+ *   The server checks again when the form is submitted.
+ */
+(function () {
+    var input = document.getElementById('username');
+    if (!input || !input.dataset.availabilityUrl) {
+        return;
+    }
+
+    var feedback = input.parentElement.querySelector('.invalid-feedback');
+    var timer = null;
+    var latest = null;
+
+    function check() {
+        var username = input.value;
+        if (!username) {
+            return;
+        }
+        latest = username;
+        var url = input.dataset.availabilityUrl + '?username=' + encodeURIComponent(username);
+        fetch(url, {headers: {'Accept': 'application/json'}, credentials: 'same-origin'})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json();
+            })
+            .then(function (result) {
+                // Ignore answers for what the user has since typed over.
+                if (username !== latest) {
+                    return;
+                }
+                input.classList.toggle('is-invalid', !result.available);
+                if (feedback) {
+                    feedback.textContent = result.available ? '' : result.error;
+                }
+            })
+            .catch(function () {
+                // Leave it to the server to check on submit.
+            });
+    }
+
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(check, 300);
+    });
+})();
@@ -0,0 +1,81 @@
+/*
+ * Infinite scrolling lists: the journey event timeline (event/events.html)
+ * and the public journey feed (journey/feed.html).
+ *
+ * - Loads the next page when the "Loading more" marker scrolls into view,
+ *   and appends its cards to the list.
+ * - "Read more" buttons fetch an event's full description and replace the
+ *   summary with it.
+ */
+(function () {
+    var timeline = document.getElementById('timeline');
+    if (!timeline) {
+        return;
+    }
+
+    var more = document.getElementById('timeline-more');
+    var loading = false;
+
+    function loadNextPage() {
+        var url = more && more.dataset.nextUrl;
+        if (!url || loading) {
+            return;
+        }
+        loading = true;
+        fetch(url, {headers: {'Accept': 'application/json'}, credentials: 'same-origin'})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json();
+            })
+            .then(function (page) {
+                timeline.insertAdjacentHTML('beforeend', page.html);
+                if (page.next_url) {
+                    more.dataset.nextUrl = page.next_url;
+                } else {
+                    observer.disconnect();
+                    more.remove();
+                }
+            })
+            .catch(function () {
+                more.textContent = 'Could not load more. Scroll to try again.';
+            })
+            .finally(function () {
+                loading = false;
+            });
+    }
+
+    var observer = null;
+    if (more) {
+        observer = new IntersectionObserver(function (entries) {
+            if (entries.some(function (entry) { return entry.isIntersecting; })) {
+                loadNextPage();
+            }
+        }, {rootMargin: '600px 0px'});
+        observer.observe(more);
+    }
+
+    // Cards are added as the user scrolls, so listen on the timeline itself.
+    timeline.addEventListener('click', function (event) {
+        var button = event.target.closest('.event-read-more');
+        if (!button) {
+            return;
+        }
+        button.disabled = true;
+        fetch(button.dataset.url, {headers: {'Accept': 'application/json'}, credentials: 'same-origin'})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json();
+            })
+            .then(function (event) {
+                button.parentElement.querySelector('.event-description').textContent = event.description;
+                button.remove();
+            })
+            .catch(function () {
+                button.disabled = false;
+            });
+    });
+})();
@@ -0,0 +1,94 @@
+"""
+authorization.py
+
+Answers "may the current user do this to this journey?" for the journey and
+event routes, from a cache of each journey's owner and visibility:
+```
+>>> journey, error = authorization.authorize(authorization.EDIT, journey_id)
+>>> if journey is None:
+>>>     flash(error, 'error')
+```
+
+A journey's access row (see `queries.JOURNEY_ACCESS`) is fetched once per
+request at most, and kept in a small in-process cache for `ttl` seconds, so
+the routes don't need to join `journeys` into their own statements just to
+check ownership: once `authorize()` has passed, editing or deleting an event
+is a single statement, conditional on the event belonging to the journey.
+
+Nothing in the app changes a journey's owner or status yet. Anything that
+does should call `invalidate_journey(journey_id)` afterwards (and
+`journey_feed.refresh(journey_id)`, see app/db/journey_feed.py); other
+worker processes see the change within `ttl` seconds.
+"""
+from flask import g, session
+from app.config import constants
+from app.db import queries
+from app.utils.cache import MISSING, TTLCache
+
+# Actions on a journey.
+VIEW = 'view'  # See the journey and its events
+EDIT = 'edit'  # Add, change, delete, or import the journey's events
+
+# Access rows keyed by journey_id (`None` for journeys that don't exist),
+# created by `init_authorization`.
+_journeys: TTLCache = None
+
+def init_authorization(max_size: int, ttl: float):
+    """Sets up the journey access cache.
+
+    Args:
+        max_size: Most journeys cached in this process.
+        ttl: Seconds a journey's access row is cached for.
+    """
+    global _journeys
+    _journeys = TTLCache(max_size, ttl)
+
+def get_journey(journey_id: int):
+    """Returns a journey's access row (`journey_id`, `user_id`, `title`,
+    `status` and the owner's `username`), or `None` if there is no such
+    journey."""
+    per_request = g.setdefault('journey_access', {})
+    journey = per_request.get(journey_id, MISSING)
+    if journey is MISSING:
+        journey = _journeys.get(journey_id)
+        if journey is MISSING:
+            journey = queries.fetch_one(queries.JOURNEY_ACCESS, (journey_id,))
+            _journeys.set(journey_id, journey)
+        per_request[journey_id] = journey
+    return dict(journey) if journey is not None else None
+
+def can(user_id, action: str, journey) -> bool:
+    """Returns True if a user may do `action` to a journey (an access row from
+    `get_journey()`)."""
+    if journey is None:
+        return False
+    is_owner = journey['user_id'] == user_id
+    if action == EDIT:
+        return is_owner
+    return journey['status'] != 'private' or is_owner
+
+def authorize(action: str, journey_id: int):
+    """Checks that the logged-in user may do `action` to a journey.
+
+    Returns:
+        A `(journey, error)` tuple: the journey's access row, or `None` and a
+        message saying why the user can't.
+    """
+    journey = get_journey(journey_id)
+    if journey is None:
+        return None, 'Journey not found'
+    if not can(session.get(constants.USER_ID), action, journey):
+        if action == EDIT:
+            return None, 'You do not have permission to change this journey'
+        return None, 'You do not have permission to view this journey'
+    return journey, None
+
+def invalidate_journey(journey_id: int):
+    """Drops a journey from this process's cache (call after changing its
+    owner or status)."""
+    _journeys.delete(journey_id)
+    g.get('journey_access', {}).pop(journey_id, None)
+
+def stats():
+    """Returns the journey access cache counters."""
+    return _journeys.stats()
@@ -0,0 +1,123 @@
+"""
+cache.py
+
+Small caching building blocks shared by the app's caches:
+    - `TTLCache`: a thread-safe, in-process LRU cache whose entries also
+      expire after a fixed time-to-live, with hit/miss/eviction counters.
+    - `RedisBackend`: an optional shared cache backend, so that several worker
+      processes can share cached values. It needs the `redis` package, which
+      is only imported when a backend is actually configured.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by `TTLCache.get()` when a key isn't cached, so that `None` can be
+# cached like any other value.
+MISSING = object()
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    Args:
+        max_size: Maximum number of entries. Adding an entry to a full cache
+            evicts the least recently used one.
+        ttl: Seconds an entry stays valid after it was stored (0 or less to
+            never expire entries).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = dict(hits=0, misses=0, evictions=0, expirations=0, invalidations=0)
+
+    def get(self, key, default=MISSING):
+        """Returns the value cached for `key`, or `default` if it isn't cached
+        (or has expired)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """Caches `value` under `key`, evicting the least recently used entry
+        if the cache is full.
+
+        Args:
+            key: The key.
+            value: The value.
+            ttl: Seconds this entry stays valid, if not the cache's `ttl`.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl > 0 else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def delete(self, key):
+        """Removes `key` from the cache (if it is cached)."""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._counters['invalidations'] += 1
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        with self._lock:
+            self._counters['invalidations'] += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the cache's counters, plus its current and maximum size."""
+        with self._lock:
+            return dict(self._counters, size=len(self._entries), max_size=self.max_size)
+
+class RedisBackend:
+    """A cache backend shared between processes, stored in Redis (or any
+    server that speaks the Redis protocol).
+
+    Values are stored as JSON, so they must be JSON-serialisable.
+
+    Args:
+        url: Redis URL, e.g. `redis://localhost:6379/0`.
+        prefix: Prefix added to every key, to keep different caches apart.
+        ttl: Seconds before a stored value expires.
+    """
+
+    def __init__(self, url: str, prefix: str, ttl: float):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('A Redis cache backend was configured, but the "redis" '
+                               'package is not installed.') from e
+        self._client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        """Returns the value stored for `key`, or `MISSING`."""
+        value = self._client.get(self.prefix + key)
+        return MISSING if value is None else json.loads(value)
+
+    def set(self, key, value):
+        """Stores `value` under `key`."""
+        self._client.set(self.prefix + key, json.dumps(value, default=str), ex=int(self.ttl) or None)
+
+    def delete(self, key):
+        """Removes `key` from the backend."""
+        self._client.delete(self.prefix + key)
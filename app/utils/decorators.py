@@ -6,8 +6,9 @@ Flask views. These decorators help enforce login and role-based access
 control across the application.
 """
 from functools import wraps
-from flask import redirect, url_for, session, render_template
+from flask import redirect, url_for, session, render_template, request, flash
 from ..config import constants
+from . import rate_limit
 
 def login_required(f):
     """
@@ -82,4 +83,33 @@ def if_logged_in_redirect(f):
             # Redirect to the user home page if already logged in
             return redirect(user_home_url())  # You should define the `user_home_url()` function or the URL
         return f(*args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
+
+def rate_limited(action, template):
+    """
+    A decorator that applies the rate limits for `action` (see
+    app/utils/rate_limit.py) to POST requests, keyed by the client's IP address
+    and the submitted username. This runs before the view, so refused
+    attempts never reach the database or the password hasher.
+
+    Args:
+        action (str): The name of the limited action, e.g. 'login'.
+        template (str): The template to re-render (with a 429 status) when an
+            attempt is refused.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method == constants.HTTP_METHOD_POST:
+                username = request.form.get(constants.USERNAME)
+                retry_after = rate_limit.check(action, {
+                    rate_limit.KEY_IP: request.remote_addr,
+                    rate_limit.KEY_USERNAME: rate_limit.normalise_username(username),
+                })
+                if retry_after is not None:
+                    flash("Too many attempts. Please wait a minute and try again.", constants.FLASH_MESSAGE_DANGER)
+                    return (render_template(template, username=username),
+                            constants.HTTP_STATUS_CODE_429, {'Retry-After': str(retry_after)})
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
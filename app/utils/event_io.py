@@ -0,0 +1,202 @@
+"""
+event_io.py
+
+Bulk import and export of a journey's events, as CSV or JSON Lines (one JSON
+object per line). Both formats use the columns in `COLUMNS`; times are
+written as `YYYY-MM-DD HH:MM:SS`, and read in any ISO 8601 form (e.g. the
+`YYYY-MM-DDTHH:MM` that the event form sends).
+
+`import_events()` reads the file a row at a time, checks every row with the
+same rules as the add event form (`validators.EVENT_FORM`), and inserts the valid rows in batches of
+`BATCH_SIZE` (one multi-row INSERT per batch) inside a single transaction.
+If any row is invalid, nothing is imported, and every problem is reported
+with its line number, so the file can be fixed and imported again:
+```
+>>> result = event_io.import_events(journey_id, file.stream, 'csv', max_rows=5000)
+>>> result.imported, result.errors
+(0, [(4, 'Title, start time and location are required'), (9, 'Invalid start time')])
+```
+
+`export_events()` yields the export a line at a time, fetching the events a
+page at a time in timeline order, so a long journey is never held in memory
+at once. The routes and `flask events` commands (see app/cli.py) use both.
+"""
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+from app.db import db, journey_feed, queries
+from app.utils import validators
+
+# Columns imported and exported, in CSV column order.
+COLUMNS = ('title', 'description', 'start_time', 'end_time', 'location')
+
+# Formats, keyed by name, with their file extensions.
+FORMATS = {'csv': ('.csv',), 'jsonl': ('.jsonl', '.ndjson')}
+
+# Rows inserted per INSERT statement, and events fetched per export page.
+BATCH_SIZE = 500
+
+# Problems reported before an import stops reading the file.
+MAX_ERRORS = 100
+
+# Columns a CSV file must have (the others may be left out).
+_REQUIRED_COLUMNS = ('title', 'start_time', 'location')
+
+# The result of an import: the number of events imported, and a list of
+# `(line number, message)` pairs for the rows that couldn't be (line 0 for
+# problems with the file as a whole).
+ImportResult = namedtuple('ImportResult', ['imported', 'errors'])
+
+def detect_format(filename, requested=None):
+    """Works out a file's format from `requested` (a format name) or, failing
+    that, its file name.
+
+    Returns:
+        'csv', 'jsonl', or `None` if the format isn't known.
+    """
+    if requested:
+        return requested if requested in FORMATS else None
+    filename = (filename or '').lower()
+    for name, extensions in FORMATS.items():
+        if filename.endswith(extensions):
+            return name
+    return None
+
+def import_events(journey_id: int, stream, file_format: str, max_rows: int):
+    """Imports events into a journey, all or nothing. Needs an app context.
+
+    Args:
+        journey_id: The journey to add the events to. The caller must check
+            that the user owns it.
+        stream: Binary file object to read (UTF-8, with or without a BOM).
+        file_format: 'csv' or 'jsonl'.
+        max_rows: Most events a single import may contain.
+
+    Returns:
+        An `ImportResult`.
+    """
+    errors = []
+    batch = []
+    imported = 0
+    connection = db.get_db()
+    cursor = db.get_cursor()
+    connection.start_transaction()
+    try:
+        for count, (line, row, error) in enumerate(_read_rows(stream, file_format), 1):
+            if count > max_rows:
+                errors.append((line, f'An import can contain at most {max_rows} events.'))
+                break
+            values = None
+            if error is None:
+                values, error = parse_event(row)
+            if error:
+                errors.append((line, error))
+                if len(errors) >= MAX_ERRORS:
+                    break
+                continue
+            # Once a row has failed nothing will be imported, so stop
+            # inserting (but keep checking the rest of the file).
+            if errors:
+                continue
+            batch.append((journey_id, *values, None))
+            if len(batch) >= BATCH_SIZE:
+                cursor.executemany(queries.INSERT_EVENT.sql, batch)
+                imported += len(batch)
+                batch = []
+        if not errors and batch:
+            cursor.executemany(queries.INSERT_EVENT.sql, batch)
+            imported += len(batch)
+        if errors:
+            connection.rollback()
+            return ImportResult(0, errors)
+        connection.commit()
+        journey_feed.refresh(journey_id)
+        return ImportResult(imported, [])
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def parse_event(row):
+    """Checks and converts one imported row.
+
+    Args:
+        row: Dictionary of column values (strings, or `None` for missing
+            values).
+
+    Returns:
+        A `(values, error)` tuple: the values for `queries.INSERT_EVENT` (title,
+        description, start and end time, location), or `None` and a message
+        saying what is wrong with the row.
+    """
+    if not isinstance(row, dict):
+        return None, 'Each line must be a JSON object'
+    values = {column: str(row.get(column) or '').strip() for column in COLUMNS}
+
+    error = validators.EVENT_FORM.first_error(values)
+    if error:
+        return None, error
+    start = datetime.fromisoformat(values['start_time'])
+    end = datetime.fromisoformat(values['end_time']) if values['end_time'] else None
+    return (values['title'], values['description'], start, end, values['location']), None
+
+def export_events(journey_id: int, file_format: str):
+    """Yields a journey's events in `file_format`, a line (or CSV record) at a
+    time. Needs an app context for as long as it is iterated (wrap it in
+    `stream_with_context()` to stream it from a route)."""
+    if file_format == 'csv':
+        yield _csv_line(COLUMNS)
+    for event in _events_in_pages(journey_id):
+        values = [event[column] for column in COLUMNS]
+        values = [value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime) else value
+                  for value in values]
+        if file_format == 'csv':
+            yield _csv_line(values)
+        else:
+            yield json.dumps(dict(zip(COLUMNS, values)), ensure_ascii=False) + '\n'
+
+def _events_in_pages(journey_id):
+    """Yields a journey's events in timeline order, fetching `BATCH_SIZE` at a
+    time."""
+    page = queries.fetch_all(queries.EVENTS_EXPORT_PAGE['first'], (journey_id, BATCH_SIZE))
+    while page:
+        yield from page
+        if len(page) < BATCH_SIZE:
+            return
+        last = page[-1]
+        page = queries.fetch_all(queries.EVENTS_EXPORT_PAGE['after'],
+                                 (journey_id, last['start_time'], last['start_time'], last['event_id'],
+                                  BATCH_SIZE))
+
+def _read_rows(stream, file_format):
+    """Yields `(line number, row, error)` for each row of an import file."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        if file_format == 'csv':
+            reader = csv.DictReader(text)
+            if not set(_REQUIRED_COLUMNS) <= set(reader.fieldnames or ()):
+                yield 0, None, f"The first line must name the columns: {', '.join(COLUMNS)}"
+                return
+            for row in reader:
+                yield reader.line_num, row, None
+        else:
+            for line, text_line in enumerate(text, 1):
+                if not text_line.strip():
+                    continue
+                try:
+                    yield line, json.loads(text_line), None
+                except ValueError:
+                    yield line, None, 'Invalid JSON'
+    except UnicodeDecodeError:
+        yield 0, None, 'The file must be UTF-8 text'
+    finally:
+        # Leave the underlying stream open for its owner.
+        text.detach()
+
+def _csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
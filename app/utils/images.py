@@ -0,0 +1,378 @@
+"""
+images.py
+
+Uploaded images (profile pictures and event photos), resized in the
+background.
+
+Uploads used to be saved as they were and served at full size everywhere, so
+a profile thumbnail could cost the visitor several megabytes. Now
+`save_upload()` checks that the upload is an image, streams it to a staging
+folder outside `static/`, and returns at once with the name to store in the
+database. A small pool of worker threads then makes a WebP copy of it at each
+size in `VARIANTS` (EXIF data such as the GPS position is left out, after
+applying the camera's rotation) and deletes the staged original:
+```
+>>> name = images.save_upload(request.files['event_image'])
+```
+
+Images are content-addressed: an image's name is the SHA-256 digest of the
+uploaded bytes (plus the original format's extension), so two uploads of the
+same file share one set of variants, and two different files can never
+overwrite each other. The variants are spread over two levels of
+subdirectories named after the digest's first four hex digits (e.g.
+`uploads/3f/2a/3f2a....thumb.webp`), so no directory grows too large. Several
+users and events can refer to the same image, so the routes never delete
+image files themselves: they count references with `app/db/image_refs.py`,
+and `flask images gc` deletes the images nothing refers to any more.
+
+Templates pick a size with the `image_url()` and `image_srcset()` globals:
+```
+<img src="{{ image_url(event.event_image, 'card') }}"
+     srcset="{{ image_srcset(event.event_image) }}" sizes="33vw">
+```
+Until a new upload's variants are ready, `image_url()` points at a
+placeholder. Images uploaded before the variants existed are served as they
+are until `flask images backfill` (see app/cli.py) makes their variants.
+
+An upload can pass the format check and still fail to process (e.g. a
+truncated file). With no worker threads, `save_upload()` then raises
+`InvalidImage`, before anything refers to the image. With workers, an upload
+staged during a request is only queued once the request is over, so the
+route has stored its name by then; if processing fails, the `on_failure`
+callback (`image_refs.forget()`) removes every reference to it.
+"""
+import hashlib
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import g, has_request_context, url_for
+from PIL import Image, ImageOps
+from app.utils.cache import TTLCache
+
+class InvalidImage(ValueError):
+    """Raised when an upload isn't an image in one of the accepted formats."""
+
+# Variant names and the longest side of each, in pixels, smallest first.
+# Images smaller than a variant are not enlarged.
+VARIANTS = {
+    'thumb': 256,
+    'card': 800,
+    'full': 1600,
+}
+
+# Accepted upload formats (as named by Pillow) and the extension new uploads
+# are stored with.
+_FORMATS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif', 'WEBP': 'webp'}
+
+# Content-addressed image names (images uploaded before then keep their
+# original file names, and live directly in the upload folder).
+_DIGEST_NAME = re.compile(r'[0-9a-f]{64}\.\w+')
+
+# Bytes read from an upload at a time while staging it.
+_CHUNK_SIZE = 64 * 1024
+
+# Served while a new upload's variants are being made.
+_PENDING_IMAGE = 'images/image_pending.svg'
+
+# Settings (see `init_images`).
+_app = None
+_upload_folder = None
+_staging_folder = None
+_workers = 2
+_quality = 80
+_on_failure = None
+
+# The worker pool (created on first use in each process, see `_submit`).
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# Names whose variants are known to exist, so templates don't check the disk
+# for every image they show.
+_ready = TTLCache(max_size=10000, ttl=300.0)
+# Names queued or being processed in this process.
+_queued = set()
+_counters = dict(staged=0, deduplicated=0, processed=0, failed=0, in_flight=0)
+_counters_lock = threading.Lock()
+
+def init_images(app, upload_folder: str, staging_folder: str, workers: int, quality: int,
+                on_failure=None):
+    """Sets up image processing, and registers the `image_url()` and
+    `image_srcset()` template globals (and `has_variants()`, as
+    `image_ready()`).
+
+    Args:
+        app: The `Flask` application.
+        upload_folder: Folder under `static/` the variants are saved in.
+        staging_folder: Folder uploads wait in until they are processed.
+        workers: Number of worker threads (0 to process on the calling
+            thread).
+        quality: WebP quality (0-100).
+        on_failure: Called with an image's name (in an app context) when the
+            workers fail to process it.
+    """
+    global _app, _upload_folder, _staging_folder, _workers, _quality, _on_failure
+    _app = app
+    _upload_folder = upload_folder
+    _staging_folder = staging_folder
+    _workers = workers
+    _quality = quality
+    _on_failure = on_failure
+    os.makedirs(staging_folder, exist_ok=True)
+    app.teardown_request(_submit_pending)
+    app.add_template_global(image_url)
+    app.add_template_global(image_srcset)
+    app.add_template_global(has_variants, 'image_ready')
+
+def save_upload(file) -> str:
+    """Stages an uploaded image and queues it for processing, unless the same
+    image has already been uploaded.
+
+    The caller should count the new reference to the image with
+    `image_refs.retain()` before storing the name.
+
+    Args:
+        file: The uploaded `FileStorage` (from `request.files`).
+
+    Raises:
+        InvalidImage: The upload isn't a PNG, JPEG, GIF or WebP image, or
+            (with no worker threads) it couldn't be processed.
+
+    Returns:
+        The image's name, to store in the database.
+    """
+    # Only the header is read here; the pixels are decoded by the worker.
+    try:
+        with Image.open(file.stream) as image:
+            image_format = image.format
+    except (OSError, Image.DecompressionBombError):
+        raise InvalidImage('Invalid file type. Please choose an image.')
+    if image_format not in _FORMATS:
+        raise InvalidImage('Invalid file type. Please choose an image.')
+    file.stream.seek(0)
+
+    # Hash the upload while streaming it to the staging folder.
+    digest = hashlib.sha256()
+    temp_path = os.path.join(_staging_folder, f'{uuid.uuid4().hex}.tmp')
+    with open(temp_path, 'wb') as staged:
+        for chunk in iter(lambda: file.stream.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            staged.write(chunk)
+    name = f'{digest.hexdigest()}.{_FORMATS[image_format]}'
+
+    with _counters_lock:
+        duplicate = name in _queued or has_variants(name)
+        if duplicate:
+            _counters['deduplicated'] += 1
+        else:
+            _queued.add(name)
+            _counters['staged'] += 1
+    if duplicate:
+        os.remove(temp_path)
+        return name
+    staged_path = os.path.join(_staging_folder, name)
+    os.replace(temp_path, staged_path)
+    if _workers <= 0:
+        with _counters_lock:
+            _counters['in_flight'] += 1
+        if not _process_queued(name, staged_path):
+            raise InvalidImage('This image could not be processed. Please choose another.')
+    elif has_request_context():
+        # Queued once the route has stored the name (see `_submit_pending`).
+        g.setdefault('_staged_images', []).append((name, staged_path))
+    else:
+        _submit(name, staged_path)
+    return name
+
+def is_content_addressed(name) -> bool:
+    """Returns True if `name` is a content-addressed image name (as opposed
+    to the file name of an image uploaded before then)."""
+    return bool(name) and _DIGEST_NAME.fullmatch(name) is not None
+
+def delete(name):
+    """Deletes an image's variants, and its original if it was uploaded before
+    the variants existed. Does nothing if `name` is empty.
+
+    Only call this for images nothing refers to (see `image_refs.py`).
+    """
+    if not name:
+        return
+    _ready.delete(name)
+    paths = [os.path.join(_upload_folder, variant_name(name, variant)) for variant in VARIANTS]
+    paths.append(os.path.join(_upload_folder, name))
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def stored_files():
+    """Yields `(digest, path, mtime)` for every variant file of every
+    content-addressed image."""
+    for folder, _, filenames in os.walk(_upload_folder):
+        if folder == _upload_folder:
+            continue
+        for filename in filenames:
+            digest = filename.split('.', 1)[0]
+            if len(digest) == 64:
+                path = os.path.join(folder, filename)
+                try:
+                    yield digest, path, os.stat(path).st_mtime
+                except FileNotFoundError:
+                    pass
+
+def variant_name(name: str, variant: str) -> str:
+    """Returns the path of one of an image's variants, relative to the upload
+    folder, e.g. `3f/2a/3f2a....thumb.webp` for `3f2a....png`."""
+    stem = os.path.splitext(name)[0]
+    if is_content_addressed(name):
+        return f'{stem[:2]}/{stem[2:4]}/{stem}.{variant}.webp'
+    return f'{stem}.{variant}.webp'
+
+def has_variants(name: str) -> bool:
+    """Returns True if every variant of an image has been made."""
+    if _ready.get(name, False):
+        return True
+    # The largest variant is written last.
+    ready = os.path.exists(os.path.join(_upload_folder, variant_name(name, 'full')))
+    if ready:
+        _ready.set(name, True)
+    return ready
+
+def image_url(name: str, variant: str = 'full') -> str:
+    """Returns the URL of one of an image's variants. Falls back to the
+    original for images uploaded before the variants existed, and to a
+    placeholder for new uploads that are still being processed."""
+    if has_variants(name):
+        return url_for('static', filename=f'uploads/{variant_name(name, variant)}')
+    if os.path.exists(os.path.join(_upload_folder, name)):
+        return url_for('static', filename=f'uploads/{name}')
+    return url_for('static', filename=_PENDING_IMAGE)
+
+def image_srcset(name: str) -> str:
+    """Returns a `srcset` attribute value listing every variant of an image
+    with its width, or an empty string if the variants aren't ready (browsers
+    then use `src`).
+
+    Each width is the variant's size limit: an image smaller than the limit is
+    listed as wider than it is, which only means the browser may choose it
+    for a slightly larger slot than it needs to.
+    """
+    if not has_variants(name):
+        return ''
+    return ', '.join(f"{url_for('static', filename=f'uploads/{variant_name(name, variant)}')} {size}w"
+                     for variant, size in VARIANTS.items())
+
+def backfill():
+    """Makes the variants of every image in the upload folder that doesn't
+    have them yet (images uploaded before the variants existed), and
+    processes any uploads left in the staging folder by a process that
+    stopped before getting to them. Runs on the calling thread.
+
+    Returns:
+        The number of images processed.
+    """
+    count = 0
+    for folder in (_upload_folder, _staging_folder):
+        for name in sorted(os.listdir(folder)):
+            if not _is_original(name) or (folder == _upload_folder and has_variants(name)):
+                continue
+            # Originals in the upload folder are kept (they are served until
+            # the variants exist); staged uploads are deleted once processed.
+            _process(name, os.path.join(folder, name), keep_original=folder == _upload_folder)
+            count += 1
+    return count
+
+def stats():
+    """Returns the upload counters and the number of uploads waiting or being
+    processed."""
+    with _counters_lock:
+        return dict(_counters)
+
+def _submit_pending(exc=None):
+    """Request teardown: queues the uploads staged during the request."""
+    for name, staged_path in g.pop('_staged_images', ()):
+        _submit(name, staged_path)
+
+def _submit(name, staged_path):
+    """Runs `_process_in_background()` on the worker pool."""
+    global _executor, _executor_pid
+    with _counters_lock:
+        _counters['in_flight'] += 1
+    with _executor_lock:
+        # Threads don't survive a fork, so each process makes its own pool.
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix='images')
+            _executor_pid = os.getpid()
+        _executor.submit(_process_in_background, name, staged_path)
+
+def _process_in_background(name, staged_path):
+    """Worker task: processes a staged upload, and calls `_on_failure` if
+    that fails (the staged file is gone by then, so the image would otherwise
+    stay pending for ever)."""
+    if _process_queued(name, staged_path) or _on_failure is None:
+        return
+    try:
+        with _app.app_context():
+            _on_failure(name)
+    except Exception:
+        _app.logger.exception(f'Removing the references to image {name} failed')
+
+def _process_queued(name, staged_path):
+    """Processes a staged upload. Returns True if it succeeded."""
+    try:
+        return _process(name, staged_path)
+    finally:
+        with _counters_lock:
+            _counters['in_flight'] -= 1
+            _queued.discard(name)
+
+def _is_original(name):
+    """Returns True for an uploaded image's file name, as opposed to a
+    variant's or a temporary file's."""
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+    return (extension in _FORMATS.values()
+            and not any(name.endswith(f'.{variant}.webp') for variant in VARIANTS))
+
+def _process(name, source_path, keep_original=False):
+    """Makes every variant of an image, then deletes `source_path` unless
+    `keep_original` is set. Each variant is written to a temporary file and
+    renamed into place, so a half-written variant is never served.
+
+    Returns:
+        True if every variant was made.
+    """
+    try:
+        with Image.open(source_path) as original:
+            # Apply the camera's rotation before the EXIF data is dropped.
+            image = ImageOps.exif_transpose(original)
+            if image.mode not in ('RGB', 'RGBA'):
+                has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+            icc_profile = original.info.get('icc_profile')
+            for variant, size in VARIANTS.items():
+                resized = image.copy()
+                resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+                path = os.path.join(_upload_folder, variant_name(name, variant))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = f'{path}.{os.getpid()}.tmp'
+                # Only the colour profile is carried over: no EXIF or XMP.
+                resized.save(temp_path, 'WEBP', quality=_quality, icc_profile=icc_profile)
+                os.replace(temp_path, path)
+        with _counters_lock:
+            _counters['processed'] += 1
+        return True
+    except Exception:
+        with _counters_lock:
+            _counters['failed'] += 1
+        if _app is not None:
+            _app.logger.exception(f'Processing image {name} failed')
+        return False
+    finally:
+        if not keep_original:
+            try:
+                os.remove(source_path)
+            except FileNotFoundError:
+                pass
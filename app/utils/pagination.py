@@ -0,0 +1,73 @@
+"""
+pagination.py
+
+Helpers for keyset (cursor-based) pagination.
+
+Instead of skipping `OFFSET` rows, which makes the database read and discard
+every row before the page, each page is fetched relative to the sort key of a
+row on a neighbouring page, e.g. "the first 50 users after ('alice', 12) in
+(username, user_id) order". With an index on the sort key, every page costs
+the same to fetch, however deep into the list it is.
+
+The sort key of the row to continue from is passed between pages as an opaque
+cursor token (URL-safe base64 of the key as JSON). Timestamps are encoded as
+ISO 8601 strings.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from app.config import constants
+
+def encode_cursor(key) -> str:
+    """Encodes a row's sort key (a tuple of JSON-serialisable values) as a
+    cursor token."""
+    raw = json.dumps(list(key), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token, types):
+    """Decodes a cursor token made by `encode_cursor()`, checking the type of
+    each value of the sort key, e.g. `decode_cursor(token, (str, int))` for a
+    `(username, user_id)` key.
+
+    Args:
+        token: The token, or `None`.
+        types: The type of each value of the sort key. `datetime` stands for
+            a timestamp, which must be an ISO 8601 string and is returned as
+            the string.
+
+    Returns:
+        The sort key as a tuple, or `None` if there's no token or it isn't
+        valid.
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        key = json.loads(raw)
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(key, list) or len(key) != len(types):
+        return None
+    for value, kind in zip(key, types):
+        if kind is datetime:
+            if not isinstance(value, str):
+                return None
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                return None
+        # `bool` is a subclass of `int`, but `true` isn't a valid ID
+        elif not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool):
+            return None
+    return tuple(key)
+
+def page_size(value, default: int = constants.DEFAULT_PAGE_SIZE) -> int:
+    """Parses a requested page size, falling back to `default` and capping
+    it at the maximum (see `constants.DEFAULT_PAGE_SIZE` and
+    `constants.MAX_PAGE_SIZE`)."""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, constants.MAX_PAGE_SIZE))
@@ -7,7 +7,11 @@ of your user accounts should have its own unique password.
 Before running this script, you'll need to replace the list of user accounts
 (the block beginning "users = [") with the actual list of user accounts you
 want to generate hashes for.
+
+Hashes use the same cost factor as the app: 12, or the value of the
+BCRYPT_LOG_ROUNDS environment variable if it is set.
 """
+import os
 from collections import namedtuple
 from flask import Flask
 from flask_bcrypt import Bcrypt
@@ -25,6 +29,8 @@ from flask_bcrypt import Bcrypt
 UserAccount = namedtuple('UserAccount', ['username', 'password'])
 
 app = Flask(__name__)
+# Flask-Bcrypt reads the cost factor from this config key.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
 flask_bcrypt = Bcrypt(app)
 
 # Replace the example UserAccount objects below with the initial user accounts
@@ -35,7 +41,7 @@ users = [UserAccount('admin1', 'Admin1pass*'),
 print('Username | Password | Hash | Password Matches Hash')
 
 for user in users:
-    # Generate a bcrypt hash using the default settings. This function returns
+    # Generate a bcrypt hash using the configured cost factor. This function returns
     # the hash as 59-60 bytes (always 60 in the current version of bcrypt).
     password_hash = flask_bcrypt.generate_password_hash(user.password)
     
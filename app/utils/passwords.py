@@ -0,0 +1,282 @@
+"""
+passwords.py
+
+Password hashing and checking, run in a small pool of worker processes.
+
+bcrypt is deliberately slow (a few hundred milliseconds per hash at the default
+cost), and it holds the CPU the whole time. Running it on request threads
+means a burst of logins can occupy every thread and stall cheap page views.
+Instead, `hash_password()` and `check_password()` hand the work to a
+fixed-size process pool and wait for the result:
+```
+>>> password_hash = passwords.hash_password(password)
+>>> if passwords.check_password(password_hash, password): ...
+```
+
+Only `workers + max_queued` hashes may be running or queued at once. Past that,
+`HasherBusy` is raised straight away, which the app turns into a
+`503 Service Unavailable` response, rather than letting requests pile up
+behind the pool.
+
+With `workers` set to 0 hashing runs on the calling thread, as before.
+
+The pool is created on the first hash, in whichever process makes it, so
+building the app starts no processes or threads and server workers can be
+forked from it safely. Its processes are spawned (see `make_pool()`) rather
+than forked from the app process: a server process has request threads
+running, and forking one can copy locks other threads hold. Starting a
+worker takes a fraction of a second, paid by the first hashes each process
+makes. If a pool process dies (e.g. killed for running out of memory), the
+request thread that notices can replace the pool safely, and the hash is
+retried once.
+
+New hashes use the configured cost factor (`BCRYPT_LOG_ROUNDS`). Hashes made
+with a different cost keep working, and are replaced with one at the
+configured cost the next time their owner logs in (see
+`rehash_in_background()`), so the cost can be raised or lowered without
+resetting anyone's password. `flask passwords benchmark` (see app/cli.py)
+helps pick a cost for the current host.
+"""
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+from app.config import constants
+from app.db import queries
+
+class HasherBusy(Exception):
+    """Raised when too many password hashes are already running or queued."""
+
+# The process pool (created on first use, see `_get_executor`) and the ID of
+# the process that created it.
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# Pools inherited from a parent process. They are kept rather than shut down:
+# their processes belong to the parent.
+_inherited_executors = []
+
+# Settings (see `init_passwords`).
+_app = None
+_workers = 0
+_max_queued = 0
+_rounds = 12
+
+# One slot per hash that may be running or queued at once.
+_slots = None
+_counters = dict(submitted=0, rejected=0, in_flight=0, rehashed=0, rehash_skipped=0)
+_counters_lock = threading.Lock()
+
+# Thread that runs rehashes after login (created on first use), and the IDs
+# of the users whose rehash is waiting or running.
+_rehash_executor = None
+_pending_rehashes = set()
+
+def init_passwords(app, workers: int, max_queued: int, rounds: int = 12):
+    """Sets up password hashing.
+
+    Args:
+        app: The `Flask` application, used to register the error handler that
+            turns `HasherBusy` into a 503 response.
+        workers: Number of worker processes (0 to hash on the calling thread).
+        max_queued: Number of hashes that may wait for a free worker before
+            `HasherBusy` is raised.
+        rounds: bcrypt cost factor for new hashes.
+    """
+    global _app, _workers, _max_queued, _rounds, _slots
+    _app = app
+    _workers = workers
+    _max_queued = max_queued
+    _rounds = rounds
+    _slots = threading.BoundedSemaphore(workers + max_queued) if workers > 0 else None
+    app.register_error_handler(HasherBusy, _hasher_busy)
+
+def hash_password(password: str) -> str:
+    """Hashes a password with bcrypt.
+
+    Raises:
+        HasherBusy: Too many hashes are already running or queued.
+
+    Returns:
+        The hash, as a string.
+    """
+    salt = bcrypt.gensalt(rounds=_rounds)
+    return _run(bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+def check_password(password_hash, password: str) -> bool:
+    """Checks a password against a bcrypt hash.
+
+    Args:
+        password_hash: The stored hash (string or bytes).
+        password: The password to check.
+
+    Raises:
+        HasherBusy: Too many hashes are already running or queued.
+
+    Returns:
+        True if the password matches the hash.
+    """
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode('utf-8')
+    candidate = _run(bcrypt.hashpw, password.encode('utf-8'), password_hash)
+    return hmac.compare_digest(candidate, password_hash)
+
+def hash_cost(password_hash):
+    """Returns the cost factor a bcrypt hash was made with (e.g. 12 for a
+    hash starting `$2b$12$`), or `None` if it isn't a bcrypt hash."""
+    if isinstance(password_hash, bytes):
+        password_hash = password_hash.decode('utf-8', 'replace')
+    parts = password_hash.split('$')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+def needs_rehash(password_hash) -> bool:
+    """Returns True if a bcrypt hash was made with a cost factor other than
+    the configured one."""
+    cost = hash_cost(password_hash)
+    return cost is not None and cost != _rounds
+
+def rehash_in_background(user_id: int, password_hash, password: str):
+    """Replaces a user's password hash with one at the configured cost,
+    without making the caller wait for it.
+
+    Call this after `check_password(password_hash, password)` succeeds for a
+    hash where `needs_rehash(password_hash)` is True. The new hash is only
+    saved if the stored hash is still `password_hash`. If the user already
+    has a rehash pending, or the hashing pool is busy, nothing happens: the
+    hash will be replaced on a later login instead.
+
+    Args:
+        user_id: The user whose hash to replace.
+        password_hash: The user's current (checked) hash.
+        password: The user's password.
+    """
+    global _rehash_executor
+    with _counters_lock:
+        if user_id in _pending_rehashes or len(_pending_rehashes) > _max_queued:
+            _counters['rehash_skipped'] += 1
+            return
+        _pending_rehashes.add(user_id)
+        if _rehash_executor is None:
+            _rehash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rehash')
+    _rehash_executor.submit(_rehash, user_id, password_hash, password)
+
+def _rehash(user_id, password_hash, password):
+    """Does the work for `rehash_in_background()`."""
+    try:
+        new_hash = hash_password(password)
+        with _app.app_context():
+            queries.execute(queries.UPDATE_USER_PASSWORD_IF_UNCHANGED,
+                            (new_hash, user_id, password_hash))
+        counter = 'rehashed'
+    except HasherBusy:
+        counter = 'rehash_skipped'
+    except Exception:
+        _app.logger.exception('Rehashing the password of user %s failed', user_id)
+        counter = 'rehash_skipped'
+    with _counters_lock:
+        _counters[counter] += 1
+        _pending_rehashes.discard(user_id)
+
+def make_pool(workers: int) -> ProcessPoolExecutor:
+    """Creates a process pool for bcrypt work.
+
+    The pool's processes are spawned (started as new interpreters) rather
+    than forked, so it is safe to call from any thread: forking a process
+    with other threads running can copy locks they hold into the child. Each
+    process is started on first need and imports the main module once, so a
+    script that builds the app at import time must run the server under
+    `if __name__ == '__main__':` (as app.py does).
+
+    Args:
+        workers: Number of worker processes.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def stats():
+    """Returns the pool size and admission counters (`in_flight` counts
+    hashes running or queued right now)."""
+    with _counters_lock:
+        return dict(_counters, workers=_workers, max_queued=_max_queued, rounds=_rounds)
+
+def _run(function, *args):
+    """Runs `function(*args)` on the pool (or inline if there's no pool) and
+    returns its result. If the pool is broken, it is replaced and the call
+    retried once."""
+    if _slots is None:
+        return function(*args)
+    executor = _get_executor()
+    try:
+        return _run_on(executor, function, *args)
+    except BrokenProcessPool:
+        _replace_executor(executor)
+        return _run_on(_get_executor(), function, *args)
+
+def _run_on(executor, function, *args):
+    """Runs `function(*args)` on `executor`, holding a slot while it runs or
+    waits."""
+    if not _slots.acquire(blocking=False):
+        with _counters_lock:
+            _counters['rejected'] += 1
+        raise HasherBusy()
+    try:
+        future = executor.submit(function, *args)
+    except Exception:
+        _slots.release()
+        raise
+    with _counters_lock:
+        _counters['submitted'] += 1
+        _counters['in_flight'] += 1
+    # Free the slot when the work finishes, not when this thread stops
+    # waiting for it.
+    future.add_done_callback(_finished)
+    return future.result()
+
+def _finished(future):
+    """Frees the slot held by a finished hash."""
+    with _counters_lock:
+        _counters['in_flight'] -= 1
+    _slots.release()
+
+def _get_executor():
+    """Returns the process pool, creating it if this process doesn't have one
+    yet (or the last one broke). A pool inherited from a parent process is
+    kept for the parent, and this process gets its own."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is not None and _executor_pid != os.getpid():
+            _inherited_executors.append(_executor)
+            _executor = None
+        if _executor is None:
+            _executor = make_pool(_workers)
+            _executor_pid = os.getpid()
+        return _executor
+
+def _replace_executor(broken):
+    """Drops a broken process pool, unless another thread already has."""
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def _after_fork():
+    """Runs in a newly forked child process: replaces the pool lock, which
+    another thread of the parent may have been holding. The child makes its
+    own pool on its first hash."""
+    global _executor_lock
+    _executor_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def _hasher_busy(error: HasherBusy):
+    """Error handler for requests turned away because too many password
+    hashes were queued."""
+    return ('The server is busy right now. Please try again in a moment.',
+            constants.HTTP_STATUS_CODE_503, {'Retry-After': '1'})
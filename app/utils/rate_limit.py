@@ -0,0 +1,188 @@
+"""
+rate_limit.py
+
+Sliding-window rate limits for the login and signup forms, and the signup
+form's username availability checks.
+
+Each submission of a limited form counts as one attempt against every key it
+is limited by, e.g. the client's IP address and the username it tried to log
+in as. A key that has made `limit` attempts within the last `window` seconds
+is refused until older attempts slide out of the window. Refused attempts are
+not counted, so a client that backs off gets back in on schedule.
+
+The window is tracked with two counters per key, one for the current fixed
+window and one for the previous one. The number of attempts in the sliding
+window is estimated as the current count plus the previous count weighted by
+how much of the previous window still overlaps the sliding one. This uses
+constant memory per key and is accurate enough for throttling.
+
+Counters live in one of two stores:
+    - `MemoryStore` (the default): a dictionary split into independently
+      locked shards, so concurrent requests rarely wait on each other. Limits
+      apply per app process.
+    - `RedisStore`: counters kept in Redis (or any server that speaks the
+      Redis protocol), so the limits are shared by every worker process.
+      It needs the `redis` package, which is only imported when it's used.
+
+Use `@rate_limited(...)` (see app/utils/decorators.py) on a view, or call
+`check()` directly.
+"""
+import threading
+import time
+import zlib
+
+# Kinds of key an action can be limited by.
+KEY_IP = 'ip'
+KEY_USERNAME = 'username'
+
+class MemoryStore:
+    """Counters kept in this process, in `shards` separately locked
+    dictionaries."""
+
+    def __init__(self, shards: int = 16):
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+        # A shard is swept of stale keys once it grows past this many keys.
+        self._sweep_at = [1024] * shards
+
+    def hit(self, key: str, now: float, window: float, limit: int):
+        """Counts an attempt by `key`, unless it's over the limit.
+
+        Returns:
+            A `(allowed, estimate)` tuple: whether the attempt was allowed,
+            and the estimated number of attempts in the sliding window before
+            this one.
+        """
+        index = zlib.crc32(key.encode('utf-8')) % len(self._shards)
+        lock, counters = self._shards[index]
+        bucket = int(now // window)
+        elapsed = (now % window) / window
+        with lock:
+            entry = counters.get(key)
+            if entry is None or entry[0] < bucket - 1:
+                entry = [bucket, 0, 0]
+            elif entry[0] == bucket - 1:
+                entry = [bucket, 0, entry[1]]
+            _, current, previous = entry
+            estimate = previous * (1 - elapsed) + current
+            allowed = estimate < limit
+            if allowed:
+                entry[1] += 1
+            counters[key] = entry
+            if len(counters) > self._sweep_at[index]:
+                for stale in [k for k, (b, _, _) in counters.items() if b < bucket - 1]:
+                    del counters[stale]
+                self._sweep_at[index] = max(1024, 2 * len(counters))
+        return allowed, estimate
+
+    def size(self):
+        """Returns the number of keys currently tracked."""
+        return sum(len(counters) for _, counters in self._shards)
+
+class RedisStore:
+    """Counters kept in Redis, shared by every process using the same server.
+
+    Args:
+        url: Redis URL, e.g. `redis://localhost:6379/0`.
+        prefix: Prefix added to every key.
+    """
+
+    def __init__(self, url: str, prefix: str = 'journey:ratelimit:'):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('A Redis rate limit store was configured, but the "redis" '
+                               'package is not installed.') from e
+        self._client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def hit(self, key: str, now: float, window: float, limit: int):
+        """Counts an attempt by `key`, unless it's over the limit (see
+        `MemoryStore.hit`)."""
+        bucket = int(now // window)
+        elapsed = (now % window) / window
+        current_key = f'{self.prefix}{key}:{bucket}'
+        pipeline = self._client.pipeline()
+        pipeline.incr(current_key)
+        pipeline.expire(current_key, int(2 * window) + 1)
+        pipeline.get(f'{self.prefix}{key}:{bucket - 1}')
+        current, _, previous = pipeline.execute()
+        # `current` includes this attempt.
+        estimate = int(previous or 0) * (1 - elapsed) + current - 1
+        allowed = estimate < limit
+        if not allowed:
+            # Refused attempts aren't counted.
+            self._client.decr(current_key)
+        return allowed, estimate
+
+    def size(self):
+        """Not tracked for Redis; always `None`."""
+        return None
+
+# The store, window and limits (see `init_rate_limits`).
+_store = None
+_window = 60.0
+_limits = {}
+
+# Allowed and refused attempts, keyed by "action:kind".
+_counters = {}
+_counters_lock = threading.Lock()
+
+def init_rate_limits(window: float, limits: dict, shards: int = 16, redis_url: str = ''):
+    """Sets up rate limiting.
+
+    Args:
+        window: Length of the sliding window in seconds.
+        limits: Attempts allowed per window, keyed by `(action, kind)`, e.g.
+            `('login', KEY_IP)`. A limit of 0 turns that limit off.
+        shards: Number of shards in the in-process store.
+        redis_url: URL of a Redis server to keep counters in, or an empty
+            string to keep them in this process.
+    """
+    global _store, _window, _limits
+    _store = RedisStore(redis_url) if redis_url else MemoryStore(shards)
+    _window = window
+    _limits = {rule: limit for rule, limit in limits.items() if limit > 0}
+    with _counters_lock:
+        _counters.clear()
+        for action, kind in _limits:
+            _counters[f'{action}:{kind}'] = dict(allowed=0, refused=0)
+
+def check(action: str, keys: dict):
+    """Counts an attempt at `action`, and decides whether to allow it.
+
+    This does no database or password work, so it can run before any.
+
+    Args:
+        action: Name of the action, e.g. 'login'.
+        keys: The attempt's key of each kind, e.g.
+            `{KEY_IP: '10.0.0.1', KEY_USERNAME: 'alice'}`. Empty keys and
+            kinds with no limit for this action are skipped.
+
+    Returns:
+        `None` if the attempt is allowed, otherwise the number of seconds to
+        wait before trying again.
+    """
+    now = time.time()
+    for kind, key in keys.items():
+        limit = _limits.get((action, kind))
+        if not limit or not key:
+            continue
+        allowed, _ = _store.hit(f'{action}:{kind}:{key}', now, _window, limit)
+        with _counters_lock:
+            _counters[f'{action}:{kind}']['allowed' if allowed else 'refused'] += 1
+        if not allowed:
+            # A hint only: by the end of the current window, the oldest
+            # attempts have started sliding out.
+            return max(1, int(_window - now % _window))
+    return None
+
+def stats():
+    """Returns the allowed/refused counters for each limit."""
+    with _counters_lock:
+        counters = {name: dict(values) for name, values in _counters.items()}
+    return dict(limits=counters, window=_window, tracked_keys=_store.size() if _store else 0)
+
+def normalise_username(username):
+    """Returns the form of a username used as a rate limit key, so that e.g.
+    'Alice' and ' alice' count against the same limit."""
+    return (username or '').strip().lower()
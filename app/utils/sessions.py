@@ -0,0 +1,502 @@
+"""
+sessions.py
+
+Server-side sessions.
+
+Flask's default sessions live entirely in a signed cookie, so the server can't
+end one: a cookie saved before logging out keeps working, and a banned user
+stays logged in until they log out themselves. Here the cookie only holds a
+random session ID, and the session itself is kept on the server:
+    - Every session is held in memory as a compact record (user_id, role,
+      status, when it was issued and last used, plus any other session data),
+      in a dictionary keyed by session ID and indexed by user_id. Looking a
+      session up on each request is a dictionary lookup, with no database
+      round trip.
+    - Records are also written to a local SQLite file, so they survive a
+      restart and can be shared by several worker processes on one host.
+      Creating, deleting, revoking and changing the data of a session (e.g.
+      a flashed message) is written straight away; only when the session
+      was last used is written behind, in batches, by a background thread.
+    - `revoke_user()` and `update_user()` end or change every session of a
+      user, using the user_id index. Each change (and each change to a
+      session's data) is also logged in the SQLite file, and every process
+      checks that log at most every `poll_interval` seconds and drops its
+      in-memory copies of the affected sessions, so no process can keep
+      serving a revoked session, or data another process has since changed.
+
+Only sessions of a logged-in user are kept on the server. Before logging in
+(e.g. a flashed "invalid password" message), the session stays in a signed
+cookie as with Flask's default sessions, so requests from visitors who never
+log in can't fill the store.
+
+The app's code keeps using `flask.session` as usual. After a successful login,
+call `session.regenerate()` so that the user gets a fresh session ID.
+"""
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from itsdangerous import BadSignature
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface
+from app.config import constants
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    sid TEXT PRIMARY KEY,
+    user_id INTEGER,
+    role TEXT,
+    status TEXT,
+    issued_at REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_user_id ON sessions (user_id);
+CREATE TABLE IF NOT EXISTS session_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin INTEGER NOT NULL,
+    sid TEXT,
+    user_id INTEGER,
+    created_at REAL NOT NULL
+);
+'''
+
+# Session keys kept as fields of the record rather than in its data.
+_RECORD_FIELDS = ((constants.USER_ID, 'user_id'),
+                  (constants.USER_ROLE, 'role'),
+                  (constants.USER_STATUS, 'status'))
+
+# How often (in seconds) a used session's `last_seen` time is updated, and
+# idle sessions are cleared out.
+_TOUCH_INTERVAL = 60.0
+
+class ServerSideSession(SecureCookieSession):
+    """The session object used for each request (see `flask.session`).
+
+    Args:
+        initial: The session's data.
+        sid: Session ID, or `None` for a new session.
+        issued_at: When the session ID was issued.
+    """
+
+    def __init__(self, initial=None, sid=None, issued_at=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.issued_at = issued_at
+        self.rotate = False
+
+    def regenerate(self):
+        """Gives the session a new ID when the response is sent, and ends the
+        old one. Call this after logging a user in."""
+        self.rotate = True
+        self.modified = True
+
+class SessionStore:
+    """In-memory session records with a SQLite copy.
+
+    Args:
+        path: Path of the SQLite file.
+        idle_timeout: Seconds a session can go unused before it ends.
+        last_seen_flush_interval: Seconds between writes of the `last_seen`
+            times of the sessions used since the last write.
+        poll_interval: Seconds between checks for sessions changed or revoked
+            by other processes.
+    """
+
+    def __init__(self, path: str, idle_timeout: float, last_seen_flush_interval: float, poll_interval: float):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.last_seen_flush_interval = last_seen_flush_interval
+        self.poll_interval = poll_interval
+
+        # `_lock` guards every dictionary below.
+        self._lock = threading.Lock()
+        self._records = {}
+        self._by_user = {}
+        # Session IDs whose `last_seen` time needs writing behind.
+        self._dirty = set()
+        self._counters = dict(hits=0, loads=0, created=0, ended=0, revoked=0, flushed=0)
+
+        # The SQLite connection, flusher thread and last event seen all belong
+        # to the process that created them (see `_connection`).
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._last_seq = 0
+        self._last_poll = 0.0
+        self._last_expire = 0.0
+
+    def get(self, sid: str):
+        """Returns a copy of a session's record, or `None` if the session has
+        ended."""
+        now = time.time()
+        if now - self._last_poll >= self.poll_interval:
+            self._poll(now)
+
+        with self._lock:
+            record = self._records.get(sid)
+            if record is not None:
+                self._counters['hits'] += 1
+        if record is None:
+            record = self._load(sid)
+            if record is None:
+                return None
+        if now - record['last_seen'] > self.idle_timeout:
+            self.delete(sid)
+            return None
+        return dict(record)
+
+    def create(self, record: dict):
+        """Stores a new session record and returns its session ID."""
+        sid = secrets.token_urlsafe(32)
+        record = dict(record, sid=sid)
+        with self._lock:
+            self._remember(record)
+            self._counters['created'] += 1
+        with self._db_lock:
+            self._connection().execute(
+                'INSERT INTO sessions (sid, user_id, role, status, issued_at, last_seen, data) '
+                'VALUES (:sid, :user_id, :role, :status, :issued_at, :last_seen, :data)',
+                dict(record, data=json.dumps(record['data'])))
+        return sid
+
+    def update(self, sid: str, data: dict, last_seen: float):
+        """Changes a session's data. The change is written straight away, and
+        other processes drop their copies of the session at their next poll."""
+        with self._lock:
+            record = self._records.get(sid)
+        if record is None and self._load(sid) is None:
+            # The session has ended.
+            return
+        with self._lock:
+            record = self._records.get(sid)
+            if record is not None:
+                record['data'] = data
+                record['last_seen'] = last_seen
+                self._dirty.discard(sid)
+        with self._db_lock:
+            db = self._connection()
+            # Only ever update an existing row: a session revoked by another
+            # process in the meantime must stay deleted.
+            db.execute('UPDATE sessions SET data = ?, last_seen = ? WHERE sid = ?',
+                       (json.dumps(data), last_seen, sid))
+            self._log_event(db, sid=sid)
+
+    def touch(self, sid: str, last_seen: float):
+        """Records that a session was used (written behind)."""
+        with self._lock:
+            record = self._records.get(sid)
+            if record is not None:
+                record['last_seen'] = last_seen
+                self._dirty.add(sid)
+
+    def delete(self, sid: str):
+        """Ends a session."""
+        with self._lock:
+            self._forget(sid)
+            self._counters['ended'] += 1
+        with self._db_lock:
+            db = self._connection()
+            db.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+            self._log_event(db, sid=sid)
+
+    def revoke_user(self, user_id: int):
+        """Ends every session of a user.
+
+        Returns:
+            The number of sessions this process had in memory for the user.
+        """
+        with self._lock:
+            sids = list(self._by_user.get(user_id, ()))
+            for sid in sids:
+                self._forget(sid)
+            self._counters['revoked'] += len(sids)
+        with self._db_lock:
+            db = self._connection()
+            db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+            self._log_event(db, user_id=user_id)
+        return len(sids)
+
+    def update_user(self, user_id: int, role: str, status: str):
+        """Changes the role and status recorded in every session of a user."""
+        with self._lock:
+            for sid in self._by_user.get(user_id, ()):
+                self._records[sid].update(role=role, status=status)
+        with self._db_lock:
+            db = self._connection()
+            db.execute('UPDATE sessions SET role = ?, status = ? WHERE user_id = ?',
+                       (role, status, user_id))
+            self._log_event(db, user_id=user_id)
+
+    def flush(self):
+        """Writes every pending `last_seen` time to the SQLite file."""
+        with self._lock:
+            rows = [(self._records[sid]['last_seen'], sid)
+                    for sid in self._dirty if sid in self._records]
+            self._dirty.clear()
+        if not rows:
+            return
+        with self._db_lock:
+            db = self._connection()
+            # Only ever update existing rows: a session revoked by another
+            # process in the meantime must stay deleted.
+            db.execute('BEGIN')
+            db.executemany('UPDATE sessions SET last_seen = ? WHERE sid = ?', rows)
+            db.executemany('INSERT INTO session_events (origin, sid, created_at) VALUES (?, ?, ?)',
+                           [(os.getpid(), sid, time.time()) for _, sid in rows])
+            db.execute('COMMIT')
+        with self._lock:
+            self._counters['flushed'] += len(rows)
+
+    def stats(self):
+        """Returns the store's counters and size."""
+        with self._lock:
+            return dict(self._counters, sessions=len(self._records), users=len(self._by_user),
+                        pending_writes=len(self._dirty))
+
+    def _remember(self, record):
+        """Adds a record to memory and the user_id index (hold `_lock`)."""
+        self._records[record['sid']] = record
+        if record['user_id'] is not None:
+            self._by_user.setdefault(record['user_id'], set()).add(record['sid'])
+
+    def _forget(self, sid):
+        """Drops a record from memory and the user_id index (hold `_lock`)."""
+        record = self._records.pop(sid, None)
+        self._dirty.discard(sid)
+        if record is not None and record['user_id'] is not None:
+            sids = self._by_user.get(record['user_id'])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._by_user[record['user_id']]
+        return record
+
+    def _load(self, sid):
+        """Loads a session another process created (or that this process
+        dropped) from the SQLite file."""
+        with self._db_lock:
+            row = self._connection().execute(
+                'SELECT sid, user_id, role, status, issued_at, last_seen, data '
+                'FROM sessions WHERE sid = ?', (sid,)).fetchone()
+        if row is None:
+            return None
+        record = dict(zip(('sid', 'user_id', 'role', 'status', 'issued_at', 'last_seen', 'data'), row))
+        record['data'] = json.loads(record['data'])
+        with self._lock:
+            self._remember(record)
+            self._counters['loads'] += 1
+        return record
+
+    def _log_event(self, db, sid=None, user_id=None):
+        """Tells other processes to drop their copies of a session, or of
+        every session of a user."""
+        db.execute('INSERT INTO session_events (origin, sid, user_id, created_at) VALUES (?, ?, ?, ?)',
+                   (os.getpid(), sid, user_id, time.time()))
+
+    def _poll(self, now):
+        """Drops in-memory sessions that other processes have changed or
+        ended since the last poll."""
+        self._last_poll = now
+        with self._db_lock:
+            events = self._connection().execute(
+                'SELECT seq, origin, sid, user_id FROM session_events WHERE seq > ? ORDER BY seq',
+                (self._last_seq,)).fetchall()
+        if not events:
+            return
+        self._last_seq = events[-1][0]
+        pid = os.getpid()
+        with self._lock:
+            for _, origin, sid, user_id in events:
+                if origin == pid:
+                    continue
+                if sid is not None:
+                    self._forget(sid)
+                if user_id is not None:
+                    for user_sid in list(self._by_user.get(user_id, ())):
+                        self._forget(user_sid)
+
+    def _connection(self):
+        """Returns this process's SQLite connection (hold `_db_lock`),
+        opening it and starting the flusher thread on first use."""
+        if self._db is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+                                       check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(_SCHEMA)
+            self._last_seq = self._db.execute(
+                'SELECT COALESCE(MAX(seq), 0) FROM session_events').fetchone()[0]
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_forever, name='session-flush', daemon=True).start()
+        return self._db
+
+    def _flush_forever(self):
+        """Flusher thread: writes pending `last_seen` times every
+        `last_seen_flush_interval` seconds, and clears out idle sessions now
+        and then."""
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.last_seen_flush_interval)
+            try:
+                self.flush()
+                now = time.time()
+                if now - self._last_expire >= _TOUCH_INTERVAL:
+                    self._last_expire = now
+                    self._expire(now)
+            except sqlite3.Error:
+                # Try again with the next batch.
+                pass
+
+    def _expire(self, now):
+        """Drops sessions that have been idle for too long, and old events."""
+        cutoff = now - self.idle_timeout
+        with self._lock:
+            for sid in [sid for sid, record in self._records.items() if record['last_seen'] < cutoff]:
+                self._forget(sid)
+        with self._db_lock:
+            db = self._connection()
+            db.execute('DELETE FROM sessions WHERE last_seen < ?', (cutoff,))
+            # Every process polls far more often than this.
+            db.execute('DELETE FROM session_events WHERE created_at < ?', (now - 3600,))
+
+class ServerSideSessionInterface(SecureCookieSessionInterface):
+    """Flask session interface that keeps logged-in sessions in a
+    `SessionStore`, and the others in a signed cookie."""
+
+    session_class = ServerSideSession
+
+    def __init__(self, store: SessionStore):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and '.' in sid:
+            # A signed cookie (session IDs never contain a dot).
+            return self._open_signed(app, sid)
+        record = self.store.get(sid) if sid else None
+        if record is None:
+            return self.session_class()
+        data = dict(record['data'])
+        for key, field in _RECORD_FIELDS:
+            if record[field] is not None:
+                data[key] = record[field]
+        session = self.session_class(data, sid=sid, issued_at=record['issued_at'])
+        session.last_seen = record['last_seen']
+        session.identity = _identity(data)
+        return session
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        partitioned = self.get_cookie_partitioned(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # An emptied session (e.g. after logging out) is ended, and the cookie
+        # is removed.
+        if not session:
+            if session.modified:
+                if session.sid is not None:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       partitioned=partitioned, samesite=samesite,
+                                       httponly=httponly)
+                response.vary.add('Cookie')
+            return
+
+        now = time.time()
+        data = {key: value for key, value in session.items()
+                if key not in dict(_RECORD_FIELDS)}
+        identity = _identity(session)
+        if identity[0] is None:
+            # Not logged in: keep the session in the cookie.
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                session.sid = None
+            elif not session.modified:
+                return
+            value = self.get_signing_serializer(app).dumps(dict(session))
+            response.set_cookie(name, value, expires=self.get_expiration_time(app, session),
+                                httponly=httponly, domain=domain, path=path, secure=secure,
+                                partitioned=partitioned, samesite=samesite)
+            response.vary.add('Cookie')
+            return
+        if session.sid is None or session.rotate or identity != getattr(session, 'identity', None):
+            # A new session, or a different user or role: issue a new ID so
+            # that a session ID known before logging in can't be reused.
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            session.sid = self.store.create(dict(zip(('user_id', 'role', 'status'), identity),
+                                                 issued_at=now, last_seen=now, data=data))
+        elif session.modified:
+            self.store.update(session.sid, data, now)
+        else:
+            if now - session.last_seen >= _TOUCH_INTERVAL:
+                self.store.touch(session.sid, now)
+            return
+
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=httponly, domain=domain, path=path, secure=secure,
+                            partitioned=partitioned, samesite=samesite)
+        response.vary.add('Cookie')
+
+    def _open_signed(self, app, value):
+        """Opens a session kept in a signed cookie (an empty one if the
+        signature is wrong or has expired)."""
+        try:
+            data = self.get_signing_serializer(app).loads(
+                value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return self.session_class()
+        # Only data is kept in the cookie: a logged-in identity is never
+        # trusted from it.
+        for key, _ in _RECORD_FIELDS:
+            data.pop(key, None)
+        return self.session_class(data)
+
+def _identity(data):
+    """Returns the `(user_id, role, status)` of a session's data."""
+    return tuple(data.get(key) for key, _ in _RECORD_FIELDS)
+
+# The app's session store (see `init_sessions`).
+store = None
+
+def init_sessions(app, path: str, idle_timeout: float, last_seen_flush_interval: float, poll_interval: float):
+    """Replaces the app's cookie sessions with server-side sessions.
+
+    Args:
+        app: The `Flask` application.
+        path: Path of the SQLite file sessions are written to.
+        idle_timeout: Seconds a session can go unused before it ends.
+        last_seen_flush_interval: Seconds between writes of the `last_seen`
+            times of the sessions used since the last write (the only part
+            of a session that is written behind).
+        poll_interval: Seconds between checks for sessions changed or ended by
+            other processes.
+    """
+    global store
+    store = SessionStore(path, idle_timeout, last_seen_flush_interval, poll_interval)
+    app.session_interface = ServerSideSessionInterface(store)
+
+def revoke_user(user_id):
+    """Ends every session of a user (e.g. because they've been banned)."""
+    return store.revoke_user(int(user_id))
+
+def update_user(user_id, role: str, status: str):
+    """Applies a change to a user's role or status to all of their sessions.
+    Banning a user ends their sessions."""
+    if status == constants.USER_STATUS_BANNED:
+        revoke_user(user_id)
+    else:
+        store.update_user(int(user_id), role, status)
+
+def stats():
+    """Returns the session store's counters."""
+    return store.stats()
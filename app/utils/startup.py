@@ -0,0 +1,47 @@
+"""
+startup.py
+
+Records how long each phase of building the app took (see `create_app()` in
+app/__init__.py), so slow startups can be traced to the step responsible:
+```
+>>> with startup.phase('database'):
+>>>     db.init_db(app, ...)
+>>> startup.report()
+{'pid': 4242, 'total_ms': 41.7, 'phases': [{'phase': 'database', 'ms': 0.2}, ...]}
+```
+
+The report is shown by `flask startup report` (see app/cli.py) and on the
+admin statistics page. It describes the process that built the app: under
+`gunicorn --preload` that is the master, and every worker forked from it
+shares the same report.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+# `(phase, seconds)` pairs in the order the phases ran, and the process that
+# ran them.
+_phases = []
+_pid = None
+
+def reset():
+    """Forgets the phases of an earlier startup (call before the first
+    phase)."""
+    global _pid
+    _phases.clear()
+    _pid = os.getpid()
+
+@contextmanager
+def phase(name: str):
+    """Times the block as startup phase `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - start))
+
+def report():
+    """Returns the startup phases and their cost, in the order they ran."""
+    phases = [dict(phase=name, ms=round(seconds * 1000, 1)) for name, seconds in _phases]
+    return dict(pid=_pid, total_ms=round(sum(seconds for _, seconds in _phases) * 1000, 1),
+                phases=phases)
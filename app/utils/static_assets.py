@@ -0,0 +1,228 @@
+"""
+static_assets.py
+
+Long-lived HTTP caching for the files under `app/static`.
+
+At startup every file under `app/static` (except the uploads) is hashed into
+a manifest, and `url_for('static', filename=...)` puts the file's
+fingerprint into its URL:
+```
+>>> url_for('static', filename='css/base.css')
+'/static/css/base.3f2a1c9d0e4b.css'
+```
+A fingerprinted URL always names the same bytes, so it is served with
+`Cache-Control: public, max-age=..., immutable` and browsers never ask for it
+again; changing the file changes its URL. Content-addressed uploads (see
+app/utils/images.py) already have the digest in their names, so they are
+served the same way. Every other URL (other uploads, or a hand-written
+`/static/...` path) is served with `Cache-Control: no-cache`, so browsers
+revalidate it with its ETag, which is the file's SHA-256 digest.
+
+Text files can be served precompressed. `flask static compress` (see
+app/cli.py) writes a `.gz` copy of each next to it, and a `.br` copy as well
+if the optional `brotli` package is installed. They are picked up at startup
+and chosen according to the request's `Accept-Encoding`.
+
+The files can also be handed off to the web server in front of the app
+(`STATIC_SENDFILE`):
+    - `x-sendfile` (Apache's mod_xsendfile, lighttpd): the response carries the
+      file's absolute path in an `X-Sendfile` header.
+    - `x-accel-redirect` (nginx): the response carries the file's path under
+      `STATIC_ACCEL_PREFIX` in an `X-Accel-Redirect` header, with a matching
+      internal location, e.g.:
+      ```
+      location /protected-static/ {
+          internal;
+          alias /path/to/app/static/;
+      }
+      ```
+The app still sets the caching headers, and answers conditional requests
+itself, in both cases.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from flask import abort, current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+# Length of the fingerprint put into URLs (hex digits of the SHA-256 digest).
+FINGERPRINT_LENGTH = 12
+
+# Extensions of the files worth compressing.
+COMPRESSIBLE = ('.css', '.js', '.svg', '.txt', '.json', '.html', '.map')
+
+# Content codings, best first, and the extension of their precompressed copies.
+_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_FINGERPRINTED = re.compile(rf'(?P<stem>.+)\.[0-9a-f]{{{FINGERPRINT_LENGTH}}}(?P<ext>\.\w+)')
+_CONTENT_ADDRESSED_UPLOAD = re.compile(r'uploads/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+\.webp')
+
+# Settings (see `init_static`).
+_static_folder = None
+_sendfile = ''
+_accel_prefix = '/protected-static/'
+_max_age = 31536000
+
+# The manifest: SHA-256 digests keyed by path (relative to the static
+# folder), the paths keyed by their fingerprinted path, and the content codings
+# each path has a precompressed copy for.
+_digests = {}
+_fingerprinted = {}
+_encodings = {}
+
+def init_static(app, sendfile: str = '', accel_prefix: str = '/protected-static/', max_age: int = 31536000):
+    """Builds the static file manifest and takes over serving `/static/`.
+
+    Args:
+        app: The `Flask` application.
+        sendfile: '' to send files from the app, or 'x-sendfile' or
+            'x-accel-redirect' to hand them off to the web server.
+        accel_prefix: Internal URL prefix the web server maps to the static
+            folder (for 'x-accel-redirect').
+        max_age: Seconds browsers may cache fingerprinted files for.
+    """
+    global _static_folder, _sendfile, _accel_prefix, _max_age
+    if sendfile not in ('', 'x-sendfile', 'x-accel-redirect'):
+        raise ValueError(f'Unknown STATIC_SENDFILE value "{sendfile}".')
+    _static_folder = app.static_folder
+    _sendfile = sendfile
+    _accel_prefix = accel_prefix.rstrip('/') + '/'
+    _max_age = max_age
+    app.config['USE_X_SENDFILE'] = sendfile == 'x-sendfile'
+    build_manifest()
+    app.url_defaults(_fingerprint_url)
+    app.view_functions['static'] = serve_static
+
+def build_manifest():
+    """Hashes every static file (except uploads and precompressed copies), and
+    notes which have up-to-date precompressed copies."""
+    digests, fingerprinted, encodings = {}, {}, {}
+    for path in _static_files():
+        with open(os.path.join(_static_folder, path), 'rb') as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        digests[path] = digest
+        fingerprinted[fingerprint(path, digest)] = path
+        source_mtime = os.stat(os.path.join(_static_folder, path)).st_mtime
+        for coding, extension in _ENCODINGS:
+            try:
+                if os.stat(os.path.join(_static_folder, path + extension)).st_mtime >= source_mtime:
+                    encodings.setdefault(path, []).append(coding)
+            except FileNotFoundError:
+                pass
+    _digests.clear()
+    _digests.update(digests)
+    _fingerprinted.clear()
+    _fingerprinted.update(fingerprinted)
+    _encodings.clear()
+    _encodings.update(encodings)
+
+def fingerprint(path: str, digest: str) -> str:
+    """Returns `path` with the fingerprint of `digest` before its extension,
+    e.g. `css/base.3f2a1c9d0e4b.css`."""
+    stem, extension = os.path.splitext(path)
+    return f'{stem}.{digest[:FINGERPRINT_LENGTH]}{extension}'
+
+def compress():
+    """Writes precompressed copies of the compressible static files, and
+    rebuilds the manifest.
+
+    Returns:
+        The number of copies written.
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    written = 0
+    for path in _static_files():
+        if not path.endswith(COMPRESSIBLE):
+            continue
+        source = os.path.join(_static_folder, path)
+        with open(source, 'rb') as file:
+            data = file.read()
+        copies = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            copies['.br'] = brotli.compress(data)
+        for extension, compressed in copies.items():
+            # Only worth serving if it is actually smaller.
+            if len(compressed) < len(data):
+                with open(source + extension, 'wb') as file:
+                    file.write(compressed)
+                written += 1
+    build_manifest()
+    return written
+
+def serve_static(filename):
+    """Serves a file from the static folder (replaces Flask's `static`
+    view)."""
+    path = _fingerprinted.get(filename)
+    immutable = path is not None or _CONTENT_ADDRESSED_UPLOAD.fullmatch(filename) is not None
+    if path is None:
+        path = filename
+        # A fingerprint from an earlier version of the file (e.g. a page
+        # cached before a deploy): serve the current file, without letting it
+        # be cached as that URL's content.
+        match = _FINGERPRINTED.fullmatch(filename)
+        if match is not None and filename not in _digests:
+            current = match.group('stem') + match.group('ext')
+            if current in _digests:
+                path = current
+
+    coding = None
+    for candidate in _encodings.get(path, ()):
+        if request.accept_encodings[candidate]:
+            coding = candidate
+            break
+    extension = dict(_ENCODINGS)[coding] if coding else ''
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    digest = _digests.get(path)
+    etag = f'{digest}-{coding}' if digest and coding else digest
+
+    if _sendfile == 'x-accel-redirect':
+        full_path = safe_join(_static_folder, path)
+        if full_path is None or not os.path.isfile(full_path):
+            abort(404)
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = _accel_prefix + path + extension
+        if etag:
+            response.set_etag(etag)
+        response.make_conditional(request)
+    else:
+        # Answers conditional and range requests too.
+        response = send_from_directory(_static_folder, path + extension, mimetype=mimetype,
+                                       etag=etag or True)
+    if coding:
+        response.headers['Content-Encoding'] = coding
+    if path in _encodings:
+        response.vary.add('Accept-Encoding')
+    if immutable:
+        response.headers['Cache-Control'] = f'public, max-age={_max_age}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _fingerprint_url(endpoint, values):
+    """`url_defaults` callback: fingerprints the URLs of static files in the
+    manifest."""
+    if endpoint == 'static':
+        filename = values.get('filename')
+        digest = _digests.get(filename)
+        if digest is not None:
+            values['filename'] = fingerprint(filename, digest)
+
+def _static_files():
+    """Yields the paths (relative to the static folder, with `/` separators)
+    of the files in the manifest."""
+    for folder, folders, filenames in os.walk(_static_folder):
+        relative = os.path.relpath(folder, _static_folder)
+        if relative == '.':
+            # Uploads change at run time; content-addressed ones are already
+            # fingerprinted by name.
+            folders[:] = [name for name in folders if name != 'uploads']
+            relative = ''
+        for filename in filenames:
+            if filename.endswith(tuple(extension for _, extension in _ENCODINGS)):
+                continue
+            yield os.path.join(relative, filename).replace(os.sep, '/')
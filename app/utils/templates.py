@@ -0,0 +1,161 @@
+"""
+templates.py
+
+Template loading and caching:
+    - `TemplateIndex`: a Jinja loader that finds every template through one
+      dictionary lookup. The templates are found by name relative to
+      `templates/` or to any of the folders in `SEARCH_FOLDERS` (so
+      `render_template('users.html')` finds `templates/user/users.html`), and
+      the index of names is built once at startup rather than probing each
+      folder on every render.
+    - A bytecode cache: compiled templates are written to a folder shared by
+      every worker process, so a template is compiled once per deploy rather
+      than once per worker (`flask templates compile`, see app/cli.py, fills
+      it ahead of time).
+    - The `{% cache %}` tag, which keeps the rendered HTML of a block in an
+      in-process cache:
+      ```
+      {% for user in users %}
+          {% cache ('user_row', user.values()|list), 300 %}
+              <tr>...</tr>
+          {% endcache %}
+      {% endfor %}
+      ```
+      The first expression is the key and the second the seconds to keep the
+      HTML for (`TEMPLATE_FRAGMENT_TTL` if it is left out). The key must
+      include everything the block shows: the rows it renders, and anything
+      about the viewer it depends on. Nothing is invalidated: a changed row
+      makes a new key, and the fragment cached under the old one is evicted
+      or expires.
+"""
+import os
+import threading
+import time
+from jinja2 import BaseLoader, FileSystemBytecodeCache, TemplateNotFound, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from app.utils.cache import MISSING, TTLCache
+
+# Folders under `templates/` whose templates can also be found by the name
+# relative to the folder, in the order they are searched.
+SEARCH_FOLDERS = ('base', 'auth', 'home', 'user', 'event')
+
+# Rendered fragments keyed by template name and `repr()` of the key (`None`
+# when fragment caching is off), and the default time to keep them for. Set
+# by `init_templates`.
+_fragments: TTLCache = None
+_fragment_ttl = 300.0
+
+class TemplateIndex(BaseLoader):
+    """A Jinja loader that looks templates up in an index of names built up
+    front.
+
+    A name that isn't in the index rebuilds it once before the template is
+    reported missing, so templates added while the app runs are still found.
+
+    Args:
+        root: The `templates` folder.
+        search_folders: Folders under `root` whose templates can also be
+            found by the name relative to the folder (the first folder with a
+            template of that name wins, and `root` itself comes first).
+    """
+
+    def __init__(self, root: str, search_folders=SEARCH_FOLDERS):
+        self.root = root
+        self.search_folders = search_folders
+        self._paths = {}
+        self._lock = threading.Lock()
+        self.build()
+
+    def build(self):
+        """Indexes every template under the search folders."""
+        paths = {}
+        for folder in (self.root, *(os.path.join(self.root, name) for name in self.search_folders)):
+            for directory, _, filenames in sorted(os.walk(folder, followlinks=True)):
+                for filename in sorted(filenames):
+                    path = os.path.join(directory, filename)
+                    paths.setdefault(os.path.relpath(path, folder).replace(os.sep, '/'), path)
+        with self._lock:
+            self._paths = paths
+
+    def get_source(self, environment, template):
+        path = self._paths.get(template)
+        if path is None:
+            self.build()
+            path = self._paths.get(template)
+        if path is None:
+            raise TemplateNotFound(template)
+        try:
+            with open(path, encoding='utf-8') as file:
+                source = file.read()
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            raise TemplateNotFound(template)
+
+        def uptodate():
+            try:
+                return os.path.getmtime(path) == mtime
+            except OSError:
+                return False
+        return source, path, uptodate
+
+    def list_templates(self):
+        return sorted(self._paths)
+
+class FragmentCacheExtension(Extension):
+    """The `{% cache key, ttl %}...{% endcache %}` tag (see the module
+    docstring)."""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        args.append(parser.parse_expression() if parser.stream.skip_if('comma') else nodes.Const(None))
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, template_name, key, ttl, caller):
+        if _fragments is None:
+            return caller()
+        key = f'{template_name}:{key!r}'
+        html = _fragments.get(key)
+        if html is MISSING:
+            html = Markup(caller())
+            _fragments.set(key, html, _fragment_ttl if ttl is None else ttl)
+        return html
+
+def init_templates(app, bytecode_cache_path: str, fragment_cache_size: int, fragment_ttl: float):
+    """Sets up template loading, the bytecode cache and the `{% cache %}` tag.
+
+    Args:
+        app: The `Flask` application.
+        bytecode_cache_path: Folder compiled templates are written to.
+        fragment_cache_size: Most fragments cached in this process (0 to
+            render `{% cache %}` blocks every time).
+        fragment_ttl: Seconds a fragment is cached for when its tag doesn't
+            say.
+    """
+    global _fragments, _fragment_ttl
+    app.jinja_loader = TemplateIndex(os.path.join(app.root_path, app.template_folder))
+    os.makedirs(bytecode_cache_path, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_path)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    _fragments = TTLCache(fragment_cache_size, fragment_ttl) if fragment_cache_size > 0 else None
+    _fragment_ttl = fragment_ttl
+
+def compile_all(app):
+    """Compiles every template into the bytecode cache.
+
+    Returns:
+        A `(compiled, seconds)` tuple.
+    """
+    start = time.perf_counter()
+    names = app.jinja_loader.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names), time.perf_counter() - start
+
+def stats():
+    """Returns the fragment cache counters (`{"enabled": false}` if fragment
+    caching is off)."""
+    return _fragments.stats() if _fragments is not None else {'enabled': False}
@@ -1,110 +1,279 @@
 # validators.py
+#
+# The rules for every form field in the app, declared once and shared by the
+# routes that accept the field (and by the bulk event import, see
+# app/utils/event_io.py):
+# ```
+# >>> errors = validators.SIGNUP_FORM.validate(request.form)
+# >>> errors
+# {'username': 'Your username can only contain letters and numbers.',
+#  'password': 'Password must contain at least one digit.'}
+# ```
+# `Form.validate()` checks every field of a form in one call and returns the
+# first problem with each field (an empty dictionary if there are none).
+#
+# Each `Field` is compiled when this module is imported into a list of
+# checks. Checks on the characters of a value (allowed characters, required
+# kinds of character) don't use regular expressions: the value's distinct
+# characters are collected in a single pass (`frozenset(value)`), and each
+# check is then a set comparison against a precomputed character class.
+# `flask validators benchmark` (see app/cli.py) times every form.
+#
+# Whether a username or email is already in use is a database question, so it
+# is not a field rule: signup leaves it to the UNIQUE constraints on `users`
+# (see `signup()` in app/routes/user.py), and the profile form checks it with
+# `email_taken()`.
 
-import re
-from app.db import db
+import string
+from datetime import datetime
+from app.db import queries
 from app.config import constants
 
-def validate_username(username):
-    if len(username) > 20:
-        # The user should never see this error during normal conditions,
-        # because we set a maximum length of 20 on the input field in the
-        # template. However, a user or attacker could easily override that
-        # and submit a longer value, so we need to handle that case.
-        return 'Your username cannot exceed 20 characters.'
-    elif not re.match(r'[A-Za-z0-9]+', username):
-        return 'Your username can only contain letters and numbers.'
-    else:
-        # check if the username already exists in the database and ensure the username is unique
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT user_id FROM users WHERE username = %s',(username,))
-            username_exists = cursor.fetchone() is not None
-            if username_exists:
-                return 'Username already exists. Please choose a different username.'
-    return ''
-
-def validate_firstname(firstname):
-    if len(firstname) > 50:
-        return 'Your first name cannot exceed 50 characters.'
-    elif firstname and not firstname.strip():
-        # Check if the name is empty (consisting only of spaces or an empty string).
-        return "First name cannot be just whitespace. Please enter a valid name."
-    return ''
-
-def validate_lastname(lastname):
-    if len(lastname) > 50:
-        return 'Your last name cannot exceed 50 characters.'
-    elif lastname and not lastname.strip():
-        # Check if the name is empty (consisting only of spaces or an empty string).
-        return "Last name cannot be just whitespace. Please enter a valid name."
-    return ''
-
-    # Validate the new user's email address. Note: The regular expression
-    # we use here isn't a perfect check for a valid address, but is
-    # sufficient for this example.
-def validate_email(email, request_url, user_id):
-    if len(email) > 320:
-        # As above, the user should never see this error under normal
-        # conditions because we set a maximum input length in the template.
-        return 'Your email address cannot exceed 320 characters.'
-    elif not re.match(r'[^@]+@[^@]+\.[^@]+', email):
-        return 'Invalid email address.'
-    # Check email uniqueness
-    with db.get_cursor() as cursor:
-        cursor.execute('SELECT user_id FROM users WHERE email = %s', (email,))
-        existing_user = cursor.fetchone()
-
-        if existing_user:
-            existing_user_id = existing_user[constants.USER_ID]
-
-            if request_url == constants.URL_PROFILE:
-                # Allow user to keep their own email, but prevent duplicates
-                if existing_user_id != int(user_id):
-                    return 'Email already exists. Please choose a different email.'
-            else:
-                # If not updating profile, email must be unique
-                return 'Email already exists. Please choose a different email.'
-
-    return ''
-
-def validate_location(location):
-    if len(location) > 50:
-        return 'Your location content cannot exceed 50 characters.'
-    elif location and not location.strip():
-        # Check if the location is empty (consisting only of spaces or an empty string).
-        return "Location cannot be just whitespace. Please enter a valid name."
-    return ''
-
-def validate_personal_description(personal_description):
-    if personal_description and not personal_description.strip():
-        # Check if the location is empty (consisting only of spaces or an empty string).
-        return "Personal Description cannot be just whitespace."
-    return ''
-
-    # Validate password. Think about what other constraints might be useful
-    # here for security (e.g. requiring a certain mix of character types,
-    # or avoiding overly-common passwords). Make sure that you clearly
-    # communicate any rules to the user, either through hints on the signup
-    # page or with clear error messages here.
-    #
-    # Note: Unlike the username and email address, we don't enforce a
-    # maximum password length. Because we'll be storing a hash of the
-    # password in our database, and not the password itself, it doesn't
-    # matter how long a password the user chooses. Whether it's 8 or 800
-    # characters, the hash will always be the same length.
-def validate_password(password):
-    if len(password) < 8:
-        return 'Please choose a longer password!'
-    if not re.search(r'[A-Z]', password):
-        return 'Password must contain at least one uppercase letter.'
-    if not re.search(r'[a-z]', password):
-        return 'Password must contain at least one lowercase letter.'
-    if not re.search(r'[0-9]', password):
-        return 'Password must contain at least one digit.'
-    if not re.search(r'[\W_]', password):
-        return 'Password must contain at least one special character.'
-    return ''
-
-def validate_repassword(password, repassword):
-    if password != repassword:
-        return 'The two entered passwords do not match.'
-    return ''
\ No newline at end of file
+# Messages for a username or email that is already in use.
+USERNAME_TAKEN = 'Username already exists. Please choose a different username.'
+EMAIL_TAKEN = 'Email already exists. Please choose a different email.'
+
+# Character classes.
+LETTERS_AND_DIGITS = frozenset(string.ascii_letters + string.digits)
+UPPERCASE = frozenset(string.ascii_uppercase)
+LOWERCASE = frozenset(string.ascii_lowercase)
+DIGITS = frozenset(string.digits)
+
+def is_special(char):
+    """Whether `char` is a special character: anything but a letter or digit
+    (in any script), or an underscore."""
+    return char == '_' or not char.isalnum()
+
+class Field:
+    """The rules for one form field.
+
+    Each rule is given as its parameter and the message to show when the value
+    breaks it, and they are checked in the order listed below; the first one
+    broken is the field's error. An empty (or missing) value only breaks
+    `required` and `matches`: the other rules apply to values that were given.
+
+    Args:
+        name: The form field's name.
+        required: Message if the value is empty.
+        max_length: `(length, message)`.
+        min_length: `(length, message)`.
+        not_blank: Message if the value is nothing but whitespace.
+        only: `(characters, message)`: the value may only contain characters
+            from the set `characters`.
+        contains: A list of `(characters, message)` pairs: the value must
+            contain at least one character from each set `characters` (or,
+            instead of a set, one for which the function `characters`
+            returns True).
+        email: Message if the value isn't shaped like an email address.
+        choices: `(values, message)`: the value must be one of `values`.
+        timestamp: Message if the value isn't an ISO 8601 date and time.
+        matches: `(other field, message)`: the value must equal the other
+            field's.
+    """
+    def __init__(self, name, *, required=None, max_length=None, min_length=None, not_blank=None,
+                 only=None, contains=(), email=None, choices=None, timestamp=None, matches=None):
+        self.name = name
+        self.required = required
+        self.matches = matches
+        # Checks of a non-empty value, in order.
+        self._checks = []
+        self.uses_chars = bool(only or contains)
+        if max_length:
+            self._checks.append(_max_length_check(*max_length))
+        if min_length:
+            self._checks.append(_min_length_check(*min_length))
+        if not_blank:
+            self._checks.append(_value_check(lambda value: not value.isspace(), not_blank))
+        if only:
+            self._checks.append(_only_check(*only))
+        for characters, message in contains:
+            self._checks.append(_contains_check(characters, message))
+        if email:
+            self._checks.append(_value_check(_is_email, email))
+        if choices:
+            self._checks.append(_value_check(frozenset(choices[0]).__contains__, choices[1]))
+        if timestamp:
+            self._checks.append(_value_check(_is_timestamp, timestamp))
+
+    def error(self, value, values=None):
+        """Returns the first rule `value` breaks, or `None`.
+
+        Args:
+            value: The field's value (`None` counts as empty).
+            values: The whole form, for `matches`.
+        """
+        value = value or ''
+        if self.matches:
+            other, message = self.matches
+            if value != ((values or {}).get(other) or ''):
+                return message
+        if not value:
+            return self.required
+        chars = frozenset(value) if self.uses_chars else None
+        for check in self._checks:
+            message = check(value, chars)
+            if message:
+                return message
+        return None
+
+    def with_name(self, name):
+        """Returns a copy of the field under another name (e.g. the password
+        rules for a `new_password` field)."""
+        field = object.__new__(Field)
+        field.__dict__.update(self.__dict__, name=name)
+        return field
+
+class Form:
+    """The fields of a form, validated together."""
+    def __init__(self, *fields):
+        self.fields = fields
+
+    def validate(self, values):
+        """Checks every field.
+
+        Args:
+            values: The submitted values, keyed by field name (e.g.
+                `request.form`); missing fields count as empty.
+
+        Returns:
+            The first error of each field that has one, keyed by field name,
+            in the form's field order.
+        """
+        errors = {}
+        for field in self.fields:
+            message = field.error(values.get(field.name), values)
+            if message:
+                errors[field.name] = message
+        return errors
+
+    def first_error(self, values):
+        """Returns the first error in the form, or an empty string."""
+        return next(iter(self.validate(values).values()), '')
+
+# Check factories for `Field` (each returns a function of a value and its
+# distinct characters, returning the error message or `None`).
+
+def _max_length_check(length, message):
+    return lambda value, chars: message if len(value) > length else None
+
+def _min_length_check(length, message):
+    return lambda value, chars: message if len(value) < length else None
+
+def _value_check(is_valid, message):
+    return lambda value, chars: None if is_valid(value) else message
+
+def _only_check(characters, message):
+    characters = frozenset(characters)
+    return lambda value, chars: None if chars <= characters else message
+
+def _contains_check(characters, message):
+    if callable(characters):
+        return lambda value, chars: None if any(map(characters, chars)) else message
+    characters = frozenset(characters)
+    return lambda value, chars: None if chars & characters else message
+
+def _is_email(value):
+    # Something, an @, then a domain with a dot that isn't its first or last
+    # character. Not a full check of the address, but enough to catch typos.
+    local, at, domain = value.partition('@')
+    return bool(local) and bool(at) and '@' not in domain and '.' in domain[1:-1]
+
+def _is_timestamp(value):
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+# --- Users ---
+
+# The user should never see the length errors during normal conditions,
+# because the templates set a maximum length on the input fields. However, a
+# user or attacker could easily override that and submit a longer value, so
+# we need to handle that case.
+USERNAME = Field(constants.USERNAME,
+                 required='Please enter a username.',
+                 max_length=(20, 'Your username cannot exceed 20 characters.'),
+                 only=(LETTERS_AND_DIGITS, 'Your username can only contain letters and numbers.'))
+
+EMAIL = Field(constants.EMAIL,
+              required='Invalid email address.',
+              max_length=(320, 'Your email address cannot exceed 320 characters.'),
+              email='Invalid email address.')
+
+# Unlike the username and email address, we don't enforce a maximum password
+# length. Because we'll be storing a hash of the password in our database,
+# and not the password itself, it doesn't matter how long a password the user
+# chooses.
+PASSWORD = Field(constants.PASSWORD,
+                 required='Please choose a longer password!',
+                 min_length=(8, 'Please choose a longer password!'),
+                 contains=[(UPPERCASE, 'Password must contain at least one uppercase letter.'),
+                           (LOWERCASE, 'Password must contain at least one lowercase letter.'),
+                           (DIGITS, 'Password must contain at least one digit.'),
+                           (is_special, 'Password must contain at least one special character.')])
+
+CONFIRM_PASSWORD = Field(constants.FORM_FIELD_CONFIRM_PASSWORD,
+                         matches=(constants.PASSWORD, 'The two entered passwords do not match.'))
+
+FIRST_NAME = Field(constants.FIRST_NAME,
+                   max_length=(50, 'Your first name cannot exceed 50 characters.'),
+                   not_blank='First name cannot be just whitespace. Please enter a valid name.')
+
+LAST_NAME = Field(constants.LAST_NAME,
+                  max_length=(50, 'Your last name cannot exceed 50 characters.'),
+                  not_blank='Last name cannot be just whitespace. Please enter a valid name.')
+
+LOCATION = Field(constants.LOCATION,
+                 max_length=(50, 'Your location content cannot exceed 50 characters.'),
+                 not_blank='Location cannot be just whitespace. Please enter a valid name.')
+
+PERSONAL_DESCRIPTION = Field(constants.USER_PERSONAL_DESCRIPTION,
+                             not_blank='Personal Description cannot be just whitespace.')
+
+SIGNUP_FORM = Form(USERNAME, EMAIL, PASSWORD, CONFIRM_PASSWORD, FIRST_NAME, LAST_NAME, LOCATION)
+
+PROFILE_FORM = Form(EMAIL, FIRST_NAME, LAST_NAME, LOCATION, PERSONAL_DESCRIPTION)
+
+CHANGE_PASSWORD_FORM = Form(
+    PASSWORD.with_name(constants.FORM_FIELD_NEW_PASSWORD),
+    Field(constants.FORM_FIELD_CONFIRM_PASSWORD,
+          matches=(constants.FORM_FIELD_NEW_PASSWORD, 'The two entered passwords do not match.')))
+
+# An admin changing a user's role and status.
+USER_EDIT_FORM = Form(
+    Field(constants.USER_ROLE, required='Invalid role',
+          choices=((constants.USER_ROLE_TRAVELLER, constants.USER_ROLE_EDITOR, constants.USER_ROLE_ADMIN),
+                   'Invalid role')),
+    Field(constants.USER_STATUS, required='Invalid status',
+          choices=((constants.USER_STATUS_ACTIVE, constants.USER_STATUS_BANNED), 'Invalid status')))
+
+def email_taken(email, user_id=None):
+    """Whether another user (than `user_id`, if given) already has `email`."""
+    existing_user = queries.fetch_one(queries.USER_ID_BY_EMAIL, (email,))
+    return existing_user is not None and (user_id is None or existing_user[constants.USER_ID] != int(user_id))
+
+# --- Events ---
+
+# The same rules apply to events added through the form and imported in bulk
+# (see app/utils/event_io.py).
+_EVENT_REQUIRED = 'Title, start time and location are required'
+
+EVENT_FORM = Form(
+    Field('title', required=_EVENT_REQUIRED, not_blank=_EVENT_REQUIRED,
+          max_length=(100, 'The title cannot exceed 100 characters')),
+    Field('start_time', required=_EVENT_REQUIRED, timestamp='Invalid start time'),
+    Field('end_time', timestamp='Invalid end time'),
+    Field('location', required=_EVENT_REQUIRED, not_blank=_EVENT_REQUIRED,
+          max_length=(100, 'The location cannot exceed 100 characters')))
+
+# --- Announcements ---
+
+_ANNOUNCEMENT_REQUIRED = 'Title and content are required'
+
+ANNOUNCEMENT_FORM = Form(
+    Field('title', required=_ANNOUNCEMENT_REQUIRED, not_blank=_ANNOUNCEMENT_REQUIRED,
+          max_length=(255, 'The title cannot exceed 255 characters')),
+    Field('content', required=_ANNOUNCEMENT_REQUIRED, not_blank=_ANNOUNCEMENT_REQUIRED),
+    Field('level', required='Invalid level', choices=(('high', 'medium', 'low'), 'Invalid level')),
+    Field('status', required='Invalid status', choices=(('active', 'inactive'), 'Invalid status')))
@@ -1,8 +1,12 @@
 -- Drop existing tables to ensure no conflicts.
+DROP TABLE IF EXISTS journey_feed;
 DROP TABLE IF EXISTS events;
 DROP TABLE IF EXISTS journeys;
 DROP TABLE IF EXISTS announcements;
 DROP TABLE IF EXISTS users;
+DROP TABLE IF EXISTS schema_migrations;
+DROP TABLE IF EXISTS image_blobs;
+DROP TABLE IF EXISTS content_versions;
 
 CREATE TABLE users (
     user_id INT AUTO_INCREMENT PRIMARY KEY,
@@ -54,3 +58,6 @@ CREATE TABLE announcements (
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE RESTRICT  -- Ensures user_id references a valid user in the users table, preventing deletion of users with associated records
 );
 
+-- Indexes and later changes to the schema are applied by the migrations in
+-- app/db/migrations/. After creating the tables, run:
+--     flask --app app db migrate
@@ -0,0 +1,18 @@
+"""Shared setup for the unit tests.
+
+None of the tests touch the database, but importing anything under `app.db`
+imports `app/db/connect.py`, the database credentials each developer creates
+for themselves (it isn't committed). If it's missing, placeholder credentials
+are used instead.
+"""
+import os
+import sys
+import types
+
+_CONNECT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'app', 'db', 'connect.py')
+
+if not os.path.exists(_CONNECT):
+    connect = types.ModuleType('app.db.connect')
+    connect.dbuser = connect.dbpass = connect.dbhost = connect.dbname = ''
+    sys.modules['app.db.connect'] = connect
@@ -0,0 +1,65 @@
+import io
+from datetime import datetime
+from app.utils import event_io
+
+def _rows(data, file_format):
+    return list(event_io._read_rows(io.BytesIO(data), file_format))
+
+def test_parse_event():
+    values, error = event_io.parse_event({'title': ' Hike ', 'start_time': '2024-05-01T10:30',
+                                          'end_time': '2024-05-01 16:00:00', 'location': 'Arthur\'s Pass'})
+    assert error is None
+    assert values == ('Hike', '', datetime(2024, 5, 1, 10, 30), datetime(2024, 5, 1, 16), 'Arthur\'s Pass')
+    values, error = event_io.parse_event({'title': 'Hike', 'start_time': '2024-05-01', 'location': 'Here',
+                                          'end_time': None, 'extra': 'ignored'})
+    assert (values[3], error) == (None, None)
+
+def test_parse_event_errors():
+    row = {'title': 'Hike', 'start_time': '2024-05-01T10:30', 'location': 'Here'}
+    assert event_io.parse_event(['Hike']) == (None, 'Each line must be a JSON object')
+    assert event_io.parse_event(dict(row, title='  ')) == (None, 'Title, start time and location are required')
+    assert event_io.parse_event(dict(row, location=None)) == (None, 'Title, start time and location are required')
+    assert event_io.parse_event(dict(row, start_time='soon')) == (None, 'Invalid start time')
+    assert event_io.parse_event(dict(row, end_time='2024-05-01 25:00')) == (None, 'Invalid end time')
+    assert event_io.parse_event(dict(row, title='x' * 101)) == (None, 'The title cannot exceed 100 characters')
+
+def test_csv_line_numbers():
+    data = ('title,start_time,location\n'
+            'A,2024-05-01,Here\n'
+            '"Multi\nline",2024-05-02,There\n'
+            'C,2024-05-03,Everywhere\n').encode('utf-8')
+    rows = _rows(data, 'csv')
+    assert [(line, row['title'], error) for line, row, error in rows] == \
+        [(2, 'A', None), (4, 'Multi\nline', None), (5, 'C', None)]
+
+def test_csv_needs_a_header():
+    rows = _rows(b'A,2024-05-01,Here\n', 'csv')
+    assert rows == [(0, None, 'The first line must name the columns: '
+                              'title, description, start_time, end_time, location')]
+    assert _rows(b'', 'csv')[0][0] == 0
+
+def test_csv_with_bom():
+    rows = _rows('﻿title,start_time,location\nA,2024-05-01,Here\n'.encode('utf-8'), 'csv')
+    assert rows[0][1]['title'] == 'A'
+
+def test_jsonl_errors():
+    data = b'{"title": "A"}\n\n{"title": \n["not", "an", "object"]\n'
+    rows = _rows(data, 'jsonl')
+    assert rows == [(1, {'title': 'A'}, None), (3, None, 'Invalid JSON'), (4, ['not', 'an', 'object'], None)]
+    assert event_io.parse_event(rows[2][1])[1] == 'Each line must be a JSON object'
+
+def test_not_utf8():
+    assert _rows(b'{"title": "caf\xe9"}\n', 'jsonl') == [(0, None, 'The file must be UTF-8 text')]
+
+def test_stream_is_left_open():
+    stream = io.BytesIO(b'{}\n')
+    list(event_io._read_rows(stream, 'jsonl'))
+    assert not stream.closed
+
+def test_detect_format():
+    assert event_io.detect_format('Trip.CSV') == 'csv'
+    assert event_io.detect_format('trip.ndjson') == 'jsonl'
+    assert event_io.detect_format('trip.txt') is None
+    assert event_io.detect_format(None) is None
+    assert event_io.detect_format('trip.txt', 'jsonl') == 'jsonl'
+    assert event_io.detect_format('trip.csv', 'xml') is None
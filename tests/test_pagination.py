@@ -0,0 +1,54 @@
+import base64
+import json
+from datetime import datetime
+from app.config import constants
+from app.utils import pagination
+
+def _token(value):
+    """Encodes any JSON value the way `encode_cursor()` encodes keys."""
+    raw = json.dumps(value).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def test_round_trip():
+    token = pagination.encode_cursor(('alice', 12))
+    assert '=' not in token
+    assert pagination.decode_cursor(token, (str, int)) == ('alice', 12)
+
+def test_round_trip_with_timestamp():
+    token = pagination.encode_cursor(('2024-05-01T10:30:00', 7))
+    assert pagination.decode_cursor(token, (datetime, int)) == ('2024-05-01T10:30:00', 7)
+
+def test_no_token():
+    assert pagination.decode_cursor(None, (str, int)) is None
+    assert pagination.decode_cursor('', (str, int)) is None
+
+def test_not_base64_or_json():
+    assert pagination.decode_cursor('!!!', (str, int)) is None
+    assert pagination.decode_cursor(_token('x')[:-2] + '@@', (str,)) is None
+    not_json = base64.urlsafe_b64encode(b'{not json').decode('ascii')
+    assert pagination.decode_cursor(not_json, (str, int)) is None
+
+def test_not_a_list_or_wrong_length():
+    assert pagination.decode_cursor(_token({'a': 1}), (str, int)) is None
+    assert pagination.decode_cursor(_token(['alice']), (str, int)) is None
+    assert pagination.decode_cursor(_token(['alice', 1, 2]), (str, int)) is None
+
+def test_wrong_types():
+    assert pagination.decode_cursor(_token([12, 'alice']), (str, int)) is None
+    assert pagination.decode_cursor(_token(['alice', '12']), (str, int)) is None
+    assert pagination.decode_cursor(_token(['alice', 1.5]), (str, int)) is None
+    assert pagination.decode_cursor(_token(['alice', None]), (str, int)) is None
+
+def test_bool_is_not_an_int():
+    assert pagination.decode_cursor(_token(['alice', True]), (str, int)) is None
+
+def test_invalid_timestamp():
+    assert pagination.decode_cursor(_token(['yesterday', 1]), (datetime, int)) is None
+    assert pagination.decode_cursor(_token([1714559400, 1]), (datetime, int)) is None
+
+def test_page_size():
+    assert pagination.page_size(None) == constants.DEFAULT_PAGE_SIZE
+    assert pagination.page_size('ten', default=5) == 5
+    assert pagination.page_size('20') == 20
+    assert pagination.page_size('0') == 1
+    assert pagination.page_size(str(constants.MAX_PAGE_SIZE + 1)) == constants.MAX_PAGE_SIZE
@@ -0,0 +1,55 @@
+from app.search import planner
+from app.search.planner import UserFilter
+
+_COLUMNS = 'user_id, username, email, first_name, last_name, role, status'
+
+def test_no_filter():
+    page, roles, statuses = planner.compile_filter(UserFilter(), all_users=True, per_page=50)
+    assert page == (f'SELECT {_COLUMNS} FROM users ORDER BY username, user_id LIMIT %s', (51,))
+    assert roles == ('SELECT role, COUNT(*) AS count FROM users GROUP BY role', ())
+    assert statuses == ('SELECT status, COUNT(*) AS count FROM users GROUP BY status', ())
+
+def test_system_users_only():
+    page, roles, _ = planner.compile_filter(UserFilter(), all_users=False, per_page=10)
+    assert page[0] == (f"SELECT {_COLUMNS} FROM users WHERE role IN ('editor', 'admin') "
+                       'ORDER BY username, user_id LIMIT %s')
+    assert roles[0] == ("SELECT role, COUNT(*) AS count FROM users WHERE role IN ('editor', 'admin') "
+                        'GROUP BY role')
+
+def test_fields_and_facets():
+    search = UserFilter(fields={'last_name': 'smi', 'username': 'j'}, role='editor', status='banned')
+    page, roles, statuses = planner.compile_filter(search, all_users=True, per_page=20)
+    # Fields are always in `FIELDS` order.
+    assert page == (f'SELECT {_COLUMNS} FROM users WHERE username LIKE %s AND last_name LIKE %s '
+                    'AND role = %s AND status = %s ORDER BY username, user_id LIMIT %s',
+                    ('j%', 'smi%', 'editor', 'banned', 21))
+    # Each facet's counts apply every filter but its own.
+    assert roles == ('SELECT role, COUNT(*) AS count FROM users WHERE username LIKE %s '
+                     'AND last_name LIKE %s AND status = %s GROUP BY role',
+                     ('j%', 'smi%', 'banned'))
+    assert statuses == ('SELECT status, COUNT(*) AS count FROM users WHERE username LIKE %s '
+                        'AND last_name LIKE %s AND role = %s GROUP BY status',
+                        ('j%', 'smi%', 'editor'))
+
+def test_after_cursor():
+    page, roles, _ = planner.compile_filter(UserFilter(), all_users=True, per_page=5, after=('bob', 7))
+    assert page == (f'SELECT {_COLUMNS} FROM users WHERE (username > %s OR (username = %s AND user_id > %s)) '
+                    'ORDER BY username, user_id LIMIT %s', ('bob', 'bob', 7, 6))
+    # The counts cover every page.
+    assert roles == ('SELECT role, COUNT(*) AS count FROM users GROUP BY role', ())
+
+    page, _, _ = planner.compile_filter(UserFilter(status='active'), all_users=True, per_page=5,
+                                        after=('bob', 7))
+    assert page == (f'SELECT {_COLUMNS} FROM users WHERE status = %s '
+                    'AND (username > %s OR (username = %s AND user_id > %s)) '
+                    'ORDER BY username, user_id LIMIT %s', ('active', 'bob', 'bob', 7, 6))
+
+def test_wildcards_match_literally():
+    assert planner.escape_like('50%_off\\') == '50\\%\\_off\\\\'
+    page, _, _ = planner.compile_filter(UserFilter(fields={'email': 'a_b%'}), all_users=True, per_page=1)
+    assert page[1] == ('a\\_b\\%%', 2)
+
+def test_parse_filter():
+    search = planner.parse_filter({'username': ' ali ', 'email': '  ', 'role': 'editor',
+                                   'status': 'deleted', 'location': 'x'})
+    assert search == UserFilter(fields={'username': 'ali'}, role='editor', status=None)
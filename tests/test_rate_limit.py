@@ -0,0 +1,61 @@
+import pytest
+from app.utils import rate_limit
+
+WINDOW = 60.0
+
+def test_limit_within_one_window():
+    store = rate_limit.MemoryStore(shards=4)
+    results = [store.hit('login:ip:1', 10.0 + i, WINDOW, 3) for i in range(4)]
+    assert results == [(True, 0), (True, 1), (True, 2), (False, 3)]
+
+def test_refused_attempts_are_not_counted():
+    store = rate_limit.MemoryStore()
+    for i in range(10):
+        store.hit('key', 10.0 + i, WINDOW, 3)
+    # Only the 3 allowed attempts carry over, weighted by the overlap.
+    assert store.hit('key', WINDOW + 30.0, WINDOW, 3) == (True, pytest.approx(1.5))
+
+def test_previous_window_is_weighted_by_its_overlap():
+    store = rate_limit.MemoryStore()
+    for i in range(4):
+        store.hit('key', 50.0 + i, WINDOW, 4)
+    # A quarter of the way into the next window, 3/4 of the sliding window
+    # still overlaps the previous one: 4 * 0.75 = 3 attempts.
+    now = WINDOW + 15.0
+    assert store.hit('key', now, WINDOW, 4) == (True, pytest.approx(3.0))
+    assert store.hit('key', now, WINDOW, 4) == (False, pytest.approx(4.0))
+    # Later in the window, older attempts have slid out.
+    assert store.hit('key', WINDOW + 45.0, WINDOW, 4) == (True, pytest.approx(2.0))
+
+def test_counts_older_than_the_previous_window_are_dropped():
+    store = rate_limit.MemoryStore()
+    for i in range(3):
+        store.hit('key', 10.0 + i, WINDOW, 3)
+    assert store.hit('key', 2 * WINDOW + 1.0, WINDOW, 3) == (True, 0)
+
+def test_keys_are_counted_separately():
+    store = rate_limit.MemoryStore(shards=2)
+    assert store.hit('a', 1.0, WINDOW, 1) == (True, 0)
+    assert store.hit('b', 1.0, WINDOW, 1) == (True, 0)
+    assert store.hit('a', 2.0, WINDOW, 1)[0] is False
+    assert store.size() == 2
+
+def test_check():
+    rate_limit.init_rate_limits(WINDOW, {('login', rate_limit.KEY_IP): 2,
+                                         ('login', rate_limit.KEY_USERNAME): 0})
+    keys = {rate_limit.KEY_IP: '10.0.0.1', rate_limit.KEY_USERNAME: 'alice'}
+    assert rate_limit.check('login', keys) is None
+    assert rate_limit.check('login', keys) is None
+    retry_after = rate_limit.check('login', keys)
+    assert 1 <= retry_after <= WINDOW
+    # Other actions, other IPs and empty keys aren't limited.
+    assert rate_limit.check('signup', keys) is None
+    assert rate_limit.check('login', {rate_limit.KEY_IP: '10.0.0.2'}) is None
+    assert rate_limit.check('login', {rate_limit.KEY_IP: ''}) is None
+    stats = rate_limit.stats()
+    assert stats['limits'] == {'login:ip': dict(allowed=3, refused=1)}
+    assert stats['tracked_keys'] == 2
+
+def test_normalise_username():
+    assert rate_limit.normalise_username(' Alice ') == 'alice'
+    assert rate_limit.normalise_username(None) == ''
@@ -0,0 +1,84 @@
+import pytest
+from app.search.index import UserSearchIndex, ngrams
+
+def _user(user_id, username, first_name='', last_name='', email='', role='traveller'):
+    return dict(user_id=user_id, username=username, first_name=first_name, last_name=last_name,
+                email=email, role=role)
+
+@pytest.fixture
+def index():
+    index = UserSearchIndex()
+    index.load([
+        _user(1, 'smith', email='one@example.com'),
+        _user(2, 'smithers', email='two@example.com'),
+        _user(3, 'jo', first_name='Anna', last_name='Smithson'),
+        _user(4, 'blacksmith', email='four@example.com'),
+        _user(5, 'zed', email='smith@example.com'),
+        _user(6, 'other', email='six@example.com'),
+    ])
+    return index
+
+def _ids(rows):
+    return [row['user_id'] for row in rows]
+
+def test_ngrams():
+    assert ngrams('abcd') == {'a', 'b', 'c', 'd', 'ab', 'bc', 'cd', 'abc', 'bcd'}
+
+def test_ranking(index):
+    rows, total = index.search('Smith')
+    # Exact username, username prefix, last name prefix, then a username
+    # substring and an email prefix (equal scores, in username order).
+    assert _ids(rows) == [1, 2, 3, 4, 5]
+    assert total == 5
+
+def test_ties_in_username_order():
+    index = UserSearchIndex()
+    index.load([_user(1, 'bella'), _user(2, 'abel'), _user(3, 'isabel')])
+    rows, _ = index.search('bel')
+    assert _ids(rows) == [1, 2, 3]
+    index.add(_user(4, 'bel'))
+    assert _ids(index.search('bel')[0]) == [4, 1, 2, 3]
+
+def test_long_terms_must_match_whole(index):
+    index.add(_user(7, 'abcxbcd'))
+    assert index.search('abcd') == ([], 0)
+    assert _ids(index.search('bcxb')[0]) == [7]
+
+def test_fields_where_and_paging(index):
+    assert _ids(index.search('smith', fields=['email'])[0]) == [5]
+    rows, total = index.search('smith', where=lambda row: row['user_id'] % 2 == 0)
+    assert (_ids(rows), total) == ([2, 4], 2)
+    rows, total = index.search('smith', offset=1, limit=2)
+    assert (_ids(rows), total) == ([2, 3], 5)
+    assert index.search('   ') == ([], 0)
+
+def test_results_are_copies(index):
+    rows, _ = index.search('other')
+    rows[0]['role'] = 'admin'
+    assert index.search('other')[0][0]['role'] == 'traveller'
+
+def test_remove(index):
+    index.remove(1)
+    assert len(index) == 5
+    assert _ids(index.search('smith')[0]) == [2, 3, 4, 5]
+    assert index.search('one@')[0] == []
+    # None of its n-grams still point at it.
+    assert not any(1 in posting for posting in index._postings.values())
+    index.remove(1)
+    assert len(index) == 5
+
+def test_remove_drops_empty_postings():
+    index = UserSearchIndex()
+    index.add(_user(1, 'qqq'))
+    index.remove(1)
+    assert index._postings == {}
+
+def test_add_replaces_and_update_changes(index):
+    index.add(_user(6, 'renamed'))
+    assert index.search('other') == ([], 0)
+    assert _ids(index.search('renamed')[0]) == [6]
+    index.update(3, last_name='Jones')
+    assert 3 not in _ids(index.search('smith')[0])
+    assert _ids(index.search('anna jones')[0]) == [3]
+    index.update(99, username='nobody')
+    assert len(index) == 6
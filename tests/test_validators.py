@@ -0,0 +1,86 @@
+from app.config import constants
+from app.utils import validators
+
+SIGNUP = {
+    constants.USERNAME: 'alice99',
+    constants.EMAIL: 'alice@example.com',
+    constants.PASSWORD: 'Passw0rd!',
+    constants.FORM_FIELD_CONFIRM_PASSWORD: 'Passw0rd!',
+    constants.FIRST_NAME: 'Alice',
+    constants.LAST_NAME: '',
+    constants.LOCATION: 'Christchurch',
+}
+
+def test_valid_signup():
+    assert validators.SIGNUP_FORM.validate(SIGNUP) == {}
+
+def test_missing_fields_count_as_empty():
+    errors = validators.SIGNUP_FORM.validate({})
+    assert errors == {
+        constants.USERNAME: 'Please enter a username.',
+        constants.EMAIL: 'Invalid email address.',
+        constants.PASSWORD: 'Please choose a longer password!',
+    }
+
+def test_every_field_is_checked_in_form_order():
+    errors = validators.SIGNUP_FORM.validate(dict(SIGNUP, username='alice_99', email='alice',
+                                                  confirm_password='other'))
+    assert list(errors) == [constants.USERNAME, constants.EMAIL, constants.FORM_FIELD_CONFIRM_PASSWORD]
+    assert errors[constants.USERNAME] == 'Your username can only contain letters and numbers.'
+    assert errors[constants.FORM_FIELD_CONFIRM_PASSWORD] == 'The two entered passwords do not match.'
+
+def test_first_broken_rule_is_reported():
+    field = validators.PASSWORD
+    assert field.error('Pass!1') == 'Please choose a longer password!'
+    assert field.error('password1!') == 'Password must contain at least one uppercase letter.'
+    assert field.error('PASSWORD1!') == 'Password must contain at least one lowercase letter.'
+    assert field.error('Password!!') == 'Password must contain at least one digit.'
+    assert field.error('Password12') == 'Password must contain at least one special character.'
+    assert field.error('Pässword12') == 'Password must contain at least one special character.'
+    assert field.error('Passw0rd€') is None
+
+def test_is_special():
+    assert validators.is_special('_')
+    assert validators.is_special(' ')
+    assert not validators.is_special('é')
+    assert not validators.is_special('7')
+
+def test_username_length_and_characters():
+    assert validators.USERNAME.error('a' * 20) is None
+    assert validators.USERNAME.error('a' * 21) == 'Your username cannot exceed 20 characters.'
+    assert validators.USERNAME.error('zoë') == 'Your username can only contain letters and numbers.'
+
+def test_email_shape():
+    assert validators.EMAIL.error('a@b.co') is None
+    for email in ('@b.co', 'a@bco', 'a@.co', 'a@b.', 'a@b@c.co'):
+        assert validators.EMAIL.error(email) == 'Invalid email address.', email
+
+def test_optional_fields():
+    assert validators.FIRST_NAME.error('') is None
+    assert validators.FIRST_NAME.error(None) is None
+    assert validators.FIRST_NAME.error('   ') == \
+        'First name cannot be just whitespace. Please enter a valid name.'
+    assert validators.FIRST_NAME.error('x' * 51) == 'Your first name cannot exceed 50 characters.'
+
+def test_renamed_field_keeps_its_rules():
+    errors = validators.CHANGE_PASSWORD_FORM.validate({constants.FORM_FIELD_NEW_PASSWORD: 'short',
+                                                       constants.FORM_FIELD_CONFIRM_PASSWORD: 'short'})
+    assert errors == {constants.FORM_FIELD_NEW_PASSWORD: 'Please choose a longer password!'}
+    assert validators.PASSWORD.name == constants.PASSWORD
+
+def test_choices():
+    form = validators.USER_EDIT_FORM
+    assert form.validate({constants.USER_ROLE: constants.USER_ROLE_EDITOR,
+                          constants.USER_STATUS: constants.USER_STATUS_BANNED}) == {}
+    assert form.validate({constants.USER_ROLE: 'root', constants.USER_STATUS: ''}) == {
+        constants.USER_ROLE: 'Invalid role',
+        constants.USER_STATUS: 'Invalid status',
+    }
+
+def test_event_form():
+    event = {'title': 'Hike', 'start_time': '2024-05-01T10:30', 'location': 'Arthur\'s Pass'}
+    assert validators.EVENT_FORM.first_error(event) == ''
+    assert validators.EVENT_FORM.first_error(dict(event, end_time='later')) == 'Invalid end time'
+    assert validators.EVENT_FORM.first_error(dict(event, start_time='2024-13-01')) == 'Invalid start time'
+    assert validators.EVENT_FORM.first_error(dict(event, title=' ')) == \
+        'Title, start time and location are required'
@@ -14,5 +14,6 @@ print("Python path:", sys.path)
 print("Current working directory:", os.getcwd())
 print("Files in current directory:", os.listdir())
 
-# Import the Flask application
-from app import app as application 
\ No newline at end of file
+# Build the Flask application
+from app import create_app
+application = create_app()
\ No newline at end of file